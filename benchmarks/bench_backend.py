@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Per-call overhead of Backend.do_request against a stand-in tracker which
+answers every command with the same canned response.  The raw socket
+round trip over the same kind of connection is measured as the floor,
+and Backend.do_request_iter for comparison.
+
+    python -m benchmarks.bench_backend [options]
+"""
+import time
+import socket
+import threading
+import SocketServer
+from optparse import OptionParser
+
+from mogilefs.backend import Backend
+
+class CannedTracker(object):
+    """
+    Replies `response` to every line it receives.
+    """
+    def __init__(self, response='OK 1 \r\n', host='127.0.0.1', port=0):
+        class Handler(SocketServer.StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                while self.rfile.readline():
+                    self.wfile.write(response)
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server((host, port), Handler)
+        self.address = '%s:%d' % self._server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def canned_response(pairs):
+    """
+    An OK response carrying `pairs` key_N=valueN arguments.
+    """
+    args = ['key_count=%d' % pairs]
+    for x in xrange(1, pairs + 1):
+        args.append('key_%d=some%%2Fkey%%2F%d' % (x, x))
+    return 'OK 1 %s\r\n' % '&'.join(args)
+
+def bench_raw(address, iterations):
+    host, port = address.split(':')
+    sock = socket.create_connection((host, int(port)))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    rfile = sock.makefile('rb')
+    start = time.time()
+    for x in xrange(iterations):
+        sock.sendall('list_keys domain=bench\r\n')
+        rfile.readline()
+    elapsed = time.time() - start
+    sock.close()
+    return elapsed
+
+def bench_backend(address, iterations):
+    backend = Backend([address])
+    backend.metrics = None
+    backend.do_request('list_keys', { 'domain': 'bench' })
+    start = time.time()
+    for x in xrange(iterations):
+        backend.do_request('list_keys', { 'domain': 'bench' })
+    return time.time() - start
+
+def bench_stream(address, iterations):
+    backend = Backend([address])
+    backend.metrics = None
+    backend.do_request('list_keys', { 'domain': 'bench' })
+    start = time.time()
+    for x in xrange(iterations):
+        for pair in backend.do_request_iter('list_keys', { 'domain': 'bench' }):
+            pass
+    return time.time() - start
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--iterations', type='int', default=20000,
+                      help='requests per measurement [%default]')
+    parser.add_option('-p', '--pairs', type='int', action='append',
+                      help='arguments in the response, may be repeated [0, 1000]')
+    options, args = parser.parse_args(argv)
+
+    print '%8s %12s %12s %12s %12s' % ('pairs', 'raw us', 'backend us', 'overhead us', 'stream us')
+    for pairs in options.pairs or [0, 1000]:
+        iterations = max(options.iterations / max(pairs / 10, 1), 100)
+        tracker = CannedTracker(canned_response(pairs)).start()
+        try:
+            raw = bench_raw(tracker.address, iterations) / iterations * 1e6
+            backend = bench_backend(tracker.address, iterations) / iterations * 1e6
+            stream = bench_stream(tracker.address, iterations) / iterations * 1e6
+        finally:
+            tracker.stop()
+        print '%8d %12.1f %12.1f %12.1f %12.1f' % (pairs, raw, backend, backend - raw, stream)
+
+if __name__ == '__main__':
+    main()
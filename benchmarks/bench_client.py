@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput and latency of the Client operations against an in-process
+fake cluster.
+
+    python -m benchmarks.bench_client [options]
+"""
+import sys
+import time
+import random
+import threading
+from optparse import OptionParser
+from cStringIO import StringIO
+
+from mogilefs import Client, Admin, MogileFSError
+from benchmarks.fakes import Cluster, Faults
+
+DOMAIN = 'benchmark'
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    idx = int(round((len(samples) - 1) * p / 100.0))
+    return samples[idx]
+
+class Result(object):
+    def __init__(self, name, samples, errors, elapsed):
+        self.name    = name
+        self.samples = sorted(samples)
+        self.errors  = errors
+        self.elapsed = elapsed
+
+    def ops(self):
+        if not self.elapsed:
+            return 0.0
+        return len(self.samples) / self.elapsed
+
+    def format(self):
+        ms = lambda p: percentile(self.samples, p) * 1000
+        return '%-16s %8d %6d %10.1f %8.3f %8.3f %8.3f %8.3f' % (
+            self.name, len(self.samples), self.errors, self.ops(),
+            ms(50), ms(90), ms(99), ms(100))
+
+HEADER = '%-16s %8s %6s %10s %8s %8s %8s %8s' % (
+    'operation', 'ops', 'errors', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+
+def run(name, func, iterations, threads=1):
+    """
+    Calls func(i) for i in range(iterations), spread over `threads`
+    threads, and returns a Result with the latency of every call.
+    """
+    samples = []
+    errors  = [0]
+    lock    = threading.Lock()
+    counter = iter(xrange(iterations))
+
+    def worker():
+        local = []
+        failed = 0
+        while 1:
+            lock.acquire()
+            try:
+                i = counter.next()
+            except StopIteration:
+                lock.release()
+                break
+            lock.release()
+            start = time.time()
+            try:
+                func(i)
+            except MogileFSError:
+                failed += 1
+                continue
+            local.append(time.time() - start)
+        lock.acquire()
+        samples.extend(local)
+        errors[0] += failed
+        lock.release()
+
+    start = time.time()
+    workers = [threading.Thread(target=worker) for x in xrange(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return Result(name, samples, errors[0], time.time() - start)
+
+def benchmark(client, iterations=1000, size=4096, threads=1, out=sys.stdout):
+    data = ''.join(chr(random.randint(0, 255)) for x in xrange(size))
+    keys = ['bench_%d' % i for i in xrange(iterations)]
+
+    results = []
+    results.append(run('store_content', lambda i: client.store_content(keys[i], data),
+                       iterations, threads))
+    results.append(run('store_file', lambda i: client.store_file('file_' + keys[i], StringIO(data)),
+                       iterations, threads))
+    results.append(run('get_paths', lambda i: client.get_paths(keys[i]),
+                       iterations, threads))
+    results.append(run('get_file_data', lambda i: client.get_file_data(keys[i]),
+                       iterations, threads))
+    results.append(run('list_keys', lambda i: client.list_keys(prefix='bench_', limit=100),
+                       iterations, threads))
+
+    print >>out, HEADER
+    for result in results:
+        print >>out, result.format()
+    return results
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--iterations', type='int', default=1000,
+                      help='calls per operation [%default]')
+    parser.add_option('-s', '--size', type='int', default=4096,
+                      help='size of the stored content in bytes [%default]')
+    parser.add_option('-t', '--threads', type='int', default=1,
+                      help='concurrent callers sharing one Client [%default]')
+    parser.add_option('--nodes', type='int', default=3,
+                      help='number of storage nodes [%default]')
+    parser.add_option('--tracker-latency', type='float', default=0,
+                      help='seconds added to every tracker command [%default]')
+    parser.add_option('--storage-latency', type='float', default=0,
+                      help='seconds added to every storage request [%default]')
+    parser.add_option('--error-rate', type='float', default=0,
+                      help='probability of a storage request failing [%default]')
+    options, args = parser.parse_args(argv)
+
+    cluster = Cluster(nodes=options.nodes,
+                      tracker_faults=Faults(latency=options.tracker_latency),
+                      storage_faults=Faults(latency=options.storage_latency,
+                                            error_rate=options.error_rate))
+    cluster.start()
+    try:
+        Admin(cluster.hosts).create_domain(DOMAIN)
+        client = Client(DOMAIN, cluster.hosts)
+        benchmark(client, options.iterations, options.size, options.threads)
+    finally:
+        cluster.stop()
+
+if __name__ == '__main__':
+    main()
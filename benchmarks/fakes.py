@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stand-ins for a mogilefsd tracker and a DAV storage node, so
+the client can be exercised and measured without a MogileFS cluster.
+
+    cluster = Cluster(nodes=3).start()
+    client = Client('domain', cluster.hosts)
+    ...
+    cluster.stop()
+"""
+import re
+import time
+import random
+import urllib
+import threading
+import SocketServer
+import BaseHTTPServer
+
+def _encode(args):
+    return '&'.join(['%s=%s' % (urllib.quote_plus(str(k)), urllib.quote_plus(str(v)))
+                     for k, v in args.items()])
+
+def _decode(arg):
+    params = {}
+    for pair in arg.split('&'):
+        if not pair:
+            continue
+        k, _, v = pair.partition('=')
+        params[urllib.unquote_plus(k)] = urllib.unquote_plus(v)
+    return params
+
+class Faults(object):
+    """
+    Latency and failure injection shared by the fake servers.  latency is
+    in seconds; error_rate is the probability of failing a request.
+    """
+    def __init__(self, latency=0, error_rate=0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+    def apply(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.error_rate and random.random() < self.error_rate
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # many clients connect at once; a dropped SYN outlasts the client's
+    # connect timeout and gets the tracker marked dead
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # clients dropping connections is business as usual here
+        pass
+
+
+class FakeStorage(object):
+    """
+    A DAV storage node holding its files in memory.  Supports PUT
+    (including Content-Range and chunked bodies), GET and HEAD with Range,
+    MKCOL and DELETE.
+
+    For testing reads, drop_after cuts GET bodies off after that many
+    bytes and closes the connection, and ignore_range answers every GET
+    with the whole file.
+    """
+    def __init__(self, host='127.0.0.1', port=0, faults=None, require_mkcol=False):
+        self.files = {}
+        self.dirs = set()
+        self.faults = faults or Faults()
+        self.require_mkcol = require_mkcol
+        self.requests = []
+        self.drop_after = None
+        self.ignore_range = False
+        storage = self
+
+        class Handler(_StorageHandler):
+            pass
+        Handler.storage = storage
+        self._server = _Server((host, port), Handler)
+        self.host, self.port = self._server.server_address
+        self.netloc = '%s:%d' % (self.host, self.port)
+        self._thread = None
+
+    def url(self, path):
+        return 'http://%s%s' % (self.netloc, path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _StorageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    storage = None
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body='', headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            drop_after = self.storage.drop_after
+            if self.command == 'GET' and drop_after is not None and len(body) > drop_after:
+                self.wfile.write(body[:drop_after])
+                self.close_connection = 1
+                return
+            self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            buf = []
+            while 1:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    while self.rfile.readline() not in ('\r\n', '\n', ''):
+                        pass
+                    break
+                buf.append(self.rfile.read(size))
+                self.rfile.readline()
+            return ''.join(buf)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _fault(self):
+        self.storage.requests.append((self.command, self.path))
+        if self.storage.faults.apply():
+            self._reply(500, 'injected failure')
+            return True
+        return False
+
+    def do_PUT(self):
+        body = self._read_body()
+        if self._fault():
+            return
+        parent = self.path.rsplit('/', 1)[0] + '/'
+        if self.storage.require_mkcol and parent not in self.storage.dirs:
+            return self._reply(403)
+        rng = self.headers.get('Content-Range')
+        if rng:
+            m = re.match(r'bytes (\d+)-(\d+)/', rng)
+            start = int(m.group(1))
+            data = self.storage.files.get(self.path, '')
+            data = data.ljust(start, '\0')
+            self.storage.files[self.path] = data[:start] + body + data[start + len(body):]
+        else:
+            self.storage.files[self.path] = body
+        self._reply(201)
+
+    def do_MKCOL(self):
+        if self._fault():
+            return
+        if self.path in self.storage.dirs:
+            return self._reply(405)
+        self.storage.dirs.add(self.path)
+        self._reply(201)
+
+    def do_DELETE(self):
+        if self._fault():
+            return
+        if self.storage.files.pop(self.path, None) is None:
+            return self._reply(404)
+        self._reply(204)
+
+    def _ranges(self, length):
+        header = self.headers.get('Range')
+        if not header or self.storage.ignore_range:
+            return None
+        ranges = []
+        for spec in header.split('=', 1)[1].split(','):
+            start, end = spec.strip().split('-')
+            if not start:
+                start, end = length - int(end), length - 1
+            else:
+                start = int(start)
+                end = end and min(int(end), length - 1) or length - 1
+            if start >= length:
+                continue
+            ranges.append((start, end))
+        return ranges
+
+    def do_GET(self):
+        if self._fault():
+            return
+        data = self.storage.files.get(self.path)
+        if data is None:
+            return self._reply(404)
+        ranges = self._ranges(len(data))
+        if ranges is None:
+            return self._reply(200, data)
+        if not ranges:
+            return self._reply(416, '', {'Content-Range': 'bytes */%d' % len(data)})
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            return self._reply(206, data[start:end + 1],
+                               {'Content-Range': 'bytes %d-%d/%d' % (start, end, len(data))})
+        boundary = 'fakeboundary'
+        parts = []
+        for start, end in ranges:
+            parts.append('--%s\r\nContent-Type: application/octet-stream\r\n'
+                         'Content-Range: bytes %d-%d/%d\r\n\r\n%s\r\n'
+                         % (boundary, start, end, len(data), data[start:end + 1]))
+        parts.append('--%s--\r\n' % boundary)
+        self._reply(206, ''.join(parts),
+                    {'Content-Type': 'multipart/byteranges; boundary=%s' % boundary})
+
+    do_HEAD = do_GET
+
+
+class FakeTracker(object):
+    """
+    A tracker speaking the mogilefsd line protocol, keeping its namespace
+    in memory and placing files on the given FakeStorage nodes.
+    """
+    def __init__(self, storages, host='127.0.0.1', port=0, faults=None, replicas=2):
+        self.storages = storages
+        self.faults = faults or Faults()
+        self.replicas = replicas
+        self.domains = {}
+        self.files = {}
+        self.fsck_log = []
+        self.settings = {'schema_version': '15'}
+        self.commands = []
+        # when set, list_fids answers like mogilefsd: at most this many
+        # fids above 'from', 'to' being a count rather than a fid
+        self.list_fids_limit = None
+        # when set, the connection is closed instead of answering once
+        # this many more commands have been answered
+        self.drop_after = None
+        self._open = {}
+        self._fid = 0
+        self._lock = threading.Lock()
+        # devid => device row as reported by get_devices, two per host
+        self.devices = {}
+        for hostid, storage in enumerate(storages):
+            for n in (1, 2):
+                devid = len(self.devices) + 1
+                self.devices[devid] = {'storage': storage, 'hostid': hostid + 1,
+                                       'status': 'alive', 'observed_state': 'writeable',
+                                       'utilization': '%.1f' % (devid * 3.0),
+                                       'weight': 100, 'mb_total': 1000, 'mb_used': 10 * devid}
+        tracker = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                while 1:
+                    line = self.rfile.readline()
+                    if not line:
+                        break
+                    if tracker.drop_after is not None:
+                        if tracker.drop_after <= 0:
+                            tracker.drop_after = None
+                            break
+                        tracker.drop_after -= 1
+                    self.wfile.write(tracker.handle_line(line))
+        self._server = _Server((host, port), Handler)
+        self.host, self.port = self._server.server_address
+        self.address = '%s:%d' % (self.host, self.port)
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle_line(self, line):
+        cmd, _, arg = line.strip().partition(' ')
+        self.commands.append(cmd)
+        if self.faults.apply():
+            return 'ERR injected_failure injected+failure\r\n'
+        handler = getattr(self, 'cmd_' + cmd, None)
+        if handler is None:
+            return 'ERR unknown_command Unknown+server+command\r\n'
+        self._lock.acquire()
+        try:
+            try:
+                res = handler(_decode(arg))
+            except TrackerError, e:
+                return 'ERR %s %s\r\n' % (e.args[0], urllib.quote_plus(e.args[1]))
+        finally:
+            self._lock.release()
+        return 'OK %s\r\n' % _encode(res or {})
+
+    def _path(self, devid, fid):
+        storage = self.devices[devid]['storage']
+        fid = '%010d' % fid
+        return storage.url('/dev%d/%s/%s/%s/%s.fid' % (devid, fid[0], fid[1:4], fid[4:7], fid))
+
+    def _writable(self):
+        return [devid for devid, dev in sorted(self.devices.items())
+                if dev['status'] == 'alive']
+
+    # namespace
+    def cmd_create_domain(self, args):
+        if args['domain'] in self.domains:
+            raise TrackerError('domain_exists', 'That domain already exists')
+        self.domains[args['domain']] = {}
+        return {'domain': args['domain']}
+
+    def cmd_delete_domain(self, args):
+        if args['domain'] not in self.domains:
+            raise TrackerError('domain_not_found', 'Domain not found')
+        del self.domains[args['domain']]
+        return {'domain': args['domain']}
+
+    def cmd_create_class(self, args):
+        classes = self.domains.setdefault(args['domain'], {})
+        if args['class'] in classes:
+            raise TrackerError('class_exists', 'That class already exists')
+        classes[args['class']] = int(args['mindevcount'])
+        return {'class': args['class'], 'domain': args['domain']}
+
+    def cmd_get_domains(self, args):
+        res = {'domains': len(self.domains)}
+        for x, (domain, classes) in enumerate(sorted(self.domains.items())):
+            res['domain%d' % (x + 1)] = domain
+            res['domain%dclasses' % (x + 1)] = len(classes)
+            for y, (cls, mindevcount) in enumerate(sorted(classes.items())):
+                res['domain%dclass%dname' % (x + 1, y + 1)] = cls
+                res['domain%dclass%dmindevcount' % (x + 1, y + 1)] = mindevcount
+        return res
+
+    def _check_domain(self, args):
+        if args.get('domain') not in self.domains:
+            raise TrackerError('unreg_domain', 'Domain name invalid/not found')
+
+    def cmd_create_open(self, args):
+        self._check_domain(args)
+        cls = args.get('class')
+        if cls and cls not in self.domains[args['domain']]:
+            raise TrackerError('unreg_class', 'Invalid class')
+        self._fid += 1
+        fid = self._fid
+        devids = self._writable()
+        random.shuffle(devids)
+        devids = devids[:3]
+        self._open[fid] = args
+        res = {'fid': fid, 'dev_count': len(devids)}
+        for x, devid in enumerate(devids):
+            res['devid_%d' % (x + 1)] = devid
+            res['path_%d' % (x + 1)] = self._path(devid, fid)
+        return res
+
+    def cmd_create_close(self, args):
+        fid = int(args['fid'])
+        opened = self._open.pop(fid, None)
+        if opened is None:
+            raise TrackerError('no_temp_file', 'No tempfile or file already closed')
+        devid = int(args['devid'])
+        storage = self.devices[devid]['storage']
+        path = args['path'].split(storage.netloc, 1)[-1]
+        size = int(args['size'])
+        if len(storage.files.get(path, '')) != size:
+            raise TrackerError('size_mismatch', 'Expected: %d; actual: %d' % (size, len(storage.files.get(path, ''))))
+        # "replicate" to other devices on other hosts right away
+        devids = [devid]
+        used = [storage]
+        for other in self._writable():
+            if len(devids) >= self.replicas:
+                break
+            dev = self.devices[other]
+            if dev['storage'] not in used:
+                dev['storage'].files[self._path(other, fid).split(dev['storage'].netloc, 1)[-1]] = storage.files[path]
+                devids.append(other)
+                used.append(dev['storage'])
+        self.files[(opened['domain'], opened['key'])] = {
+            'fid': fid, 'devids': devids, 'length': size,
+            'class': opened.get('class') or 'default', 'checksum': args.get('checksum')}
+        return {}
+
+    def _lookup(self, args):
+        self._check_domain(args)
+        try:
+            return self.files[(args['domain'], args['key'])]
+        except KeyError:
+            raise TrackerError('unknown_key', 'unknown_key')
+
+    def cmd_get_paths(self, args):
+        info = self._lookup(args)
+        res = {'paths': len(info['devids'])}
+        for x, devid in enumerate(info['devids']):
+            res['path%d' % (x + 1)] = self._path(devid, info['fid'])
+        return res
+
+    def cmd_file_info(self, args):
+        info = self._lookup(args)
+        return {'fid': info['fid'], 'length': info['length'], 'class': info['class'],
+                'devcount': len(info['devids']), 'domain': args['domain'], 'key': args['key']}
+
+    def cmd_delete(self, args):
+        info = self._lookup(args)
+        del self.files[(args['domain'], args['key'])]
+        return {}
+
+    def cmd_rename(self, args):
+        self._check_domain(args)
+        src = (args['domain'], args['from_key'])
+        dst = (args['domain'], args['to_key'])
+        if src not in self.files:
+            raise TrackerError('unknown_key', 'unknown_key')
+        if dst in self.files:
+            raise TrackerError('key_exists', 'Target key name already exists; can\'t overwrite.')
+        self.files[dst] = self.files.pop(src)
+        return {}
+
+    def cmd_list_keys(self, args):
+        self._check_domain(args)
+        prefix = args.get('prefix', '')
+        after = args.get('after', '')
+        limit = int(args.get('limit') or 1000)
+        keys = sorted(k for d, k in self.files if d == args['domain']
+                      and k.startswith(prefix) and k > after)[:limit]
+        if not keys:
+            raise TrackerError('none_match', 'No keys match')
+        res = {'key_count': len(keys), 'next_after': keys[-1]}
+        for x, key in enumerate(keys):
+            res['key_%d' % (x + 1)] = key
+        return res
+
+    def cmd_list_fids(self, args):
+        start, end = int(args['from']), int(args['to'])
+        if self.list_fids_limit is None:
+            rows = sorted((info['fid'], domain, key, info)
+                          for (domain, key), info in self.files.items()
+                          if start <= info['fid'] <= end)
+        else:
+            rows = sorted((info['fid'], domain, key, info)
+                          for (domain, key), info in self.files.items()
+                          if info['fid'] > start)
+            rows = rows[:min(end or 100, self.list_fids_limit)]
+        res = {'fid_count': len(rows)}
+        for x, (fid, domain, key, info) in enumerate(rows):
+            x += 1
+            res['fid_%d_fid' % x] = fid
+            res['fid_%d_domain' % x] = domain
+            res['fid_%d_key' % x] = key
+            res['fid_%d_length' % x] = info['length']
+            res['fid_%d_class' % x] = info['class']
+            res['fid_%d_devcount' % x] = len(info['devids'])
+        return res
+
+    def cmd_sleep(self, args):
+        return {}
+
+    # cluster administration
+    def cmd_get_hosts(self, args):
+        res = {'hosts': len(self.storages)}
+        for x, storage in enumerate(self.storages):
+            x += 1
+            res['host%d_hostid' % x] = x
+            res['host%d_hostname' % x] = 'host%d' % x
+            res['host%d_hostip' % x] = storage.host
+            res['host%d_http_port' % x] = storage.port
+            res['host%d_status' % x] = 'alive'
+        return res
+
+    def cmd_get_devices(self, args):
+        devids = sorted(self.devices)
+        if args.get('devid'):
+            devids = [int(args['devid'])]
+        res = {'devices': len(devids)}
+        for x, devid in enumerate(devids):
+            dev = self.devices[devid]
+            x += 1
+            res['dev%d_devid' % x] = devid
+            for k in ('hostid', 'status', 'observed_state', 'utilization',
+                      'weight', 'mb_total', 'mb_used'):
+                res['dev%d_%s' % (x, k)] = dev[k]
+        return res
+
+    def _device(self, args):
+        try:
+            return self.devices[int(args['device'])]
+        except (KeyError, ValueError):
+            raise TrackerError('device_not_found', 'Device not found')
+
+    def cmd_set_state(self, args):
+        self._device(args)['status'] = args['state']
+        return {}
+
+    def cmd_set_weight(self, args):
+        self._device(args)['weight'] = int(args['weight'])
+        return {}
+
+    def cmd_update_host(self, args):
+        return {'hostid': 1, 'hostname': args['host']}
+
+    def cmd_stats(self, args):
+        res = {'devicescount': len(self.devices), 'fidmax': self._fid}
+        for x, devid in enumerate(sorted(self.devices)):
+            dev = self.devices[devid]
+            res['devices%did' % (x + 1)] = devid
+            res['devices%dhost' % (x + 1)] = 'host%d' % dev['hostid']
+            res['devices%dstatus' % (x + 1)] = dev['status']
+            res['devices%dfiles' % (x + 1)] = sum(1 for f in self.files.values() if devid in f['devids'])
+        return res
+
+    def cmd_fsck_status(self, args):
+        return {'running': '0', 'host': '', 'max_logid': len(self.fsck_log)}
+
+    def cmd_fsck_getlog(self, args):
+        after = int(args.get('after_logid') or 0)
+        rows = [row for row in self.fsck_log if row['logid'] > after][:100]
+        res = {'row_count': len(rows)}
+        for x, row in enumerate(rows):
+            for k, v in row.items():
+                res['row_%d_%s' % (x + 1, k)] = v
+        return res
+
+    def cmd_server_settings(self, args):
+        res = {'key_count': len(self.settings)}
+        for x, (k, v) in enumerate(sorted(self.settings.items())):
+            res['key_%d' % (x + 1)] = k
+            res['value_%d' % (x + 1)] = v
+        return res
+
+
+class TrackerError(Exception):
+    pass
+
+
+class Cluster(object):
+    """
+    A fake tracker with `nodes` storage nodes, started and stopped
+    together.
+    """
+    def __init__(self, nodes=2, tracker_faults=None, storage_faults=None, replicas=2):
+        self.storages = [FakeStorage(faults=storage_faults) for x in xrange(nodes)]
+        self.tracker = FakeTracker(self.storages, faults=tracker_faults, replicas=replicas)
+        self.hosts = [self.tracker.address]
+
+    def start(self):
+        for storage in self.storages:
+            storage.start()
+        self.tracker.start()
+        return self
+
+    def stop(self):
+        self.tracker.stop()
+        for storage in self.storages:
+            storage.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,30 +1,150 @@
 # -*- coding: utf-8 -*-
+import re
+import time
 import logging
+import threading
+from Queue import Queue, Full
+from collections import namedtuple
 
 from mogilefs.exceptions import MogileFSTrackerError
 from mogilefs.backend import Backend
 
 logger = logging
 
+FidInfo = namedtuple('FidInfo', 'fid domain key cls length devcount')
+FsckLogRow = namedtuple('FsckLogRow', 'logid utime fid evcode devid')
+
+_FID_FIELD_RE   = re.compile(r'^fid_(\d+)_(\w+)$')
+_STATS_FIELD_RE = re.compile(r'^(replication|files|devices)(\d+)(\w+)$')
+
 def _complain_ifreadonly(readonly):
     if readonly:
         raise ValueError('the operation is not allowed')
 
+def _parse_hosts(res):
+    ret = []
+    for x in xrange(1, int(res['hosts'])+1):
+        host = {}
+        for k in ('hostname', 'hostip', 'status', 'altip', 'altmask'):
+            host[k] = res.get('host%d_%s' % (x, k))
+
+        for k in ('hostid', 'http_port', 'http_get_port'):
+            value = res.get('host%d_%s' % (x, k))
+            if value:
+                host[k] = int(value)
+            else:
+                host[k] = None
+        ret.append(host)
+    return ret
+
+def _parse_devices(res):
+    ret = []
+    for x in xrange(1, int(res['devices'])+1):
+        device = {}
+        for k in ('devid', 'hostid', 'status', 'observed_state', 'utilization'):
+            device[k] = res.get('dev%d_%s' % (x, k))
+
+        for k in ('mb_total', 'mb_used', 'weight'):
+            value = res.get('dev%d_%s' % (x, k))
+            if value:
+                device[k] = int(value)
+            else:
+                device[k] = None
+        ret.append(device)
+    return ret
+
+def _fid_rows(pairs):
+    # fid_N_field pairs of a list_fids response as dicts, in order of N
+    rows = {}
+    for name, value in pairs:
+        matcher = _FID_FIELD_RE.match(name)
+        if matcher is not None:
+            rows.setdefault(int(matcher.group(1)), {})[matcher.group(2)] = value
+    return [rows[x] for x in sorted(rows)]
+
+def _walk_fids(backend, start, end, batch, target_time, min_batch, max_batch):
+    # mogilefsd answers list_fids with a capped number of fids above
+    # 'from'; other trackers give the inclusive range.  Asking from the
+    # fid before the cursor and dropping what's outside the window works
+    # for both.  An answer which stops short of the window's end may have
+    # been cut off, so the window is carried on from its last fid until
+    # an answer comes back without any.
+    cursor = start
+    while cursor <= end:
+        upper = min(cursor + batch - 1, end)
+        t = time.time()
+        rows = _fid_rows(backend.do_request_iter('list_fids', { 'from': cursor - 1,
+                                                                'to'  : upper,
+                                                                }))
+        elapsed = time.time() - t
+
+        last = None
+        for row in rows:
+            fid = int(row['fid'])
+            last = max(last, fid)
+            if fid < cursor or fid > upper:
+                continue
+            yield FidInfo(fid,
+                          row.get('domain'),
+                          row.get('key'),
+                          row.get('class'),
+                          int(row.get('length') or 0),
+                          int(row.get('devcount') or 0))
+
+        if cursor <= last < upper:
+            cursor = last + 1
+        else:
+            cursor = upper + 1
+
+        # aim for target_time per call, changing the batch at most twofold
+        if elapsed > 0:
+            factor = min(max(target_time / elapsed, 0.5), 2.0)
+        else:
+            factor = 2.0
+        batch = int(min(max(batch * factor, min_batch), max_batch))
+
+def _int_or_none(value):
+    if value:
+        return int(value)
+    return None
+
+class FsckTally(object):
+    """
+    Counts of fsck log rows per evcode and per devid, for passing to
+    Admin.follow_fsck_log.
+    """
+    def __init__(self):
+        self.total   = 0
+        self.evcodes = {}
+        self.devids  = {}
+
+    def add(self, row):
+        self.total += 1
+        self.evcodes[row.evcode] = self.evcodes.get(row.evcode, 0) + 1
+        if row.devid is not None:
+            self.devids[row.devid] = self.devids.get(row.devid, 0) + 1
+
 class Admin(object):
     def __init__(self, hosts, backend=None, readonly=False, timeout=None, hooks=None):
         self.readonly = bool(readonly)
         self.backend = Backend(hosts, timeout)
         self._hosts = hosts
+        self._timeout = timeout
 
     def replicate_row(self):
         self.backend.do_request("replicate_row")
 
     def get_hosts(self, hostid=None):
+        """
+        get a list of the hosts, each a dict with keys: hostid, hostname,
+        hostip, http_port, http_get_port, status, altip, altmask
+        """
         if hostid:
             params = { 'hostid': hostid }
         else:
             params = None
         res = self.backend.do_request("get_hosts", params)
+        return _parse_hosts(res)
 
     def get_devices(self, devid=None):
         if devid:
@@ -32,20 +152,7 @@ class Admin(object):
         else:
             params = None
         res = self.backend.do_request("get_devices", params)
-        ret = []
-        for x in xrange(1, int(res['devices'])+1):
-            device = {}
-            for k in ('devid', 'hostid', 'status', 'observed_state', 'utilization'):
-                device[k] = res.get('dev%d_%s' % (x, k))
-
-            for k in ('mb_total', 'mb_used', 'weight'):
-                value = res.get('dev%d_%s' % (x, k))
-                if value:
-                    device[k] = int(value)
-                else:
-                    device[k] = None
-            ret.append(device)
-        return ret
+        return _parse_devices(res)
 
     def list_fids(self, fromfid, tofid):
         """
@@ -54,51 +161,131 @@ class Admin(object):
         returns:
            { fid => { dict with keys: domain, class, devcount, length, key } }
         """
-        res = self.backend.do_request('list_fids',
-                                      { 'from': fromfid,
-                                        'to'  : tofid,
-                                        })
+        pairs = self.backend.do_request_iter('list_fids',
+                                             { 'from': fromfid,
+                                               'to'  : tofid,
+                                               })
         ret = {}
-        for x in xrange(1, int(res['fid_count'])+1):
-            key = 'fid_%d_fid' % x
-            ret[key] = dict([(k, res['fid_%d_%s' % (x, k)]) for k in ('key', 'length', 'class', 'domain', 'devcount')])
+        for row in _fid_rows(pairs):
+            ret[int(row['fid'])] = dict([(k, row.get(k)) for k in ('key', 'length', 'class', 'domain', 'devcount')])
         return ret
 
+    def iter_fids(self, start, end=None, batch=1000, target_time=0.5,
+                  min_batch=100, max_batch=100000, parallel=1):
+        """
+        Walk the fids from start to end (inclusive, the highest fid the
+        tracker knows of if None), yielding a FidInfo per fid.
+
+        The range asked for in each list_fids call grows or shrinks so a
+        call takes about target_time seconds.  With parallel > 1 the
+        range is cut into that many pieces walked at once, each over its
+        own tracker connection; fids are then not yielded in order.
+        """
+        if end is None:
+            res = self.backend.do_request('stats', { 'all': 1 })
+            end = int(res.get('fidmax') or 0)
+        if end < start:
+            return
+
+        if parallel <= 1:
+            for info in _walk_fids(self.backend, start, end, batch, target_time,
+                                   min_batch, max_batch):
+                yield info
+            return
+
+        span = (end - start + parallel) // parallel
+        ranges = []
+        for lo in xrange(start, end + 1, span):
+            ranges.append((lo, min(lo + span - 1, end)))
+
+        queue = Queue(maxsize=max_batch)
+        stopped = threading.Event()
+        workers = []
+        for lo, hi in ranges:
+            worker = threading.Thread(target=self._fid_worker,
+                                      args=(queue, stopped, lo, hi, batch, target_time,
+                                            min_batch, max_batch),
+                                      name='mogilefs-fids-%d' % lo)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+
+        running = len(workers)
+        try:
+            while running:
+                item = queue.get()
+                if item is None:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stopped.set()
+
+    def _fid_worker(self, queue, stopped, lo, hi, batch, target_time, min_batch, max_batch):
+        def put(item):
+            while not stopped.isSet():
+                try:
+                    queue.put(item, True, 0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        backend = Backend(self._hosts, self._timeout)
+        try:
+            for info in _walk_fids(backend, lo, hi, batch, target_time, min_batch, max_batch):
+                if not put(info):
+                    return
+        except Exception, e:
+            put(e)
+        put(None)
+
     def clear_cache(self, fromfid, tofid):
         params = {}
         res = self.backend.do_request('clear_cache', params)
 
     def get_stats(self):
         params = { 'all': 1 }
-        res = self.backend.do_request('stats', params)
+        # group the numbered fields by section and number as they are read
+        sections = { 'replication': {}, 'files': {}, 'devices': {} }
+        res = {}
+        for name, value in self.backend.do_request_iter('stats', params):
+            matcher = _STATS_FIELD_RE.match(name)
+            if matcher is None:
+                res[name] = value
+                continue
+            section, x, field = matcher.groups()
+            sections[section].setdefault(int(x), {})[field] = value
 
         ret = {}
         # get replication statistics
         if 'replicationcount' in res:
             replication = ret.setdefault('replication', {})
-            for x in xrange(1, int(res['replicationcount'])+1):
-                domain = res.get('replication%ddomain' % x, '')
-                cls = res.get('replication%dclass' % x, '')
-                devcount = res.get('replication%ddevcount' % x, '')
-                fields = res.get('replication%dfields' % x)
+            for row in sections['replication'].values():
+                domain = row.get('domain', '')
+                cls = row.get('class', '')
+                devcount = row.get('devcount', '')
+                fields = row.get('fields')
                 (replication.setdefault(domain, {}).setdefault(cls, {}))[devcount] = fields
 
         # get file statistics
         if 'filescount' in res:
             files = ret.setdefault('files', {})
-            for x in xrange(1, int(res['filescount'])+1):
-                domain = res.get('files%ddomain' % x, '')
-                cls = res.get('files%dclass' % x, '')
-                (files.setdefault(domain, {}))[cls] = res.get('files%dfiles' % x)
+            for row in sections['files'].values():
+                domain = row.get('domain', '')
+                cls = row.get('class', '')
+                (files.setdefault(domain, {}))[cls] = row.get('files')
 
         # get device statistics
         if 'devicescount' in res:
             devices = ret.setdefault('devices', {})
-            for x in xrange(1, int(res['devicescount'])+1):
-                key = res.get('devices%did' % x, '')
-                devices[key] = { 'host'  : res.get('devices%dhost' % x),
-                                 'status': res.get('devices%dstatus' % x),
-                                 'files' : res.get('devices%dfiles' % x),
+            for row in sections['devices'].values():
+                key = row.get('id', '')
+                devices[key] = { 'host'  : row.get('host'),
+                                 'status': row.get('status'),
+                                 'files' : row.get('files'),
                                  }
 
         if 'fidmax' in res:
@@ -238,6 +425,86 @@ class Admin(object):
                                         'weight': weight,
                                         })
 
+    def set_device_states(self, states):
+        """
+        change the state of many devices at once, given { devid: state }.
+        The commands are pipelined over one tracker connection.  Returns
+        { devid: None if it succeeded, else the MogileFSTrackerError }; an
+        error with err None means the connection failed before the answer
+        came, so the change may or may not have been made.
+        """
+        _complain_ifreadonly(self.readonly)
+        return self._update_devices('set_state', 'state', states)
+
+    def set_device_weights(self, weights):
+        """
+        change the weight of many devices at once, given { devid: weight };
+        returns the same as set_device_states
+        """
+        _complain_ifreadonly(self.readonly)
+        for weight in weights.values():
+            if not isinstance(weight, (int, long)):
+                raise ValueError('argument weight muse be an integer')
+        return self._update_devices('set_weight', 'weight', weights)
+
+    def update_hosts(self, hosts):
+        """
+        update many hosts at once, given { hostname: { ip, port, status } }
+        with any of the keys left out.  Returns { hostname: None if it
+        succeeded, else the MogileFSTrackerError }
+        """
+        _complain_ifreadonly(self.readonly)
+        hostnames = []
+        requests = []
+        for host, opts in hosts.items():
+            params = { 'host': host }
+            for k in ('ip', 'port', 'status'):
+                if opts.get(k):
+                    params[k] = opts[k]
+            hostnames.append(host)
+            requests.append(('update_host', params))
+        return self._pipeline_results(hostnames, requests)
+
+    def _device_hostnames(self):
+        devices_res, hosts_res = self.backend.do_pipeline([('get_devices', None),
+                                                           ('get_hosts', None)])
+        for res in (devices_res, hosts_res):
+            if isinstance(res, MogileFSTrackerError):
+                raise res
+        hostnames = dict([(host['hostid'], host['hostname']) for host in _parse_hosts(hosts_res)])
+        ret = {}
+        for device in _parse_devices(devices_res):
+            ret[int(device['devid'])] = hostnames.get(_int_or_none(device['hostid']))
+        return ret
+
+    def _update_devices(self, cmd, name, values):
+        hostnames = self._device_hostnames()
+        ret = {}
+        devids = []
+        requests = []
+        for devid, value in values.items():
+            devid = int(devid)
+            host = hostnames.get(devid)
+            if host is None:
+                ret[devid] = MogileFSTrackerError('No such device', 'no_device')
+                continue
+            devids.append(devid)
+            requests.append((cmd, { 'host'  : host,
+                                    'device': devid,
+                                    name    : value,
+                                    }))
+        ret.update(self._pipeline_results(devids, requests))
+        return ret
+
+    def _pipeline_results(self, keys, requests):
+        ret = {}
+        for key, res in zip(keys, self.backend.do_pipeline(requests)):
+            if isinstance(res, MogileFSTrackerError):
+                ret[key] = res
+            else:
+                ret[key] = None
+        return ret
+
     def slave_list(self):
         keys = self._get_slave_keys()
         ret = {}
@@ -327,7 +594,7 @@ class Admin(object):
 
     def _set_slave_keys(self, keys):
         buf = []
-        for key. weight in keys.items():
+        for key, weight in keys.items():
             try:
                 weight = int(weight)
                 if weight != 1:
@@ -375,6 +642,49 @@ class Admin(object):
             ret.append(rec)
         return ret
 
+    def follow_fsck_log(self, after_logid=None, tally=None, until_done=False,
+                        min_interval=0.5, max_interval=30.0):
+        """
+        Yield fsck log rows as FsckLogRow tuples as they are written,
+        starting after after_logid.  While there is nothing new the wait
+        between polls doubles from min_interval up to max_interval.
+
+        Every row is also added to tally, if given.  With until_done the
+        generator stops once fsck isn't running and the log is drained.
+        """
+        logid = after_logid or 0
+        interval = min_interval
+        done = False
+        while 1:
+            res = self.backend.do_request("fsck_getlog", { 'after_logid': logid })
+            row_count = int(res['row_count'])
+            for x in xrange(1, row_count+1):
+                prefix = "row_%d_" % x
+                row = FsckLogRow(int(res[prefix + "logid"]),
+                                 _int_or_none(res.get(prefix + "utime")),
+                                 _int_or_none(res.get(prefix + "fid")),
+                                 res.get(prefix + "evcode"),
+                                 _int_or_none(res.get(prefix + "devid")))
+                logid = max(logid, row.logid)
+                if tally is not None:
+                    tally.add(row)
+                yield row
+
+            if row_count:
+                interval = min_interval
+                done = False
+                continue
+
+            if until_done:
+                if done:
+                    return
+                # drain rows written before fsck stopped with one more poll
+                if self.fsck_status().get('running') in (None, '', '0'):
+                    done = True
+                    continue
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
     def set_server_settings(self, key, value):
         res = self.backend.do_request("set_server_setting",
                                       { 'key': key,
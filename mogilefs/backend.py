@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import re
 import logging
 import select
@@ -6,9 +7,12 @@ import socket
 import signal
 import random
 import time
+import threading
 import urllib
-from errno import EINPROGRESS, EISCONN
+import weakref
+from errno import EINPROGRESS, EISCONN, EINTR
 
+from mogilefs import metrics
 from mogilefs.exceptions import MogileFSTrackerError
 
 logger = logging.getLogger('mobilefs.backend')
@@ -19,6 +23,52 @@ FLAG_NOSIGNAL = MSG_NOSIGNAL
 
 ERR_RE = re.compile(r'^ERR\s+(\w+)\s*(\S*)')
 OK_RE  = re.compile(r'^OK\s+\d*\s*(\S*)')
+# what precedes the arguments, not running into the line end
+OK_PREFIX_RE = re.compile(r'OK[ \t]*\d*[ \t]*')
+
+RECV_SIZE = 65536
+
+# '&' and '=' inside names or values
+_SEPARATOR_ESCAPES_RE = re.compile(r'%(?:26|3[dD])')
+
+_sigpipe_ignored = False
+
+def _ignore_sigpipe():
+    # Only needed once per process, and only possible from the main
+    # thread; send() is passed MSG_NOSIGNAL anyway.
+    global _sigpipe_ignored
+    _sigpipe_ignored = True
+    if FLAG_NOSIGNAL:
+        try:
+            signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+        except (ValueError, AttributeError):
+            pass
+
+if hasattr(select, 'poll'):
+    _POLLIN  = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP
+    _POLLOUT = select.POLLOUT | select.POLLERR | select.POLLHUP
+
+    def _wait_for_fd(fileno, timeout, write=False):
+        # poll() rather than select(), which can't handle fds >= 1024
+        poller = select.poll()
+        poller.register(fileno, write and _POLLOUT or _POLLIN)
+        deadline = time.time() + timeout
+        while 1:
+            try:
+                return bool(poller.poll(max(deadline - time.time(), 0) * 1000))
+            except select.error, e:
+                if e.args[0] != EINTR:
+                    raise
+else:
+    def _wait_for_fd(fileno, timeout, write=False):
+        while 1:
+            try:
+                if write:
+                    return bool(select.select([], [fileno], [], timeout)[1])
+                return bool(select.select([fileno], [], [], timeout)[0])
+            except select.error, e:
+                if e.args[0] != EINTR:
+                    raise
 
 def _encode_url_string(args):
     if not args:
@@ -30,11 +80,89 @@ def _encode_url_string(args):
                               urllib.quote_plus(str(v))))
     return '&'.join(buf)
 
+# objects with an _after_fork() method, reset in the child process by the
+# handler installed with register_fork_handlers()
+_fork_aware = weakref.WeakKeyDictionary()
+_fork_handlers_registered = False
+
+def _register_fork_aware(obj):
+    _fork_aware[obj] = True
+
+def _run_after_fork():
+    for obj in list(_fork_aware.keys()):
+        obj._after_fork()
+
+def register_fork_handlers():
+    """
+    Install an os.register_at_fork() handler which drops the tracker and
+    storage node connections inherited by a forked child at once, instead
+    of on the child's first request.  Returns False if the interpreter
+    doesn't support fork hooks; the per-request PID check still applies
+    in that case.
+    """
+    global _fork_handlers_registered
+    if _fork_handlers_registered:
+        return True
+
+    register_at_fork = getattr(os, 'register_at_fork', None)
+    if register_at_fork is None:
+        return False
+
+    register_at_fork(after_in_child=_run_after_fork)
+    _fork_handlers_registered = True
+    return True
+
+def _decode_pairs(arg):
+    # the (name, value) pairs in order, leaving out blank values like
+    # _decode_url_string but keeping repeated names
+    ret = []
+    unquote = urllib.unquote
+    if '%' in arg and not _SEPARATOR_ESCAPES_RE.search(arg):
+        for pair in unquote(arg.replace('+', ' ')).split('&'):
+            k, sep, v = pair.partition('=')
+            if v:
+                ret.append((k, v))
+        return ret
+
+    for pair in arg.split('&'):
+        k, sep, v = pair.partition('=')
+        if not v:
+            continue
+        if '%' in k or '+' in k:
+            k = unquote(k.replace('+', ' '))
+        if '%' in v:
+            v = unquote(v.replace('+', ' '))
+        elif '+' in v:
+            v = v.replace('+', ' ')
+        ret.append((k, v))
+    return ret
+
 def _decode_url_string(arg):
-    from cgi import parse_qs
+    # same result as cgi.parse_qs() keeping the first value: blank values
+    # are left out
     params = {}
-    for k, values in parse_qs(arg).items():
-        params[k] = values[0]
+    unquote = urllib.unquote
+    if '%' in arg and not _SEPARATOR_ESCAPES_RE.search(arg):
+        # no escaped separators: unquote the whole line in one go
+        for pair in unquote(arg.replace('+', ' ')).split('&'):
+            k, sep, v = pair.partition('=')
+            if v and k not in params:
+                params[k] = v
+        return params
+
+    for pair in arg.split('&'):
+        k, sep, v = pair.partition('=')
+        if not v:
+            continue
+        # most names and many values don't need unquoting at all
+        if '%' in k or '+' in k:
+            k = unquote(k.replace('+', ' '))
+        if k not in params:
+            if '%' in v:
+                v = unquote(v.replace('+', ' '))
+            elif '+' in v:
+                v = v.replace('+', ' ')
+            params[k] = v
     return params
 
 class Backend(object):
@@ -65,6 +193,65 @@ class Backend(object):
 
         self._host_dead = {}
         self._pref_ip = {}
+        # read-ahead of the cached socket
+        self._rbuf = ''
+
+        self._pid  = os.getpid()
+        self._lock = threading.RLock()
+        _register_fork_aware(self)
+
+        self.metrics = metrics.registry
+
+    def _after_fork(self):
+        # The cached socket belongs to the parent process; sending on it
+        # from here would interleave our responses with the parent's.
+        # Closing our copy of the descriptor leaves the parent's intact.
+        sock = self._sock_cache
+        self._sock_cache = None
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        self._rbuf = ''
+        self._lock = threading.RLock()
+        self._pid  = os.getpid()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            logger.debug("pid changed from %d, discarding inherited tracker socket" % self._pid)
+            self._after_fork()
+
+    def _drop_sock(self):
+        sock = self._sock_cache
+        self._sock_cache = None
+        self._rbuf = ''
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+    def get_last_tracker(self):
+        return self.last_host_connected
+
+    def warmup(self):
+        """
+        Connect to a tracker ahead of the first request, e.g. right after
+        a prefork server has started its workers.  Returns the (ip, port)
+        of the tracker connected to.
+        """
+        self._check_pid()
+        self._lock.acquire()
+        try:
+            if self._sock_cache is None:
+                sock = self._get_sock()
+                if sock is None:
+                    raise MogileFSTrackerError("couldn't connect to any mogilefs backends: %s" % self._hosts)
+                self._sock_cache = sock
+            return self.last_host_connected
+        finally:
+            self._lock.release()
 
     def set_pref_ip(self, pref_ip):
         if not isinstance(pref_ip, dict):
@@ -77,80 +264,366 @@ class Backend(object):
     def _wait_for_readability(self, fileno, timeout):
         if not fileno or not timeout:
             return 0
-        return not not (select.select([fileno], [], [], timeout)[0])
+        return _wait_for_fd(fileno, timeout)
+
+    def _readline(self, sock):
+        """
+        Reads a response line, keeping whatever arrives after it for the
+        next one.  Returns None if the tracker doesn't send anything for
+        the timeout, and what was read so far if it closes the connection.
+        """
+        chunks = []
+        buf = self._rbuf
+        while 1:
+            idx = buf.find('\n')
+            if idx >= 0:
+                self._rbuf = buf[idx+1:]
+                chunks.append(buf[:idx+1])
+                return ''.join(chunks)
+            chunks.append(buf)
+
+            if self._timeout and not self._wait_for_readability(sock.fileno(), self._timeout):
+                self._rbuf = ''
+                return None
+            buf = sock.recv(RECV_SIZE)
+            if not buf:
+                self._rbuf = ''
+                return ''.join(chunks)
 
     def do_request(self, cmd, args=None):
+        self._check_pid()
+        self._lock.acquire()
+        try:
+            if self.metrics is None:
+                return self._do_request(cmd, args)
+            return self._timed_request(cmd, args)
+        finally:
+            self._lock.release()
+
+    def _timed_request(self, cmd, args):
+        registry = self.metrics
+        start = time.time()
+        try:
+            return self._do_request(cmd, args)
+        except MogileFSTrackerError, e:
+            registry.inc(metrics.TRACKER_ERRORS, (cmd, e.err or 'transport'))
+            raise
+        finally:
+            host = self.last_host_connected
+            registry.observe(metrics.TRACKER_REQUEST_SECONDS,
+                             (cmd, host and '%s:%s' % host or ''), time.time() - start)
+
+    def _do_request(self, cmd, args):
         req = '%s %s\r\n' % (cmd, _encode_url_string(args))
-        reqlen = len(req)
+        debug = logger.isEnabledFor(logging.DEBUG)
 
-        if FLAG_NOSIGNAL:
-            try :
-                signal.signal(signal.SIGPIPE, signal.SIG_IGN)
-            except:
-                pass
+        if not _sigpipe_ignored:
+            _ignore_sigpipe()
 
-        rv   = 0
-        sock = self._sock_cache
+        sock, cached = self._send_request(cmd, req, debug)
+
+        ## wait up to 3 seconds for the socket to come to life
+        try:
+            line = self._readline(sock)
+        except socket.error, e:
+            self._drop_sock()
+            line = ''
+        if line is None:
+            self._drop_sock()
+            self.run_hook('do_request_read_timeout', cmd, self.last_host_connected)
+            raise MogileFSTrackerError("tracker socket never became readable (%s) when sending command: [%s]" % (self.last_host_connected, req))
+
+        if not line:
+            self._drop_sock()
+            if cached:
+                # the tracker closed our idle connection, start over on a
+                # fresh one
+                return self._do_request(cmd, args)
+
+        self.run_hook('do_request_finished', cmd, self.last_host_connected)
+        return self._parse_response(line, req, debug)
+
+    def do_request_iter(self, cmd, args=None):
+        """
+        Like do_request, but yields the (name, value) pairs of the response
+        as they are read off the socket rather than returning a dict, so a
+        large response is never held in memory whole.  Blank values are
+        left out as by do_request; repeated names are not merged.
+
+        The tracker connection is reserved until the iterator has been
+        exhausted or closed; closing it early discards the connection.
+        """
+        self._check_pid()
+        self._lock.acquire()
+        try:
+            for pair in self._stream_request(cmd, args):
+                yield pair
+        finally:
+            self._lock.release()
+
+    def _read_chunk(self, sock):
+        """
+        Whatever has arrived, '' if the tracker closed the connection or
+        None if nothing came for the timeout.
+        """
+        buf = self._rbuf
+        if buf:
+            self._rbuf = ''
+            return buf
+        if self._timeout and not self._wait_for_readability(sock.fileno(), self._timeout):
+            return None
+        try:
+            return sock.recv(RECV_SIZE)
+        except socket.error:
+            return ''
+
+    def _stream_request(self, cmd, args):
+        req   = '%s %s\r\n' % (cmd, _encode_url_string(args))
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        if not _sigpipe_ignored:
+            _ignore_sigpipe()
+
+        start = time.time()
+        sock, cached = self._send_request(cmd, req, debug)
+        complete = False
+        try:
+            # enough to tell OK from ERR and skip what precedes the arguments
+            buf = ''
+            while '\n' not in buf and len(buf) < 64:
+                data = self._read_chunk(sock)
+                if data is None:
+                    raise MogileFSTrackerError("tracker socket never became readable (%s) when sending command: [%s]" % (self.last_host_connected, req))
+                if not data:
+                    if cached and not buf:
+                        # the tracker closed our idle connection, start
+                        # over on a fresh one
+                        self._drop_sock()
+                        for pair in self._stream_request(cmd, args):
+                            yield pair
+                        complete = True
+                        return
+                    raise MogileFSTrackerError("tracker %s closed the connection when sending command: [%s]" % (self.last_host_connected, req))
+                buf += data
+
+            if not buf.startswith('OK') or buf[2:3] not in ' \t\r\n':
+                # errors are short, handle them as do_request does
+                idx = buf.find('\n')
+                while idx < 0:
+                    data = self._read_chunk(sock)
+                    if not data:
+                        raise MogileFSTrackerError('invalid response from server: [%s]' % buf)
+                    buf += data
+                    idx = buf.find('\n')
+                self._rbuf = buf[idx+1:]
+                complete = True
+                if self.metrics is not None:
+                    matcher = ERR_RE.match(buf)
+                    self.metrics.inc(metrics.TRACKER_ERRORS, (cmd, matcher and matcher.group(1) or 'transport'))
+                self._parse_response(buf[:idx+1], req, debug)
+
+            buf = buf[OK_PREFIX_RE.match(buf).end():]
+            while 1:
+                idx = buf.find('\n')
+                if idx >= 0:
+                    self._rbuf = buf[idx+1:]
+                    complete = True
+                    for pair in _decode_pairs(buf[:idx].rstrip()):
+                        yield pair
+                    break
+
+                # hand out every pair which has been read completely
+                amp = buf.rfind('&')
+                if amp >= 0:
+                    for pair in _decode_pairs(buf[:amp]):
+                        yield pair
+                    buf = buf[amp+1:]
+
+                data = self._read_chunk(sock)
+                if data is None:
+                    raise MogileFSTrackerError("tracker %s stopped sending the response to: [%s]" % (self.last_host_connected, req))
+                if not data:
+                    raise MogileFSTrackerError("tracker %s closed the connection during the response to: [%s]" % (self.last_host_connected, req))
+                buf += data
+        finally:
+            if not complete:
+                # the rest of the response is still on its way
+                self._drop_sock()
+
+        if self.metrics is not None:
+            host = self.last_host_connected
+            self.metrics.observe(metrics.TRACKER_REQUEST_SECONDS,
+                                 (cmd, host and '%s:%s' % host or ''), time.time() - start)
+
+    def _send_request(self, cmd, req, debug):
+        """
+        Sends req on the cached connection, or a new one if that fails.
+        Returns (sock, cached), cached telling whether an old connection
+        was used, which the tracker may have closed already.
+        """
+        reqlen = len(req)
+        rv     = 0
+        cached = False
+        sock   = self._sock_cache
         if sock:
             self.run_hook('do_request_start', cmd, self.last_host_connected)
-            logger.debug("SOCK: cached = %r, REQ: %r" % (sock, req))
+            if debug:
+                logger.debug("SOCK: cached = %r, REQ: %r" % (sock, req))
 
             # send FLAG_NOSIGNAL
             try:
                 rv = sock.send(req, FLAG_NOSIGNAL)
                 if rv != reqlen:
                     self.run_hook('do_request_length_mismatch', cmd, self.last_host_connected)
+                    self._drop_sock()
                     raise MogileFSTrackerError("send() didn't return expected length (%s, not %s)" % (rv, reqlen))
+                cached = True
             except socket.error, e:
                 self.run_hook('do_request_send_error', cmd, self.last_host_connected)
-                self._sock_cache = None
+                self._drop_sock()
+                rv = 0
 
         if not rv:
             ## may cause an exception
             sock = self._get_sock()
             if sock is None:
                 raise MogileFSTrackerError("couldn't connect to any mogilefs backends: %s" % self._hosts)
+            self._sock_cache = sock
 
             self.run_hook('do_request_start', cmd, self.last_host_connected)
-            logger.debug("SOCK: %r, REQ: %r" % (sock, req))
+            if debug:
+                logger.debug("SOCK: %r, REQ: %r" % (sock, req))
 
             # send FLAG_NOSIGNAL
             try:
                 rv = sock.send(req, FLAG_NOSIGNAL)
             except socket.error, e:
                 self.run_hook('do_request_send_error', cmd, self.last_host_connected)
+                self._drop_sock()
                 raise MogileFSTrackerError("couldn't send command: [%s]. reason: %s" % (req, e))
 
             if rv != reqlen:
                 self.run_hook('do_request_length_mismatch', cmd, self.last_host_connected)
+                self._drop_sock()
                 raise MogileFSTrackerError("send() didn't return expected length (%s, not %s)" % (rv, reqlen))
 
-        ## wait up to 3 seconds for the socket to come to life
-        if not self._wait_for_readability(sock.fileno(), self._timeout):
-            sock.close()
-            self.run_hook('do_request_read_timeout', cmd, self.last_host_connected)
-            raise MogileFSTrackerError("tracker socket never became readable (%s) when sending command: [%s]" % (self.last_host_connected, req))
-
-        sockfile = sock.makefile()
-        line = sockfile.readline()
+        return sock, cached
 
-        self.run_hook('do_request_finished', cmd, self.last_host_connected)
-        logger.debug('RESPONSE: %r' % line)
+    def _parse_response(self, line, req, debug):
+        if debug:
+            logger.debug('RESPONSE: %r' % line)
 
         matcher = OK_RE.match(line)
         if matcher:
             args = _decode_url_string(matcher.group(1))
-            logger.debug("RETURN_VARS: %r" % args)
+            if debug:
+                logger.debug("RETURN_VARS: %r" % args)
             return args
 
         matcher = ERR_RE.match(line)
         if matcher:
             self.lasterr, self.lasterrstr = map(urllib.unquote_plus, matcher.groups())
-            logger.debug("LASTERR: %s %s" % (self.lasterr, self.lasterrstr))
+            if debug:
+                logger.debug("LASTERR: %s %s" % (self.lasterr, self.lasterrstr))
             raise MogileFSTrackerError(self.lasterrstr, self.lasterr)
 
+        self._drop_sock()
         raise MogileFSTrackerError('invalid response from server: [%s]' % line)
 
+    def do_pipeline(self, requests, window=100):
+        """
+        Sends a list of (cmd, args) requests over one tracker connection
+        without waiting for each response in turn, at most `window` at a
+        time.  Returns a list in the same order holding each decoded
+        response, or the MogileFSTrackerError the tracker answered that
+        command with.  Failing to talk to the tracker at all raises as in
+        do_request; if the connection fails partway, the commands left
+        without an answer hold that error instead (with err None), as the
+        tracker may or may not have run them.
+        """
+        requests = list(requests)
+        self._check_pid()
+        self._lock.acquire()
+        try:
+            ret = []
+            error = None
+            for x in xrange(0, len(requests), window):
+                batch = requests[x:x+window]
+                if error is not None:
+                    ret.extend([error] * len(batch))
+                    continue
+                results, error = self._do_pipeline(batch)
+                ret.extend(results)
+            return ret
+        finally:
+            self._lock.release()
+
+    def _do_pipeline(self, requests):
+        # (results, error), error being the failure which cut the results
+        # short, if any
+        reqs  = ['%s %s\r\n' % (cmd, _encode_url_string(args)) for cmd, args in requests]
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        if not _sigpipe_ignored:
+            _ignore_sigpipe()
+
+        sock   = self._sock_cache
+        cached = sock is not None
+        if not cached:
+            sock = self._get_sock()
+            if sock is None:
+                raise MogileFSTrackerError("couldn't connect to any mogilefs backends: %s" % self._hosts)
+            self._sock_cache = sock
+
+        if debug:
+            logger.debug("SOCK: %r, PIPELINE: %d commands" % (sock, len(reqs)))
+        start = time.time()
+        try:
+            sock.sendall(''.join(reqs), FLAG_NOSIGNAL)
+        except socket.error, e:
+            self._drop_sock()
+            if cached:
+                return self._do_pipeline(requests)
+            raise MogileFSTrackerError("couldn't send commands to %s. reason: %s" % (self.last_host_connected, e))
+
+        ret = []
+        for (cmd, args), req in zip(requests, reqs):
+            try:
+                line = self._readline(sock)
+            except socket.error, e:
+                line = ''
+            if line is None:
+                self._drop_sock()
+                return self._cut_short(ret, reqs, "tracker socket never became readable (%s)" % (self.last_host_connected,))
+            if not line:
+                self._drop_sock()
+                if cached and not ret:
+                    # the tracker closed our idle connection before
+                    # reading anything, start over on a fresh one
+                    return self._do_pipeline(requests)
+                return self._cut_short(ret, reqs, "tracker %s closed the connection" % (self.last_host_connected,))
+
+            try:
+                ret.append(self._parse_response(line, req, debug))
+            except MogileFSTrackerError, e:
+                if e.err is None:
+                    # an answer we can't parse, the rest can't be trusted
+                    return self._cut_short(ret, reqs, str(e))
+                if self.metrics is not None:
+                    self.metrics.inc(metrics.TRACKER_ERRORS, (cmd, e.err))
+                ret.append(e)
+
+        if self.metrics is not None:
+            host = self.last_host_connected
+            self.metrics.observe(metrics.TRACKER_REQUEST_SECONDS,
+                                 ('pipeline', host and '%s:%s' % host or ''), time.time() - start)
+        return ret, None
+
+    def _cut_short(self, ret, reqs, reason):
+        error = MogileFSTrackerError("%s after %d of %d pipelined commands" % (reason, len(ret), len(reqs)))
+        logger.debug(str(error))
+        return ret + [error] * (len(reqs) - len(ret)), error
+
     def run_hook(self, hookname, *args):
         pass
 
@@ -200,7 +673,7 @@ class Backend(object):
             connected = True
 
         if err and timeout and err == EINPROGRESS:
-            ret = select.select([], [sock.fileno()], [], timeout)[1]
+            ret = _wait_for_fd(sock.fileno(), timeout, write=True)
             if ret:
                 err = sock.connect_ex(sin)
                 if err == EISCONN:
@@ -230,8 +703,13 @@ class Backend(object):
 
             sock = self._sock_to_host(host)
             if sock:
+                if self.metrics is not None:
+                    self.metrics.inc(metrics.TRACKER_CONNECTS, ('%s:%s' % host,))
                 break
 
+            if self.metrics is not None:
+                self.metrics.inc(metrics.TRACKER_CONNECT_FAILURES, ('%s:%s' % host,))
+
             # mark sock as dead
             logger.debug("marking host dead: %s @ %d" % (host, now))
             self._host_dead[host] = now
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+class NegativeCache(object):
+    """
+    Keys recently found not to exist, remembered for `ttl` seconds so that
+    repeated lookups of a missing key don't each go to the tracker.  At
+    most `max_size` keys are kept; the oldest are dropped first.
+    """
+    def __init__(self, ttl=1.0, max_size=10000):
+        self.ttl      = ttl
+        self.max_size = max_size
+        self.hits     = 0
+        self._keys    = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __contains__(self, key):
+        self._lock.acquire()
+        try:
+            expires = self._keys.get(key)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self._keys[key]
+                return False
+            self.hits += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        self._lock.acquire()
+        try:
+            # re-adding moves the key to the end
+            self._keys.pop(key, None)
+            self._keys[key] = time.time() + self.ttl
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        self._lock.acquire()
+        try:
+            self._keys.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._keys.clear()
+        finally:
+            self._lock.release()
+
+class RecentWrites(object):
+    """
+    Where keys this client has just stored were written to, so that reads
+    right after a write can go to the storage node without asking the
+    tracker.  Entries live for `ttl` seconds; at most `max_size` keys are
+    kept, the oldest are dropped first.
+
+    A key overwritten by another client within `ttl` may still be read at
+    its old path until that is deleted.
+    """
+    def __init__(self, ttl=5.0, max_size=10000):
+        self.ttl      = ttl
+        self.max_size = max_size
+        self.hits     = 0
+        self._paths   = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def get(self, key):
+        """
+        A list of the paths key was written to, or None.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._paths.get(key)
+            if entry is None:
+                return None
+            expires, paths = entry
+            if expires < time.time():
+                del self._paths[key]
+                return None
+            self.hits += 1
+            return list(paths)
+        finally:
+            self._lock.release()
+
+    def add(self, key, paths):
+        self._lock.acquire()
+        try:
+            self._paths.pop(key, None)
+            self._paths[key] = (time.time() + self.ttl, tuple(paths))
+            while len(self._paths) > self.max_size:
+                self._paths.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def move(self, from_key, to_key):
+        """
+        A rename keeps the paths.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._paths.pop(from_key, None)
+            self._paths.pop(to_key, None)
+            if entry is not None:
+                self._paths[to_key] = entry
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        """
+        Returns True if key was known.
+        """
+        self._lock.acquire()
+        try:
+            return self._paths.pop(key, None) is not None
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._paths.clear()
+        finally:
+            self._lock.release()
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done   = threading.Event()
+        self.result = None
+        self.error  = None
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls: while a call for a key is running, others
+    for the same key wait for it and get its result, or its exception,
+    instead of running again.  `shared` counts the calls saved.
+    """
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock  = threading.Lock()
+
+    def do(self, key, func, *args, **kwds):
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = func(*args, **kwds)
+            return call.result
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.done.set()
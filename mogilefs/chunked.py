@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+Large objects stored as fixed size chunks, each a key of its own, and a
+manifest under the object's key listing them.
+
+    fp = ChunkedWriter(client, 'big/object', chunk_size=64 * 1024 * 1024)
+    fp.write(...)
+    fp.close()
+
+    fp = ChunkedReader(client, 'big/object')
+    fp.seek(10 * 1024 ** 3)
+    fp.read(1024 * 1024)
+
+Chunks are uploaded by several workers at once, each its own create_open
+so the tracker spreads them over devices, and a chunk which fails is
+retried on its own.  The manifest is only written once every chunk is
+stored, so readers see the old object or the new one; the chunks of the
+old one are deleted afterwards.  The reader fetches the chunks after the
+one being read in the background, by a few workers per reader.
+"""
+import os
+import time
+import json
+import socket
+import hashlib
+import httplib
+import logging
+import threading
+from Queue import Queue
+
+from mogilefs.exceptions import MogileFSError, MogileFSTrackerError
+
+logger = logging
+
+FORMAT     = 'mogilefs-chunked'
+VERSION    = 1
+CHUNK_SIZE = 16 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+
+def chunk_key(key, upload_id, idx):
+    return '%s.chunk-%s-%06d' % (key, upload_id, idx)
+
+def chunk_keys(key, manifest):
+    return [chunk_key(key, manifest['upload_id'], idx)
+            for idx in xrange(len(manifest['chunks']))]
+
+def read_manifest(client, key):
+    """
+    The manifest of a chunked object, or None if there is no such key.
+    """
+    if not client.get_paths(key):
+        return None
+    try:
+        manifest = json.loads(client.get_file_data(key))
+    except ValueError:
+        raise MogileFSError("%s is not a chunked object" % key)
+    if not isinstance(manifest, dict) or manifest.get('format') != FORMAT:
+        raise MogileFSError("%s is not a chunked object" % key)
+    if manifest.get('version') != VERSION:
+        raise MogileFSError("%s has an unsupported manifest version %r" % (key, manifest.get('version')))
+    manifest['upload_id'] = str(manifest['upload_id'])
+    return manifest
+
+def _delete_keys(client, keys):
+    for key in keys:
+        try:
+            client.delete(key)
+        except MogileFSTrackerError, e:
+            if e.err != 'unknown_key':
+                logger.warning("failed to delete %s: %s" % (key, e))
+        except (MogileFSError, socket.error), e:
+            logger.warning("failed to delete %s: %s" % (key, e))
+
+def delete_chunked(client, key):
+    """
+    Deletes the manifest, then the chunks.
+    """
+    manifest = read_manifest(client, key)
+    if manifest is None:
+        raise MogileFSTrackerError('unknown_key', 'unknown_key')
+    client.delete(key)
+    _delete_keys(client, chunk_keys(key, manifest))
+    return True
+
+class ChunkedWriter(object):
+    """
+    Cuts what is written into chunks and hands them to `workers` upload
+    threads.  At most about 2 * workers chunks are held in memory; write()
+    blocks while the workers catch up.  Each chunk is tried `retries`
+    more times before the upload fails.
+    """
+    def __init__(self, client, key, cls=None, chunk_size=CHUNK_SIZE, workers=4,
+                 retries=2, retry_delay=0.5):
+        self.client      = client
+        self.key         = key
+        self.cls         = cls
+        self.chunk_size  = chunk_size
+        self.retries     = retries
+        self.retry_delay = retry_delay
+        self.upload_id   = '%x%s' % (int(time.time()), os.urandom(4).encode('hex'))
+        self.length      = 0
+        self._pieces   = []
+        self._buffered = 0
+        self._chunks   = []
+        self._error    = None
+        self._closed   = False
+        self._lock     = threading.Lock()
+        self._queue    = Queue(workers)
+        self._threads  = []
+        for x in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _work(self):
+        while 1:
+            job = self._queue.get()
+            if job is None:
+                return
+            if self._error is not None:
+                # the upload has failed already, just drain the queue
+                continue
+            idx, data = job
+            try:
+                self._store(idx, data)
+            except Exception, e:
+                self._lock.acquire()
+                try:
+                    if self._error is None:
+                        self._error = e
+                finally:
+                    self._lock.release()
+
+    def _store(self, idx, data):
+        key = chunk_key(self.key, self.upload_id, idx)
+        attempt = 0
+        while 1:
+            try:
+                self.client.store_content(key, data, self.cls)
+                break
+            except (MogileFSError, socket.error, httplib.HTTPException), e:
+                if attempt >= self.retries:
+                    raise MogileFSError("storing chunk %d of %s failed: %s" % (idx, self.key, e))
+            attempt += 1
+            logger.debug("storing %s failed, retrying: %s" % (key, e))
+            time.sleep(self.retry_delay * attempt)
+        self._chunks[idx] = [len(data), hashlib.md5(data).hexdigest()]
+
+    def _check(self):
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+        if self._error is not None:
+            self.abort()
+            raise self._error
+
+    def _submit(self, data):
+        self._chunks.append(None)
+        self._queue.put((len(self._chunks) - 1, data))
+
+    def write(self, content):
+        self._check()
+        if not content:
+            return
+        self._pieces.append(content)
+        self._buffered += len(content)
+        self.length += len(content)
+        if self._buffered < self.chunk_size:
+            return
+
+        data = ''.join(self._pieces)
+        offset = 0
+        while len(data) - offset >= self.chunk_size:
+            self._submit(data[offset:offset + self.chunk_size])
+            offset += self.chunk_size
+        rest = data[offset:]
+        self._pieces   = rest and [rest] or []
+        self._buffered = len(rest)
+
+    def _finish(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def close(self):
+        """
+        Waits for the chunks, then stores the manifest and deletes the
+        chunks of the object it replaces.  Returns the length.
+        """
+        self._check()
+        if self._buffered:
+            self._submit(''.join(self._pieces))
+            self._pieces, self._buffered = [], 0
+        self._finish()
+        if self._error is not None:
+            self._closed = True
+            self._cleanup()
+            raise self._error
+
+        try:
+            previous = read_manifest(self.client, self.key)
+        except MogileFSError, e:
+            logger.debug("not replacing a chunked object at %s: %s" % (self.key, e))
+            previous = None
+
+        manifest = { 'format'    : FORMAT,
+                     'version'   : VERSION,
+                     'length'    : self.length,
+                     'chunk_size': self.chunk_size,
+                     'upload_id' : self.upload_id,
+                     'chunks'    : self._chunks,
+                     }
+        try:
+            self.client.store_content(self.key, json.dumps(manifest), self.cls)
+        except:
+            self._closed = True
+            self._cleanup()
+            raise
+        self._closed = True
+
+        if previous is not None and previous['upload_id'] != self.upload_id:
+            _delete_keys(self.client, chunk_keys(self.key, previous))
+        return self.length
+
+    def abort(self):
+        """
+        Gives up on the upload and deletes the chunks stored so far.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._error = self._error or MogileFSError("upload of %s aborted" % self.key)
+        self._finish()
+        self._cleanup()
+
+    def _cleanup(self):
+        _delete_keys(self.client, [chunk_key(self.key, self.upload_id, idx)
+                                   for idx, chunk in enumerate(self._chunks)
+                                   if chunk is not None])
+
+def store_chunked(client, key, fp, cls=None, chunk_size=CHUNK_SIZE, **kwds):
+    """
+    Uploads the content of fp as a chunked object; returns the length.
+    """
+    writer = ChunkedWriter(client, key, cls, chunk_size, **kwds)
+    try:
+        while 1:
+            buf = fp.read(chunk_size)
+            if not buf:
+                break
+            writer.write(buf)
+    except:
+        writer.abort()
+        raise
+    return writer.close()
+
+class _Fetch(object):
+    __slots__ = ('done', 'data', 'error', 'cancelled')
+
+    def __init__(self):
+        self.done      = threading.Event()
+        self.data      = None
+        self.error     = None
+        self.cancelled = False
+
+def _download(client, key, length, expected, fetch):
+    fp = client.read_file(key, expected_checksum=expected)
+    try:
+        pieces = []
+        remaining = length
+        while 1:
+            if fetch.cancelled:
+                return
+            if remaining <= BLOCK_SIZE:
+                # reading to the end checks the digest
+                pieces.append(fp.read())
+                break
+            buf = fp.read(BLOCK_SIZE)
+            if not buf:
+                break
+            pieces.append(buf)
+            remaining -= len(buf)
+        fetch.data = ''.join(pieces)
+    finally:
+        fp.close()
+
+def _fetcher(queue):
+    # a function, not a method, so the workers don't keep the reader alive
+    while 1:
+        job = queue.get()
+        if job is None:
+            return
+        client, key, length, expected, fetch = job
+        try:
+            try:
+                if not fetch.cancelled:
+                    _download(client, key, length, expected, fetch)
+                    if not fetch.cancelled and len(fetch.data) != length:
+                        raise MogileFSError("%s is %d bytes, expected %d"
+                                            % (key, len(fetch.data), length))
+            except Exception, e:
+                fetch.error = e
+        finally:
+            fetch.done.set()
+
+class ChunkedReader(object):
+    """
+    A chunked object as one seekable file.  While it is read in order the
+    next `read_ahead` chunks are fetched in the background by read_ahead + 1
+    workers; fetches a seek makes useless are dropped, or stopped at the
+    next block if already running.  Chunks are checked against the MD5
+    digests of the manifest.
+    """
+    # until __init__ is through, for __del__
+    _closed = True
+
+    def __init__(self, client, key, read_ahead=2, verify=True):
+        manifest = read_manifest(client, key)
+        if manifest is None:
+            raise MogileFSTrackerError('unknown_key', 'unknown_key')
+        self.client     = client
+        self.key        = key
+        self.read_ahead = read_ahead
+        self.verify     = verify
+        self.manifest   = manifest
+        self.length     = manifest['length']
+        self.chunk_size = manifest['chunk_size']
+        self._keys    = chunk_keys(key, manifest)
+        self._fetches = {}
+        self._last    = None
+        self._pos     = 0
+        self._closed  = False
+        self._lock    = threading.Lock()
+        self._queue   = Queue()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _fetch(self, idx):
+        # workers are started on the first fetch, an object read from a
+        # single chunk needs no more than one
+        if len(self._threads) < min(self.read_ahead + 1, len(self._keys)):
+            thread = threading.Thread(target=_fetcher, args=(self._queue,))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        fetch = _Fetch()
+        length, digest = self.manifest['chunks'][idx]
+        expected = self.verify and 'MD5:%s' % digest or None
+        self._queue.put((self.client, self._keys[idx], length, expected, fetch))
+        return fetch
+
+    def _chunk(self, idx):
+        self._lock.acquire()
+        try:
+            sequential = self._last is None or idx in (self._last, self._last + 1)
+            self._last = idx
+            wanted = [idx]
+            if sequential:
+                wanted.extend(range(idx + 1, min(idx + 1 + self.read_ahead, len(self._keys))))
+            # only keep what's about to be read
+            for old in self._fetches.keys():
+                if old not in wanted:
+                    self._fetches.pop(old).cancelled = True
+            for x in wanted:
+                if x not in self._fetches:
+                    self._fetches[x] = self._fetch(x)
+            fetch = self._fetches[idx]
+        finally:
+            self._lock.release()
+
+        fetch.done.wait()
+        if fetch.cancelled:
+            raise ValueError("I/O operation on closed file")
+        if fetch.error is not None:
+            # fetch it again next time
+            self._fetches.pop(idx, None)
+            raise fetch.error
+        return fetch.data
+
+    def read(self, n=-1):
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+        if n < 0:
+            end = self.length
+        else:
+            end = min(self._pos + n, self.length)
+
+        pieces = []
+        while self._pos < end:
+            idx = self._pos // self.chunk_size
+            data = self._chunk(idx)
+            start = self._pos - idx * self.chunk_size
+            piece = data[start:start + end - self._pos]
+            if not piece:
+                raise MogileFSError("chunk %d of %s ended early" % (idx, self.key))
+            pieces.append(piece)
+            self._pos += len(piece)
+        return ''.join(pieces)
+
+    def seek(self, pos, mode=0):
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+        if mode == 1:
+            pos += self._pos
+        elif mode == 2:
+            pos += self.length
+        self._pos = max(pos, 0)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        """
+        Stops the fetches still running and the workers.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._lock.acquire()
+        try:
+            for fetch in self._fetches.values():
+                fetch.cancelled = True
+            self._fetches.clear()
+            for thread in self._threads:
+                self._queue.put(None)
+        finally:
+            self._lock.release()
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 import logging
+import urlparse
 
+from mogilefs import metrics
 from mogilefs.backend import Backend
 from mogilefs.exceptions import MogileFSError, MogileFSTrackerError
-from mogilefs.http import NewHttpFile, ClientHttpFile
+from mogilefs.http import NewHttpFile, ClientHttpFile, StreamingHttpFile, RangeReader, ConnectionPool
+from mogilefs.health import LatencyTracker, BreakerBoard
 
 logger = logging
 
@@ -16,6 +19,24 @@ class Client(object):
         self.readonly = bool(readonly)
         self.domain   = domain
         self.backend  = Backend(hosts, timeout)
+        self.http_pool = ConnectionPool()
+        self.node_stats = LatencyTracker()
+        self.breakers   = BreakerBoard()
+        self.metrics    = metrics.registry
+        # e.g. a topology.DeviceReadPolicy
+        self.read_policy = None
+        # e.g. a cache.NegativeCache, for keys get_paths found missing
+        self.negative_cache = None
+        # e.g. a cache.SingleFlight, to share concurrent identical lookups
+        self.single_flight = None
+        # e.g. a keyindex.KeyIndex, kept up to date with the keys stored
+        self.key_index = None
+        # e.g. a cache.RecentWrites, to read keys just stored without
+        # asking the tracker where they are
+        self.recent_writes = None
+        # storage nodes which want MKCOL before a PUT, learned from their
+        # 403s, so streaming uploads can create the directories first
+        self.mkcol_nodes = set()
 
     def run_hook(self, hookname, *args):
         pass
@@ -31,7 +52,21 @@ class Client(object):
         return self.backend.get_last_tracker()
     last_tracker = property(get_last_tracker)
 
-    def new_file(self, key, cls=None, bytes=0, largefile=False, create_open_arg=None, create_close_arg=None, opts=None):
+    def warmup(self, storage_hosts=None):
+        """
+        Open the tracker connection and keep-alive connections to the
+        storage nodes ahead of the first request.  Prefork servers should
+        call this in each worker after fork(); connections inherited from
+        the parent are discarded either way.
+
+        storage_hosts is a list of 'host:port' strings; by default the
+        storage nodes this client has already talked to are used.
+        """
+        self.backend.warmup()
+        return self.http_pool.warmup(storage_hosts)
+
+    def new_file(self, key, cls=None, bytes=0, largefile=False, create_open_arg=None, create_close_arg=None, opts=None, streaming=False,
+                 checksum=None, send_checksum=False):
         """
         - class
         - key
@@ -39,8 +74,16 @@ class Client(object):
         - largefile
         - create_open_arg
         - create_close_arg
+        - streaming: upload with a single chunked PUT as the file is
+          written, for content of unknown length
+        - checksum: hashlib algorithm to compute over the content while
+          it is uploaded, available as the file's checksum attribute
+        - send_checksum: pass the checksum on to the tracker in
+          create_close
         """
         self.run_hook('new_file_start', key, cls, opts)
+        if self.negative_cache is not None:
+            self.negative_cache.discard(key)
 
         create_open_arg = create_open_arg or {}
         create_close_arg = create_close_arg or {}
@@ -69,6 +112,10 @@ class Client(object):
                 path_key = 'path_%s' % x
                 dests.append((res[devid_key], res[path_key]))
 
+        if self.breakers is not None:
+            # don't start writing to a node which has been failing
+            dests = self.breakers.sort_paths(dests, lambda dest: urlparse.urlsplit(dest[1]).netloc)
+
         main_dest = dests[0]
         main_devid, main_path = main_dest
 
@@ -80,7 +127,9 @@ class Client(object):
         self.run_hook("new_file_end", key, cls, opts)
 
         # TODO
-        if largefile:
+        if streaming:
+            file_cls = StreamingHttpFile
+        elif largefile:
             file_cls = ClientHttpFile
         else:
             file_cls = NewHttpFile
@@ -89,12 +138,14 @@ class Client(object):
                         fid=res['fid'],
                         path=main_path,
                         devid=main_devid,
-                        backup_dests=dests,
+                        backup_dests=dests[1:],
                         cls=cls,
                         key=key,
                         content_length=bytes,
                         create_close_arg=create_close_arg,
                         overwrite=1,
+                        checksum=checksum,
+                        send_checksum=send_checksum,
                         )
 
     def edit_file(self, key, **opts):
@@ -148,15 +199,104 @@ class Client(object):
         return ClientHttpFile(mg=self, path=newpath, fid=fid, devid=devid, cls=cls,
                               key=key, overwrite=opts.get('overwrite'))
 
-    def read_file(self, *args, **kwds):
-        paths = self.get_paths(*args, **kwds)
+    def read_file(self, key, *args, **kwds):
+        """
+        Opens the file for reading.  Besides the arguments of get_paths
+        this takes checksum, a hashlib algorithm to compute over the
+        content as it is read, and expected_checksum ('MD5:hexdigest'),
+        which raises ChecksumMismatch once the file has been read to the
+        end with a different digest.
+        """
+        checksum = kwds.pop('checksum', None)
+        expected_checksum = kwds.pop('expected_checksum', None)
+        paths = self.get_paths(key, *args, **kwds)
+        try:
+            return self._open_paths(key, paths, checksum, expected_checksum)
+        except MogileFSError:
+            if self.recent_writes is None or not self.recent_writes.discard(key):
+                raise
+        # the storage node just written to has gone away, ask the tracker
+        paths = self.get_paths(key, *args, **kwds)
+        return self._open_paths(key, paths, checksum, expected_checksum)
+
+    def _open_paths(self, key, paths, checksum, expected_checksum):
+        paths = self._sort_paths(paths)
         path = paths[0]
         backup_dests = [(None, p) for p in paths[1:]]
-        return ClientHttpFile(path=path, backup_dests=backup_dests, readonly=1)
+        return ClientHttpFile(mg=self, path=path, backup_dests=backup_dests, readonly=1, key=key,
+                              checksum=checksum, expected_checksum=expected_checksum)
+
+    def _sort_paths(self, paths):
+        if self.node_stats is not None:
+            # start on the fastest replica which hasn't been failing lately
+            paths = self.node_stats.sort_paths(paths)
+        if self.read_policy is not None:
+            # stay off devices which are unavailable or busy
+            paths = self.read_policy.sort_paths(paths)
+        if self.breakers is not None:
+            paths = self.breakers.sort_paths(paths)
+        return paths
+
+    def get_file_range(self, key, offset, length, buf=None):
+        """
+        Reads `length` bytes of the file from `offset` with a single ranged
+        GET, without opening the file.  Returns the bytes, or, given a
+        writable buffer such as a bytearray, fills it from its start and
+        returns the number of bytes put in.  Less than `length` bytes come
+        back at the end of the file.
+        """
+        if buf is None:
+            return self.get_file_ranges(key, [(offset, length)])[0]
+        return self.get_file_ranges(key, [(offset, length)], [buf])[0]
+
+    def get_file_ranges(self, key, ranges, bufs=None):
+        """
+        get_file_range() for a list of (offset, length) ranges, fetched
+        with one multipart range GET.  Returns a list of strings, or,
+        given a buffer for each range, a list of byte counts.
+        """
+        given = bufs is not None
+        if not given:
+            bufs = [bytearray(length) for offset, length in ranges]
+        elif len(bufs) != len(ranges):
+            raise ValueError("%d buffers for %d ranges" % (len(bufs), len(ranges)))
+
+        reader = RangeReader(self, key, self._sort_paths(self.get_paths(key)))
+        try:
+            counts = reader.read_into(ranges, bufs)
+        except MogileFSError:
+            if self.recent_writes is None or not self.recent_writes.discard(key):
+                raise
+            # the storage node just written to has gone away
+            reader = RangeReader(self, key, self._sort_paths(self.get_paths(key)))
+            counts = reader.read_into(ranges, bufs)
+
+        if given:
+            return counts
+        return [str(buf[:count]) for buf, count in zip(bufs, counts)]
 
     def get_paths(self, key, noverify=1, zone='alt', pathcount=None):
+        single_flight = self.single_flight
+        if single_flight is None:
+            return self._get_paths(key, noverify, zone, pathcount)
+        # callers waiting on the same request each get their own list
+        return list(single_flight.do(('get_paths', key, noverify, zone, pathcount),
+                                     self._get_paths, key, noverify, zone, pathcount))
+
+    def _get_paths(self, key, noverify, zone, pathcount):
         self.run_hook('get_paths_start', key)
 
+        negative_cache = self.negative_cache
+        if negative_cache is not None and key in negative_cache:
+            self.run_hook('get_paths_end', key)
+            return []
+
+        if self.recent_writes is not None:
+            paths = self.recent_writes.get(key)
+            if paths is not None:
+                self.run_hook('get_paths_end', key)
+                return paths
+
         extra_params = {}
         params = { 'domain'  : self.domain,
                    'key'     : key,
@@ -170,19 +310,56 @@ class Client(object):
         except MogileFSTrackerError, e:
             if e.err == 'unknown_key':
                 paths = []
+                if negative_cache is not None:
+                    negative_cache.add(key)
             else:
                 raise e
 
         self.run_hook('get_paths_end', key)
         return paths
 
-    def get_file_data(self, key, timeout=10):
+    def file_info(self, key):
+        """
+        Returns a dict with keys: fid, devcount, length, domain, class, key
+        for the file, or None if there is no such key.
+        """
+        try:
+            res = self.backend.do_request('file_info',
+                                          { 'domain': self.domain,
+                                            'key'   : key,
+                                            })
+        except MogileFSTrackerError, e:
+            if e.err == 'unknown_key':
+                return None
+            raise e
+
+        ret = {}
+        for k in ('domain', 'class', 'key'):
+            ret[k] = res.get(k)
+        for k in ('fid', 'devcount', 'length'):
+            value = res.get(k)
+            if value:
+                ret[k] = int(value)
+            else:
+                ret[k] = 0
+        return ret
+
+    def get_file_data(self, key, timeout=10, expected_checksum=None, coalesce=False):
         """
         given a key, returns a string containing the contents of the file.
+        If expected_checksum ('MD5:hexdigest') is given the content is
+        verified as it is read.  With coalesce and single_flight set,
+        concurrent calls for the same key share one download.
         TODO:
           - supports timeout
         """
-        fp = self.read_file(key, noverify=1)
+        if coalesce and self.single_flight is not None:
+            return self.single_flight.do(('get_file_data', key, expected_checksum),
+                                         self._get_file_data, key, expected_checksum)
+        return self._get_file_data(key, expected_checksum)
+
+    def _get_file_data(self, key, expected_checksum):
+        fp = self.read_file(key, noverify=1, expected_checksum=expected_checksum)
         try:
             content = fp.read()
             return content
@@ -196,6 +373,12 @@ class Client(object):
                                   'from_key': from_key,
                                   'to_key'  : to_key,
                                   })
+        if self.negative_cache is not None:
+            self.negative_cache.discard(to_key)
+        if self.key_index is not None:
+            self.key_index.add(to_key)
+        if self.recent_writes is not None:
+            self.recent_writes.move(from_key, to_key)
         return True
 
     def list_keys(self, prefix=None, after=None, limit=None):
@@ -208,12 +391,32 @@ class Client(object):
         if limit:
             params['limit'] = limit
 
-        res = self.backend.do_request('list_keys', params)
-        resafter = res['next_after']
-        reslist = []
-        for x in xrange(1, int(res['key_count'])+1):
-            reslist.append(res['key_%d' % x])
-        return reslist
+        # the response may hold thousands of keys, so take them as they
+        # are read rather than from a dict of the whole response
+        numbered = []
+        for name, value in self.backend.do_request_iter('list_keys', params):
+            if name.startswith('key_') and name[4:].isdigit():
+                numbered.append((int(name[4:]), value))
+        numbered.sort()
+        return [key for x, key in numbered]
+
+    def iter_keys(self, prefix=None, after=None, page_size=1000):
+        """
+        Every key of the domain after `after`, in the tracker's order,
+        fetched page_size keys at a time.
+        """
+        while 1:
+            try:
+                keys = self.list_keys(prefix=prefix, after=after, limit=page_size)
+            except MogileFSTrackerError, e:
+                if e.err == 'none_match':
+                    return
+                raise
+            if not keys:
+                return
+            for key in keys:
+                yield key
+            after = keys[-1]
 
     def foreach_key(self, *args, **kwds):
         raise NotImplementedError()
@@ -245,7 +448,8 @@ class Client(object):
 
         Given a key, class, and a filehandle or filename, stores the file
         contents in MogileFS.  Returns the number of bytes stored on success,
-        undef on failure.
+        undef on failure.  With checksum (e.g. 'md5') given, returns the
+        number of bytes and the hexdigest of what was uploaded.
         """
         _complain_ifreadonly(self.readonly)
 
@@ -267,6 +471,8 @@ class Client(object):
             fp.close()
             output.close()
 
+        if opts.get('checksum'):
+            return bytes, output.checksum
         return bytes
 
     def store_content(self, key, content, cls=None, **opts):
@@ -274,7 +480,8 @@ class Client(object):
         Wrapper around new_file, print, and close.  Given a key, class, and
         file contents (scalar or scalarref), stores the file contents in
         MogileFS. Returns the number of bytes stored on success, undef on
-        failure.
+        failure.  With checksum given, returns the number of bytes and the
+        hexdigest, as store_file does.
         """
         _complain_ifreadonly(self.readonly)
 
@@ -288,6 +495,8 @@ class Client(object):
 
         self.run_hook('store_content_end', key, cls, opts)
 
+        if opts.get('checksum'):
+            return len(content), output.checksum
         return len(content)
 
     def delete(self, key):
@@ -297,4 +506,8 @@ class Client(object):
                                 { 'domain': self.domain,
                                   'key'   : key,
                                   })
+        if self.negative_cache is not None:
+            self.negative_cache.add(key)
+        if self.recent_writes is not None:
+            self.recent_writes.discard(key)
         return True
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['MogileFSError', 'MogileFSHTTPError', 'MogileFSTrackerError']
+__all__ = ['MogileFSError', 'MogileFSHTTPError', 'MogileFSTrackerError', 'UploadQueueFull',
+           'CircuitOpenError', 'ChecksumMismatch']
 
 class MogileFSError(Exception):
     pass
@@ -23,3 +24,12 @@ class MogileFSHTTPError(MogileFSError):
 
     def __str__(self):
         return 'HTTP Error %d, %s' % (self.code, self.content)
+
+class UploadQueueFull(MogileFSError):
+    pass
+
+class CircuitOpenError(MogileFSError):
+    pass
+
+class ChecksumMismatch(MogileFSError):
+    pass
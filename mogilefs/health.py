@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import time
+import urlparse
+import threading
+
+class HostStats(object):
+    __slots__ = ('latency', 'requests', 'errors', 'error_score', 'last_error')
+
+    def __init__(self):
+        self.latency     = None
+        self.requests    = 0
+        self.errors      = 0
+        self.error_score = 0.0
+        self.last_error  = None
+
+class LatencyTracker(object):
+    """
+    Per storage node (netloc) response times and failures, used to try
+    the fastest, healthiest replica first.
+
+    Latency is an exponentially weighted moving average of the time until
+    the response headers arrive.  Each failure adds `penalty` seconds to
+    a node's score; the penalty halves every `half_life` seconds, so a
+    node that recovers is tried first again before long.
+    """
+    def __init__(self, alpha=0.3, penalty=1.0, half_life=30.0):
+        self.alpha     = alpha
+        self.penalty   = penalty
+        self.half_life = half_life
+        self._hosts = {}
+        self._lock  = threading.Lock()
+
+    def _get(self, netloc):
+        stats = self._hosts.get(netloc)
+        if stats is None:
+            stats = self._hosts.setdefault(netloc, HostStats())
+        return stats
+
+    def _decayed(self, stats, now):
+        if not stats.error_score:
+            return 0.0
+        return stats.error_score * 0.5 ** ((now - stats.last_error) / self.half_life)
+
+    def record(self, netloc, elapsed):
+        self._lock.acquire()
+        try:
+            stats = self._get(netloc)
+            stats.requests += 1
+            if stats.latency is None:
+                stats.latency = elapsed
+            else:
+                stats.latency += self.alpha * (elapsed - stats.latency)
+        finally:
+            self._lock.release()
+
+    def record_error(self, netloc):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            stats = self._get(netloc)
+            stats.requests += 1
+            stats.errors   += 1
+            stats.error_score = self._decayed(stats, now) + self.penalty
+            stats.last_error  = now
+        finally:
+            self._lock.release()
+
+    def score(self, netloc, now=None):
+        """
+        Lower is better.  Nodes we haven't timed yet score the average of
+        the ones we have.
+        """
+        if now is None:
+            now = time.time()
+        stats = self._hosts.get(netloc)
+        if stats is None:
+            return self._average_latency()
+        if stats.latency is None:
+            latency = self._average_latency()
+        else:
+            latency = stats.latency
+        return latency + self._decayed(stats, now)
+
+    def _average_latency(self):
+        known = [s.latency for s in self._hosts.values() if s.latency is not None]
+        if not known:
+            return 0.0
+        return sum(known) / len(known)
+
+    def sort_paths(self, paths):
+        """
+        Returns paths ordered best node first.  The sort is stable, so
+        nodes scoring the same keep the tracker's order.
+        """
+        if len(paths) < 2:
+            return list(paths)
+        now = time.time()
+        scores = {}
+        for path in paths:
+            netloc = urlparse.urlsplit(path).netloc
+            if netloc not in scores:
+                scores[netloc] = self.score(netloc, now)
+        return sorted(paths, key=lambda path: scores[urlparse.urlsplit(path).netloc])
+
+    def stats(self):
+        """
+        Returns { netloc: { latency, requests, errors, score } }.
+        """
+        now = time.time()
+        ret = {}
+        for netloc, stats in self._hosts.items():
+            ret[netloc] = { 'latency' : stats.latency,
+                            'requests': stats.requests,
+                            'errors'  : stats.errors,
+                            'score'   : self.score(netloc, now),
+                            }
+        return ret
+
+CLOSED    = 'closed'
+OPEN      = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a storage node after `failure_threshold`
+    consecutive failures.  Once `reset_timeout` seconds have passed a
+    single trial request is let through (half-open); it closes the
+    circuit again on success and re-opens it on failure.
+    """
+    def __init__(self, failure_threshold=3, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout     = reset_timeout
+        self.failures  = 0
+        self.opened_at = None
+        self._trial    = False
+
+    def get_state(self, now=None):
+        if self.opened_at is None:
+            return CLOSED
+        if now is None:
+            now = time.time()
+        if now - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+    state = property(get_state)
+
+    def allow(self, now=None):
+        state = self.get_state(now)
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures  = 0
+        self.opened_at = None
+        self._trial    = False
+
+    def record_failure(self, now=None):
+        if now is None:
+            now = time.time()
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            self.opened_at = now
+        self._trial = False
+
+class BreakerBoard(object):
+    """
+    One CircuitBreaker per storage node netloc, shared by all the file
+    objects of a Client.
+    """
+    def __init__(self, failure_threshold=3, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout     = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, netloc):
+        breaker = self._breakers.get(netloc)
+        if breaker is None:
+            breaker = self._breakers.setdefault(netloc, CircuitBreaker(self.failure_threshold,
+                                                                        self.reset_timeout))
+        return breaker
+
+    def allow(self, netloc):
+        """
+        Whether a request to netloc may be sent now.  In the half-open
+        state this hands out the one trial request, so only call it right
+        before actually sending.
+        """
+        self._lock.acquire()
+        try:
+            return self._get(netloc).allow()
+        finally:
+            self._lock.release()
+
+    def is_open(self, netloc):
+        breaker = self._breakers.get(netloc)
+        return breaker is not None and breaker.get_state() == OPEN
+
+    def record_success(self, netloc):
+        breaker = self._breakers.get(netloc)
+        if breaker is not None and (breaker.failures or breaker.opened_at):
+            self._lock.acquire()
+            try:
+                breaker.record_success()
+            finally:
+                self._lock.release()
+
+    def record_failure(self, netloc):
+        self._lock.acquire()
+        try:
+            self._get(netloc).record_failure()
+        finally:
+            self._lock.release()
+
+    def sort_paths(self, paths, netloc=None):
+        """
+        Moves paths on nodes whose circuit is open to the end, keeping
+        the order otherwise.  netloc extracts the netloc from an item,
+        for lists of something other than plain URLs.
+        """
+        if netloc is None:
+            netloc = lambda path: urlparse.urlsplit(path).netloc
+        return sorted(paths, key=lambda path: self.is_open(netloc(path)))
+
+    def states(self):
+        return dict([(netloc, breaker.state) for netloc, breaker in self._breakers.items()])
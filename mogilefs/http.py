@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import os
+import hashlib
 import logging
+import socket
+import time
+import threading
 import urlparse
 import httplib
 from cStringIO import StringIO
 
-from mogilefs.exceptions import MogileFSHTTPError, MogileFSTrackerError
+from mogilefs import metrics
+from mogilefs.backend import _register_fork_aware
+from mogilefs.exceptions import MogileFSError, MogileFSHTTPError, MogileFSTrackerError, CircuitOpenError, ChecksumMismatch
 
 logger = logging
 
@@ -21,12 +28,211 @@ def is_success(response):
 
 def get_content_length(response):
     try:
-        return long(response.getheaders('content-length'))
+        return long(response.getheader('content-length'))
     except (TypeError, ValueError):
         return 0
 
+def get_range_total(response):
+    """
+    Returns the complete length from a 'Content-Range: bytes a-b/total'
+    header, or None.
+    """
+    value = response.getheader('content-range')
+    if not value or '/' not in value:
+        return None
+    try:
+        return long(value.rsplit('/', 1)[1])
+    except ValueError:
+        return None
+
+def parse_checksum(value):
+    """
+    Splits a checksum in the tracker's 'MD5:hexdigest' notation into
+    ('md5', 'hexdigest').  A bare hexdigest gives (None, 'hexdigest').
+    """
+    if ':' in value:
+        hashtype, digest = value.split(':', 1)
+        return hashtype.lower(), digest.lower()
+    return None, value.lower()
+
+def _discard(res):
+    """
+    Reads a response which won't be used to the end, so its connection
+    can be reused; one which breaks off is just dropped.
+    """
+    try:
+        while res.read(65536):
+            pass
+    except (socket.error, httplib.HTTPException), e:
+        logger.debug("discarding a response failed: %s" % e)
+
+def _reusable(res):
+    """
+    Whether the connection a closed response came on can take another
+    request: the body was read to the end and the server keeps it open.
+    """
+    if res.will_close:
+        return False
+    # httplib raises when a chunked body breaks off
+    return res.chunked or res.length == 0
+
+def _connection_class(scheme):
+    if scheme == 'http':
+        return httplib.HTTPConnection
+    elif scheme == 'https':
+        return httplib.HTTPSConnection
+    elif not scheme:
+        raise ValueError("url scheme is empty")
+    else:
+        raise ValueError("unsupported url scheme '%s'" % scheme)
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections to the storage nodes, keyed by scheme and
+    netloc.  A connection only becomes idle once the response to its last
+    request has been read to the end.  Connections opened by another
+    process, i.e. inherited across fork(), are never handed out.
+    """
+    def __init__(self, max_idle=4, timeout=None):
+        self.max_idle = max_idle
+        self.timeout  = timeout
+        self._idle    = {}
+        self._known   = {}
+        self._pid     = os.getpid()
+        self._lock    = threading.Lock()
+        _register_fork_aware(self)
+
+        self.metrics = metrics.registry
+        if self.metrics is not None:
+            self.metrics.add_collector(self)
+
+    def collect_metrics(self):
+        if self.metrics is None:
+            return {}
+        idle = {}
+        for (scheme, netloc), conns in self._idle.items():
+            idle[(netloc,)] = len(conns)
+        return { metrics.POOL_IDLE_CONNECTIONS: idle }
+
+    def _after_fork(self):
+        idle = self._idle
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid  = os.getpid()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            logger.debug("pid changed from %d, discarding inherited storage connections" % self._pid)
+            self._after_fork()
+
+    def _new_connection(self, scheme, netloc):
+        connection = _connection_class(scheme)
+        if self.metrics is not None:
+            self.metrics.inc(metrics.STORAGE_CONNECTS, (netloc,))
+        if self.timeout is None:
+            return connection(netloc)
+        return connection(netloc, timeout=self.timeout)
+
+    def get(self, scheme, netloc, fresh=False):
+        """
+        Returns a tuple of (connection, reused).  A reused connection may
+        have been closed by the storage node in the meantime.
+        """
+        self._check_pid()
+        key = (scheme, netloc)
+        self._lock.acquire()
+        try:
+            self._known[key] = True
+            conns = self._idle.get(key)
+            if conns and not fresh:
+                return conns.pop(), True
+        finally:
+            self._lock.release()
+        return self._new_connection(scheme, netloc), False
+
+    def put(self, scheme, netloc, conn, res=None):
+        """
+        Give a connection back.  If the response to its last request is
+        still being read, the connection is only reused once it has been
+        read to the end; one which is abandoned halfway is never reused.
+        """
+        if res is not None and not res.isclosed():
+            self._release_when_read(scheme, netloc, conn, res)
+            return
+        if self._pid != os.getpid() or (res is not None and not _reusable(res)):
+            conn.close()
+            return
+
+        self._lock.acquire()
+        try:
+            conns = self._idle.setdefault((scheme, netloc), [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def _release_when_read(self, scheme, netloc, conn, res):
+        read = res.read
+        def read_then_release(amt=None):
+            # an exception leaves the connection to be closed with res
+            data = read(amt)
+            if res.isclosed():
+                del res.read
+                self.put(scheme, netloc, conn, res)
+            return data
+        res.read = read_then_release
+
+    def warmup(self, hosts=None):
+        """
+        Open a connection to each of the given storage nodes ('host:port'
+        or URLs), or to every node this pool has talked to so far.  Returns
+        the number of connections opened.
+        """
+        self._check_pid()
+        if hosts is None:
+            keys = self._known.keys()
+        else:
+            keys = []
+            for host in hosts:
+                if '://' in host:
+                    url = urlparse.urlsplit(host)
+                    keys.append((url.scheme, url.netloc))
+                else:
+                    keys.append(('http', host))
+
+        opened = 0
+        for scheme, netloc in keys:
+            conn = self._new_connection(scheme, netloc)
+            try:
+                conn.connect()
+            except socket.error, e:
+                logger.debug("failed to warm up connection to %s: %s" % (netloc, e))
+                conn.close()
+                continue
+            self._known[(scheme, netloc)] = True
+            self.put(scheme, netloc, conn)
+            opened += 1
+        return opened
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
 class HttpFile(object):
-    def __init__(self, mg, fid, key, cls, create_close_arg=None):
+    def __init__(self, mg, fid, key, cls, create_close_arg=None,
+                 checksum=None, expected_checksum=None, send_checksum=False, **kwds):
         self.mg = mg
         self.fid = fid
         self.key = key
@@ -34,6 +240,77 @@ class HttpFile(object):
         self.create_close_arg = create_close_arg or {}
         self._closed = False
 
+        # checksum names a hashlib algorithm ('md5', 'sha1', ...) to run
+        # over the content as it passes through
+        self.expected_checksum = None
+        if expected_checksum:
+            hashtype, self.expected_checksum = parse_checksum(expected_checksum)
+            checksum = checksum or hashtype or 'md5'
+        self.checksum_type = checksum and checksum.lower() or None
+        self.send_checksum = send_checksum
+        self._hasher = checksum and hashlib.new(checksum) or None
+        self._hashed = 0
+
+    def _update_checksum(self, content, offset):
+        # only content passing through in order can be hashed
+        if self._hasher is None:
+            return
+        if offset != self._hashed:
+            logger.debug("non-sequential access to %s, no checksum" % self.key)
+            self._hasher = None
+            return
+        self._hasher.update(content)
+        self._hashed += len(content)
+
+    def get_checksum(self):
+        """
+        The hexdigest of the content written or read so far, or None if no
+        checksum was asked for or the file wasn't accessed sequentially.
+        """
+        if self._hasher is None:
+            return None
+        return self._hasher.hexdigest()
+    checksum = property(get_checksum)
+
+    def _verify_checksum(self):
+        if self.expected_checksum is None:
+            return
+        actual = self.get_checksum()
+        if actual is None:
+            return
+        if actual != self.expected_checksum:
+            raise ChecksumMismatch("%s checksum of %s is %s, expected %s"
+                                   % (self.checksum_type, self.key, actual, self.expected_checksum))
+
+    def _create_close(self, devid, path, size):
+        params = { 'fid'   : self.fid,
+                   'devid' : devid,
+                   'domain': self.mg.domain,
+                   'size'  : size,
+                   'key'   : self.key,
+                   'path'  : path,
+                   }
+        if self.send_checksum and self.checksum is not None:
+            params['checksum'] = '%s:%s' % (self.checksum_type.upper(), self.checksum)
+        if self.create_close_arg:
+            params.update(self.create_close_arg)
+        try:
+            self.mg.backend.do_request('create_close', params)
+        except MogileFSTrackerError, e:
+            if e.err != 'empty_file':
+                raise
+
+        negative_cache = getattr(self.mg, 'negative_cache', None)
+        if negative_cache is not None:
+            # a lookup may have raced with the upload
+            negative_cache.discard(self.key)
+        key_index = getattr(self.mg, 'key_index', None)
+        if key_index is not None:
+            key_index.add(self.key)
+        recent_writes = getattr(self.mg, 'recent_writes', None)
+        if recent_writes is not None:
+            recent_writes.add(self.key, [path])
+
     def __enter__(self):
         return self
 
@@ -51,12 +328,7 @@ class HttpFile(object):
 
     def _makedirs(self, path):
         url = urlparse.urlsplit(path)
-        if url.scheme == 'http':
-            connection = httplib.HTTPConnection
-        elif url.scheme == 'https':
-            connection = httplib.HTTPSConnection
-        else:
-            raise ValueError("unsupported url scheme")
+        _connection_class(url.scheme)
 
         # MogileFS file path usually looks like
         # /dev1/0/000/000/0000000900.fid
@@ -78,9 +350,8 @@ class HttpFile(object):
             # /dev1/0/000/
             # /dev1/0/000/000/
             parent = "/".join(elements[:idx]) + "/"
-            conn = connection(url.netloc)
-            conn.request("MKCOL", parent)
-            res = conn.getresponse()
+            res = self._send(url, "MKCOL", parent)
+            res.read()
             if res.status >= 200 and res.status < 300:
                 created = idx == length
             elif res.status >= 400 and res.status < 500:
@@ -92,64 +363,140 @@ class HttpFile(object):
 
         return created
 
+    def _pool(self):
+        return getattr(self.mg, 'http_pool', None)
+
+    def _needs_mkcol(self, netloc):
+        nodes = getattr(self.mg, 'mkcol_nodes', None)
+        if nodes is not None:
+            nodes.add(netloc)
+
+    def _record_failure(self, path):
+        netloc = urlparse.urlsplit(path).netloc
+        node_stats = getattr(self.mg, 'node_stats', None)
+        if node_stats is not None:
+            node_stats.record_error(netloc)
+        breakers = getattr(self.mg, 'breakers', None)
+        if breakers is not None:
+            breakers.record_failure(netloc)
+
+    def _send(self, url, method, target, *args, **kwds):
+        node_stats = getattr(self.mg, 'node_stats', None)
+        breakers   = getattr(self.mg, 'breakers', None)
+        registry   = getattr(self.mg, 'metrics', None)
+        if breakers is not None and not breakers.allow(url.netloc):
+            raise CircuitOpenError("storage node %s is unavailable" % url.netloc)
+
+        start = time.time()
+        try:
+            res = self._send_request(url, method, target, *args, **kwds)
+        except (socket.error, httplib.HTTPException):
+            self._record_failure(url.geturl())
+            if registry is not None:
+                registry.inc(metrics.STORAGE_ERRORS, (url.netloc,))
+            raise
+        elapsed = time.time() - start
+
+        if res.status >= 500:
+            self._record_failure(url.geturl())
+        else:
+            if node_stats is not None:
+                node_stats.record(url.netloc, elapsed)
+            if breakers is not None:
+                breakers.record_success(url.netloc)
+
+        if registry is not None:
+            registry.observe(metrics.STORAGE_REQUEST_SECONDS, (url.netloc, method), elapsed)
+            if res.status >= 500:
+                registry.inc(metrics.STORAGE_ERRORS, (url.netloc,))
+            body = args and args[0] or kwds.get('body')
+            if isinstance(body, (str, buffer)) and body:
+                registry.inc(metrics.STORAGE_BYTES, (url.netloc, 'sent'), len(body))
+            if method != 'HEAD':
+                received = get_content_length(res)
+                if received:
+                    registry.inc(metrics.STORAGE_BYTES, (url.netloc, 'received'), received)
+        return res
+
+    def _send_request(self, url, method, target, *args, **kwds):
+        pool = self._pool()
+        if pool is None:
+            conn = _connection_class(url.scheme)(url.netloc)
+            conn.request(method, target, *args, **kwds)
+            return conn.getresponse()
+
+        conn, reused = pool.get(url.scheme, url.netloc)
+        try:
+            conn.request(method, target, *args, **kwds)
+            res = conn.getresponse()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # the storage node has closed the idle connection
+            conn, reused = pool.get(url.scheme, url.netloc, fresh=True)
+            conn.request(method, target, *args, **kwds)
+            res = conn.getresponse()
+
+        pool.put(url.scheme, url.netloc, conn, res)
+        return res
+
     def _request(self, path, method, *args, **kwds):
         url = urlparse.urlsplit(path)
-        if url.scheme == 'http':
-            connection = httplib.HTTPConnection
-        elif url.scheme == 'https':
-            connection = httplib.HTTPSConnection
-        elif not url.scheme:
-            raise ValueError("url scheme is empty")
-        else:
-            raise ValueError("unsupported url scheme '%s'" % url.scheme)
+        _connection_class(url.scheme)
 
-        conn = connection(url.netloc)
         target = urlparse.urlunsplit((None, None, url.path, url.query, url.fragment))
-        conn.request(method, target, *args, **kwds)
-        res = conn.getresponse()
+        res = self._send(url, method, target, *args, **kwds)
         if is_success(res):
             return res
 
         if method == 'PUT' and res.status == 403:
+            res.read()
             created = self._makedirs(path)
             if created:
-                conn = connection(url.netloc)
-                conn.request(method, target, *args, **kwds)
-                res = conn.getresponse()
+                self._needs_mkcol(url.netloc)
+                res = self._send(url, method, target, *args, **kwds)
                 if is_success(res):
                     return res
 
+        res.read()
         raise MogileFSHTTPError(res.status, res.reason)
 
 class ClientHttpFile(HttpFile):
     def __init__(self, path, backup_dests=None, overwrite=False,
                  mg=None, fid=None, devid=None, cls=None, key=None, readonly=False, create_close_arg=None, **kwds):
 
-        super(ClientHttpFile, self).__init__(mg, fid, key, cls, create_close_arg)
+        super(ClientHttpFile, self).__init__(mg, fid, key, cls, create_close_arg, **kwds)
 
         if backup_dests is None:
             backup_dests = []
 
+        # every replica, for reads to move on to when a node goes away
+        self._replicas = [p for d, p in [(devid, path)] + list(backup_dests)]
+
         for tried_devid, tried_path in [(devid, path)] + list(backup_dests):
-            self._path = tried_path
+            try:
+                if overwrite:
+                    # Ensure file overwritten/created, even if they don't print anything
+                    res = self._request(tried_path, "PUT", "", headers={'Content-Length': '0'})
+                else:
+                    res = self._request(tried_path, "HEAD")
+                res.read()
+            except (MogileFSError, socket.error, httplib.HTTPException), e:
+                logger.debug("failed to open %s: %s" % (tried_path, e))
+                continue
 
             if overwrite:
-                # Ensure file overwritten/created, even if they don't print anything
-                res = self._request(tried_path, "PUT", "", headers={'Content-Length': '0'})
+                self.length = 0
             else:
-                res = self._request(tried_path, "HEAD")
-
-            if is_success(res):
-                if overwrite:
-                    self.length = 0
-                else:
-                    self.length = get_content_length(res)
+                self.length = get_content_length(res)
 
-                self.devid = tried_devid
-                self.path  = tried_path
-                break
+            self.devid = tried_devid
+            self.path  = tried_path
+            self._path = tried_path
+            break
         else:
-            raise MogileFSHTTPError("couldn't connect to any storage nodes")
+            raise MogileFSError("couldn't connect to any storage nodes")
 
         self.overwrite = overwrite
         self.readonly = readonly
@@ -164,32 +511,122 @@ class ClientHttpFile(HttpFile):
         if self._eof:
             return ''
 
-        headers = {}
         if n == 0:
             return ''
-        elif n > 0:
-            headers['Range'] = 'bytes=%d-%d' % (self._pos, self._pos + n - 1)
-        else:
-            # if n is negative, then read whole content
-            pass
 
-        try:
-            res = self._request(self._path, "GET", headers=headers)
-        except MogileFSHTTPError, e:
-            if e.code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
-                self._eof = 1
-                return ''
-            else:
-                raise e
+        # Keep what has been received when a storage node fails partway
+        # through and ask the next replica for the rest only.
+        start  = self._pos
+        chunks = []
+        received = 0
+        while 1:
+            offset = start + received
+            headers = {}
+            if n > 0:
+                headers['Range'] = 'bytes=%d-%d' % (offset, start + n - 1)
+            elif offset:
+                headers['Range'] = 'bytes=%d-' % offset
 
-        content = res.read()
-        self._pos += len(content)
+            try:
+                res = self._request(self._path, "GET", headers=headers)
+            except MogileFSHTTPError, e:
+                # a replica shorter than the file is broken, not at its end
+                if e.code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE and \
+                       (not self.readonly or offset >= self.length):
+                    self._eof = 1
+                    break
+                if not self._failover(e, record=False):
+                    raise
+                continue
+            except (CircuitOpenError, socket.error, httplib.HTTPException), e:
+                # already accounted for by _send()
+                if not self._failover(e, record=False):
+                    raise
+                continue
+
+            expected, error = self._check_response(res, offset)
+            if error is None:
+                error = self._read_body(res, chunks, expected)
+            if error is None:
+                break
+
+            received = sum([len(chunk) for chunk in chunks])
+            if not self._failover(error):
+                raise MogileFSError("read from %s failed after %d bytes: %s" % (self._path, received, error))
 
-        if n < 0:
+        content = ''.join(chunks)
+        self._pos = start + len(content)
+        if self.readonly:
+            self._update_checksum(content, start)
+
+        if n < 0 or (n > 0 and len(content) < n):
             self._eof = 1
+            if self.readonly and self._hashed == self.length:
+                self._verify_checksum()
 
         return content
 
+    def _check_response(self, res, offset):
+        """
+        Returns (expected, error), the number of body bytes announced and
+        the reason not to use the response at all.
+        """
+        if offset and res.status != httplib.PARTIAL_CONTENT:
+            _discard(res)
+            return None, "storage node ignored the range request"
+
+        total = get_range_total(res)
+        if total is None and res.status == httplib.OK:
+            total = get_content_length(res)
+        if self.readonly and total is not None and total != self.length:
+            _discard(res)
+            return None, "length mismatch (%s, not %s)" % (total, self.length)
+
+        if res.getheader('content-length') is None:
+            return None, None
+        return get_content_length(res), None
+
+    def _read_body(self, res, chunks, expected):
+        got = 0
+        try:
+            while 1:
+                chunk = res.read(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                got += len(chunk)
+        except httplib.IncompleteRead, e:
+            if e.partial:
+                chunks.append(e.partial)
+            return e
+        except socket.error, e:
+            return e
+
+        if expected is not None and got < expected:
+            return "short read (%d of %d bytes)" % (got, expected)
+        return None
+
+    def _failover(self, error, record=True):
+        """
+        Switch to the next replica after the current one failed.  Returns
+        False if there is none left.  A file open for writing stays where
+        it is, the other destinations don't hold what was written.
+        """
+        logger.debug("reading %s failed: %s" % (self._path, error))
+        if record:
+            self._record_failure(self._path)
+        if not self.readonly:
+            return False
+        try:
+            idx = self._replicas.index(self._path)
+        except ValueError:
+            idx = -1
+        remaining = self._replicas[idx + 1:]
+        if not remaining:
+            return False
+        self._path = self.path = remaining[0]
+        return True
+
     def readline(self, length=None):
         raise NotImplementedError()
 
@@ -206,6 +643,8 @@ class ClientHttpFile(HttpFile):
         headers = { 'Content-Range': "bytes %d-%d/*" % (start, end),
                     }
         res = self._request(self._path, "PUT", content, headers=headers)
+        res.read()
+        self._update_checksum(content, start)
 
         if self._pos + length > self.length:
             self.length = self._pos + length
@@ -216,20 +655,10 @@ class ClientHttpFile(HttpFile):
         if not self._closed:
             self._closed = 1
             if self.devid:
-                params = { 'fid'   : self.fid,
-                           'devid' : self.devid,
-                           'domain': self.mg.domain,
-                           'size'  : self.length,
-                           'key'   : self.key,
-                           'path'  : self.path,
-                           }
-                if self.create_close_arg:
-                    params.update(self.create_close_arg)
-                try:
-                    self.mg.backend.do_request('create_close', params)
-                except MogileFSTrackerError, e:
-                    if e.err != 'empty_file':
-                        raise
+                if self._hashed != self.length:
+                    # the end of the file was written before the start
+                    self._hasher = None
+                self._create_close(self.devid, self.path, self.length)
 
     def seek(self, pos, mode=0):
         _complain_ifclosed(self._closed)
@@ -245,7 +674,7 @@ class NewHttpFile(HttpFile):
     def __init__(self, path, devid, backup_dests=None,
                  mg=None, fid=None, cls=None, key=None, create_close_arg=None, **kwds):
 
-        super(NewHttpFile, self).__init__(mg, fid, key, cls, create_close_arg)
+        super(NewHttpFile, self).__init__(mg, fid, key, cls, create_close_arg, **kwds)
 
         if backup_dests is None:
             backup_dests = []
@@ -265,43 +694,430 @@ class NewHttpFile(HttpFile):
     def write(self, content):
         self._fp.write(content)
 
+    def put(self, body):
+        """
+        Stores body, a string or a buffer such as one over an mmap, in
+        place of anything written, and closes the file.  The body is sent
+        as it is, without being copied.
+        """
+        _complain_ifclosed(self._closed)
+        self._closed = 1
+        self._fp.close()
+        self._put(body)
+
+    def abort(self):
+        """
+        Drops what was written without storing it.
+        """
+        if not self._closed:
+            self._closed = 1
+            self._fp.close()
+
     def close(self):
         if not self._closed:
             self._closed = 1
 
             content = self._fp.getvalue()
             self._fp.close()
+            self._put(content)
+
+    def _put(self, content):
+        # the buffer may have been written out of order, so hash it as a
+        # whole
+        self._update_checksum(content, 0)
 
-            for tried_devid, tried_path in self._paths:
+        for tried_devid, tried_path in self._paths:
+            try:
+                res = self._request(tried_path, "PUT", content)
+                res.read()
+                devid = tried_devid
+                path  = tried_path
+                break
+            except (MogileFSHTTPError, CircuitOpenError, socket.error, httplib.HTTPException), e:
+                logger.debug("failed to PUT %s: %s" % (tried_path, e))
+                continue
+        else:
+            raise MogileFSError("couldn't store %s to any storage node" % self.key)
+
+        if devid:
+            self._create_close(devid, path, len(content))
+
+    def seek(self, pos, mode=0):
+        return self._fp.seek(pos, mode)
+
+    def tell(self):
+        return self._fp.tell()
+
+class StreamingHttpFile(HttpFile):
+    """
+    Uploads content of unknown length in constant memory.  The first
+    write() opens a single PUT with 'Transfer-Encoding: chunked' and every
+    write() goes straight onto the socket as one chunk; close() ends the
+    body and reports the number of bytes written to the tracker.
+
+    Since nothing is buffered, the upload can only move on to another
+    destination as long as no data has been sent.  A storage node which
+    wants the directories created with MKCOL first refuses the upload
+    with a 403 unless the client has seen it do so before; the
+    directories are then created ahead of the PUT.
+
+    Only close() commits the upload.  Leaving a with block on an
+    exception, or dropping the file unclosed, aborts it, as a partial
+    body would otherwise be stored as the whole file.
+    """
+    def __init__(self, path, devid, backup_dests=None,
+                 mg=None, fid=None, cls=None, key=None, create_close_arg=None, **kwds):
+
+        super(StreamingHttpFile, self).__init__(mg, fid, key, cls, create_close_arg, **kwds)
+
+        if backup_dests is None:
+            backup_dests = []
+        self._paths  = [(devid, path)] + list(backup_dests)
+        self._conn   = None
+        self._url    = None
+        self._closed = 0
+        self.devid   = None
+        self.path    = None
+        self.length  = 0
+
+    def _open(self):
+        breakers = getattr(self.mg, 'breakers', None)
+        mkcol_nodes = getattr(self.mg, 'mkcol_nodes', None) or ()
+        pool = self._pool()
+
+        for tried_devid, tried_path in self._paths:
+            url = urlparse.urlsplit(tried_path)
+            if url.netloc in mkcol_nodes:
+                # the body can't be sent again once refused
                 try:
-                    res = self._request(tried_path, "PUT", content)
-                    devid = tried_devid
-                    path  = tried_path
-                    break
-                except MogileFSHTTPError, e:
+                    self._makedirs(tried_path)
+                except (MogileFSHTTPError, CircuitOpenError, socket.error, httplib.HTTPException), e:
+                    logger.debug("failed to create the directories of %s: %s" % (tried_path, e))
                     continue
+            if breakers is not None and not breakers.allow(url.netloc):
+                logger.debug("skipping %s, storage node is unavailable" % tried_path)
+                continue
+
+            target = urlparse.urlunsplit((None, None, url.path, url.query, url.fragment))
+            if pool is None:
+                conn = _connection_class(url.scheme)(url.netloc)
             else:
-                devid = None
-                path  = None
-
-            if devid:
-                params = { 'fid'   : self.fid,
-                           'domain': self.mg.domain,
-                           'key'   : self.key,
-                           'path'  : path,
-                           'devid' : devid,
-                           'size'  : len(content),
-                           }
-                if self.create_close_arg:
-                    params.update(self.create_close_arg)
-                try:
-                    self.mg.backend.do_request('create_close', params)
-                except MogileFSTrackerError, e:
-                    if e.err != 'empty_file':
-                        raise
+                # the body can't be replayed on a stale keep-alive
+                # connection, so always start on a fresh one
+                conn, reused = pool.get(url.scheme, url.netloc, fresh=True)
+            try:
+                conn.putrequest('PUT', target, skip_accept_encoding=1)
+                conn.putheader('Transfer-Encoding', 'chunked')
+                conn.endheaders()
+            except (socket.error, httplib.HTTPException), e:
+                logger.debug("failed to open %s: %s" % (tried_path, e))
+                conn.close()
+                if breakers is not None:
+                    breakers.record_failure(url.netloc)
+                continue
+
+            self._conn = conn
+            self._url  = url
+            self.devid = tried_devid
+            self.path  = tried_path
+            return
+
+        raise MogileFSError("couldn't connect to any storage nodes")
+
+    def _send_chunk(self, content):
+        try:
+            if len(content) < 16384:
+                self._conn.send('%x\r\n%s\r\n' % (len(content), content))
+            else:
+                self._conn.send('%x\r\n' % len(content))
+                self._conn.send(content)
+                self._conn.send('\r\n')
+        except socket.error, e:
+            self._abort()
+            raise MogileFSError("upload to %s failed after %d bytes: %s" % (self.path, self.length, e))
+
+    def _abort(self):
+        # the node failed to take the upload
+        self._closed = 1
+        self._conn.close()
+        breakers = getattr(self.mg, 'breakers', None)
+        if breakers is not None:
+            breakers.record_failure(self._url.netloc)
+
+    def abort(self):
+        """
+        Gives up on the upload without telling the tracker about it.
+        """
+        if self._closed:
+            return
+        self._closed = 1
+        if self._conn is not None:
+            self._conn.close()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.abort()
+        elif not self._closed:
+            self.close()
+
+    def __del__(self):
+        self.abort()
+
+    def read(self, n=-1):
+        raise IOError("streaming upload is not readable")
+
+    def write(self, content):
+        _complain_ifclosed(self._closed)
+        if not content:
+            return
+
+        if self._conn is None:
+            self._open()
+        self._send_chunk(content)
+        self._update_checksum(content, self.length)
+        self.length += len(content)
+
+        registry = getattr(self.mg, 'metrics', None)
+        if registry is not None:
+            registry.inc(metrics.STORAGE_BYTES, (self._url.netloc, 'sent'), len(content))
+
+    def close(self):
+        if self._closed:
+            return
+
+        if self._conn is None:
+            # nothing written, store an empty file
+            self._open()
+        self._closed = 1
+
+        conn = self._conn
+        try:
+            conn.send('0\r\n\r\n')
+            res = conn.getresponse()
+            res.read()
+        except (socket.error, httplib.HTTPException), e:
+            self._abort()
+            raise MogileFSError("upload to %s failed: %s" % (self.path, e))
+
+        if res.status >= 500:
+            self._abort()
+            raise MogileFSHTTPError(res.status, res.reason)
+
+        # the node answered, which ends a half-open trial as well
+        breakers = getattr(self.mg, 'breakers', None)
+        if breakers is not None:
+            breakers.record_success(self._url.netloc)
+        if not is_success(res):
+            conn.close()
+            if res.status == 403:
+                self._needs_mkcol(self._url.netloc)
+            raise MogileFSHTTPError(res.status, res.reason)
+
+        pool = self._pool()
+        if pool is not None:
+            pool.put(self._url.scheme, self._url.netloc, conn, res)
+
+        self._create_close(self.devid, self.path, self.length)
 
     def seek(self, pos, mode=0):
-        return self._fp.seek(pos, mode)
+        raise IOError("streaming upload is not seekable")
 
     def tell(self):
-        return self._fp.tell()
+        _complain_ifclosed(self._closed)
+        return self.length
+
+def _parse_content_range(value):
+    """
+    (start, end, total) from 'bytes start-end/total'; total is None if
+    given as '*'.
+    """
+    try:
+        unit, spec = value.strip().split(' ', 1)
+        span, total = spec.split('/', 1)
+        start, end = span.split('-', 1)
+        return long(start), long(end), total != '*' and long(total) or None
+    except ValueError:
+        raise MogileFSError("bad Content-Range: %r" % value)
+
+class _BodyReader(object):
+    """
+    readline() and read(n) over a response, for multipart bodies.
+    """
+    def __init__(self, res, block_size=65536):
+        self.res = res
+        self.block_size = block_size
+        self._buf = ''
+
+    def _fill(self):
+        chunk = self.res.read(self.block_size)
+        if not chunk:
+            return False
+        self._buf += chunk
+        return True
+
+    def readline(self):
+        while '\n' not in self._buf:
+            if not self._fill():
+                break
+        idx = self._buf.find('\n') + 1 or len(self._buf)
+        line, self._buf = self._buf[:idx], self._buf[idx:]
+        return line
+
+    def read(self, n):
+        if not self._buf:
+            return self.res.read(min(n, self.block_size))
+        chunk, self._buf = self._buf[:n], self._buf[n:]
+        return chunk
+
+    def drain(self):
+        self._buf = ''
+        while self.res.read(self.block_size):
+            pass
+
+class RangeReader(HttpFile):
+    """
+    Reads byte ranges of a file straight into buffers: one GET carrying
+    all the ranges goes to the first replica, with no HEAD beforehand,
+    and the next replica is only tried if that fails.
+
+    Ranges past the end of the file come back short, or empty.  A
+    storage node answering a request for several ranges with fewer of
+    them is asked for the rest one at a time.
+    """
+    def __init__(self, mg, key, paths):
+        super(RangeReader, self).__init__(mg, None, key, None)
+        self.paths = list(paths)
+        # nothing to close
+        self._closed = 1
+
+    def close(self):
+        pass
+
+    def read_into(self, ranges, bufs):
+        """
+        Fills bufs[i] with the range (offset, length) ranges[i]; returns
+        the number of bytes put into each.
+        """
+        if not self.paths:
+            raise MogileFSError("no paths for %s" % self.key)
+        for path in self.paths:
+            try:
+                return self._get(path, ranges, bufs)
+            except (MogileFSError, socket.error, httplib.HTTPException), e:
+                logger.debug("reading ranges of %s failed: %s" % (path, e))
+                error = e
+        raise MogileFSError("couldn't read %s from any storage node: %s" % (self.key, error))
+
+    def _get(self, path, ranges, bufs):
+        filled = [0] * len(ranges)
+        wanted = [(offset, length, idx) for idx, (offset, length) in enumerate(ranges) if length > 0]
+        if not wanted:
+            return filled
+
+        spec = ','.join(['%d-%d' % (offset, offset + length - 1) for offset, length, idx in wanted])
+        try:
+            res = self._request(path, "GET", headers={ 'Range': 'bytes=%s' % spec })
+        except MogileFSHTTPError, e:
+            if e.code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+                return filled
+            raise
+
+        total = None
+        content_type = res.getheader('content-type') or ''
+        if res.status == httplib.PARTIAL_CONTENT and content_type.startswith('multipart/byteranges'):
+            total = self._read_multipart(res, content_type, wanted, bufs, filled)
+        elif res.status == httplib.PARTIAL_CONTENT:
+            start, end, total = _parse_content_range(res.getheader('content-range') or '')
+            self._scatter(res.read, start, end - start + 1, wanted, bufs, filled)
+        else:
+            # the storage node ignored the range, take what's wanted out
+            # of the whole file
+            if res.getheader('content-length') is None:
+                total = self._scatter(res.read, 0, None, wanted, bufs, filled)
+            else:
+                total = get_content_length(res)
+                self._scatter(res.read, 0, total, wanted, bufs, filled)
+
+        missing = []
+        for offset, length, idx in wanted:
+            if total is None:
+                continue
+            expected = max(0, min(length, total - offset))
+            if filled[idx] < expected:
+                missing.append(idx)
+        if missing and len(wanted) == 1:
+            raise MogileFSError("short read of %s (%d of %d bytes)" % (path, filled[missing[0]], expected))
+        for idx in missing:
+            filled[idx] = self._get(path, [ranges[idx]], [bufs[idx]])[0]
+        return filled
+
+    def _read_multipart(self, res, content_type, wanted, bufs, filled):
+        boundary = None
+        for param in content_type.split(';')[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'boundary':
+                boundary = value.strip('"')
+        if not boundary:
+            res.read()
+            raise MogileFSError("multipart response without a boundary")
+
+        reader = _BodyReader(res)
+        total = None
+        while 1:
+            line = reader.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line == '--%s--' % boundary:
+                break
+            if line != '--%s' % boundary:
+                continue
+
+            content_range = None
+            while 1:
+                header = reader.readline()
+                if not header.strip():
+                    break
+                name, _, value = header.partition(':')
+                if name.strip().lower() == 'content-range':
+                    content_range = value
+            if content_range is None:
+                reader.drain()
+                raise MogileFSError("multipart response part without a Content-Range")
+            start, end, part_total = _parse_content_range(content_range)
+            total = part_total
+            self._scatter(reader.read, start, end - start + 1, wanted, bufs, filled)
+        reader.drain()
+        return total
+
+    def _scatter(self, read, start, length, wanted, bufs, filled):
+        """
+        Copies `length` bytes, or everything up to the end if None, from
+        offset `start` of the file into the buffers of the ranges they
+        overlap.  Returns the offset reached.
+        """
+        pos = start
+        end = None
+        if length is not None:
+            end = start + length
+        while end is None or pos < end:
+            chunk = read(end is None and 65536 or min(65536, end - pos))
+            if not chunk:
+                if end is None:
+                    break
+                raise MogileFSError("response ended %d bytes early" % (end - pos))
+            chunk_end = pos + len(chunk)
+            for offset, size, idx in wanted:
+                lo = max(pos, offset)
+                hi = min(chunk_end, offset + size)
+                if lo >= hi:
+                    continue
+                if lo == pos and hi == chunk_end:
+                    data = chunk
+                else:
+                    data = chunk[lo - pos:hi - pos]
+                bufs[idx][lo - offset:hi - offset] = data
+                # overlapping ranges may come back in more than one part
+                filled[idx] = max(filled[idx], hi - offset)
+            pos = chunk_end
+        return pos
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+A Bloom filter of the keys of a domain, answering "might key X exist?"
+without asking the tracker.  Only keys the filter reports as possibly
+present need a tracker lookup to confirm.
+
+    index = KeyIndex.build(client, capacity=10000000)
+    index.save('/var/cache/domain.keys')
+    ...
+    index = KeyIndex.load(client, '/var/cache/domain.keys')
+    client.key_index = index    # keys this client stores are added
+    index.exists('some/key')
+"""
+import os
+import math
+import mmap
+import struct
+import hashlib
+import threading
+
+MAGIC   = 'MFSBLOOM'
+VERSION = 1
+# magic, version, number of bits, number of hash functions, keys added
+_HEADER = struct.Struct('<8sIQIQ')
+_COUNT_OFFSET = _HEADER.size - 8
+
+def _positions(key, nbits, nhashes):
+    # double hashing: h1 + i * h2 is as good as independent functions
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+    return [(h1 + i * h2) % nbits for i in xrange(nhashes)]
+
+class BloomFilter(object):
+    """
+    Sized for `capacity` keys at a false positive rate of `error_rate`.
+    The bits live in a bytearray, or in a memory mapped file when loaded
+    with load(); a filter mapped writable is updated in place.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        nbits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.nbits   = max(nbits, 8)
+        self.nhashes = max(int(round(float(self.nbits) / capacity * math.log(2))), 1)
+        self.count   = 0
+        self._bits   = bytearray((self.nbits + 7) // 8)
+        self._offset = 0
+        self._mmap   = None
+        self._lock   = threading.Lock()
+
+    @classmethod
+    def load(cls, filename, writable=False):
+        """
+        Maps a saved filter into memory instead of reading it.
+        """
+        fp = open(filename, writable and 'r+b' or 'rb')
+        try:
+            header = fp.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise ValueError("%s is not a bloom filter" % filename)
+            magic, version, nbits, nhashes, count = _HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("%s is not a bloom filter" % filename)
+            access = writable and mmap.ACCESS_WRITE or mmap.ACCESS_READ
+            mapped = mmap.mmap(fp.fileno(), 0, access=access)
+        finally:
+            fp.close()
+        if len(mapped) < _HEADER.size + (nbits + 7) // 8:
+            mapped.close()
+            raise ValueError("%s is truncated" % filename)
+
+        self = cls.__new__(cls)
+        self.nbits   = nbits
+        self.nhashes = nhashes
+        self.count   = count
+        self._bits   = None
+        self._offset = _HEADER.size
+        self._mmap   = mapped
+        self._lock   = threading.Lock()
+        return self
+
+    def __contains__(self, key):
+        if self._mmap is not None:
+            bits, offset = self._mmap, self._offset
+            for pos in _positions(key, self.nbits, self.nhashes):
+                if not ord(bits[offset + (pos >> 3)]) & (1 << (pos & 7)):
+                    return False
+            return True
+
+        bits = self._bits
+        for pos in _positions(key, self.nbits, self.nhashes):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        positions = _positions(key, self.nbits, self.nhashes)
+        self._lock.acquire()
+        try:
+            if self._mmap is not None:
+                bits, offset = self._mmap, self._offset
+                for pos in positions:
+                    idx = offset + (pos >> 3)
+                    bits[idx] = chr(ord(bits[idx]) | (1 << (pos & 7)))
+                self.count += 1
+                bits[_COUNT_OFFSET:_HEADER.size] = struct.pack('<Q', self.count)
+                return
+
+            bits = self._bits
+            for pos in positions:
+                bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+        finally:
+            self._lock.release()
+
+    def save(self, filename):
+        """
+        Writes the filter to filename, replacing it atomically.
+        """
+        tmp = '%s.tmp' % filename
+        fp = open(tmp, 'wb')
+        try:
+            fp.write(_HEADER.pack(MAGIC, VERSION, self.nbits, self.nhashes, self.count))
+            if self._mmap is not None:
+                fp.write(self._mmap[self._offset:self._offset + (self.nbits + 7) // 8])
+            else:
+                fp.write(self._bits)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(tmp, filename)
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+class KeyIndex(object):
+    """
+    A BloomFilter of a client's domain.  Set it as client.key_index to
+    have the keys the client stores or renames to added as it goes;
+    deleted keys stay in the filter, which only costs a confirming
+    lookup.
+    """
+    def __init__(self, client, bloom):
+        self.client = client
+        self.bloom  = bloom
+        self.confirmations = 0
+
+    @classmethod
+    def build(cls, client, capacity, error_rate=0.01, prefix=None, page_size=1000):
+        """
+        Scans the keys of the domain with list_keys into a new filter.
+        """
+        bloom = BloomFilter(capacity, error_rate)
+        for key in client.iter_keys(prefix, page_size=page_size):
+            bloom.add(key)
+        return cls(client, bloom)
+
+    @classmethod
+    def load(cls, client, filename, writable=True):
+        return cls(client, BloomFilter.load(filename, writable))
+
+    def save(self, filename):
+        self.bloom.save(filename)
+
+    def add(self, key):
+        self.bloom.add(key)
+
+    def might_exist(self, key):
+        """
+        False means the key didn't exist when the index was built and
+        hasn't been stored through a client using it since; True needs
+        confirming.
+        """
+        return key in self.bloom
+
+    def exists(self, key):
+        """
+        Asks the tracker only about keys the filter might contain.
+        """
+        if key not in self.bloom:
+            return False
+        self.confirmations += 1
+        return self.client.file_info(key) is not None
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Counters, gauges and latency histograms describing what the client does,
+exportable as a dict or in the Prometheus text format.
+
+Backend, Client and ConnectionPool record into the module-level
+`registry` unless their `metrics` attribute is set to another Registry,
+or to None to turn recording off.
+"""
+import bisect
+import weakref
+import threading
+
+COUNTER   = 'counter'
+GAUGE     = 'gauge'
+HISTOGRAM = 'histogram'
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+TRACKER_REQUEST_SECONDS  = 'mogilefs_tracker_request_seconds'
+TRACKER_ERRORS           = 'mogilefs_tracker_errors_total'
+TRACKER_CONNECTS         = 'mogilefs_tracker_connects_total'
+TRACKER_CONNECT_FAILURES = 'mogilefs_tracker_connect_failures_total'
+STORAGE_REQUEST_SECONDS  = 'mogilefs_storage_request_seconds'
+STORAGE_BYTES            = 'mogilefs_storage_bytes_total'
+STORAGE_ERRORS           = 'mogilefs_storage_errors_total'
+STORAGE_CONNECTS         = 'mogilefs_storage_connects_total'
+POOL_IDLE_CONNECTIONS    = 'mogilefs_pool_idle_connections'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+def _merge(into, shard):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            total = into.get(key)
+            if total is None:
+                into[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    total[i] += v
+        else:
+            into[key] = into.get(key, 0) + value
+
+class _ShardOwner(object):
+    """
+    Kept in the thread-local only, so it goes away with the thread.
+    """
+    __slots__ = ('__weakref__',)
+
+class Registry(object):
+    """
+    Metrics are recorded into a shard owned by the recording thread, so
+    the hot path takes no lock; snapshots add the shards up.  The shard
+    of a thread which has finished is folded into a retired total, so
+    short-lived threads don't pile up shards.  Label values are passed
+    as a tuple in the order the metric was described with.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._metrics    = {}
+        self._shards     = []
+        self._retired    = {}
+        self._owners     = set()
+        self._local      = threading.local()
+        self._lock       = threading.Lock()
+        self._collectors = weakref.WeakKeyDictionary()
+
+    def describe(self, name, kind, help, labels=()):
+        self._metrics[name] = (kind, help, tuple(labels))
+
+    def add_collector(self, obj):
+        """
+        obj.collect_metrics() is called on every snapshot and returns
+        { name: { label_values: value } } for gauges it computes itself.
+        Only a weak reference to obj is kept.
+        """
+        self._collectors[obj] = True
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            owner = self._local.owner = _ShardOwner()
+            self._lock.acquire()
+            try:
+                self._shards.append(shard)
+                self._owners.add(weakref.ref(owner, lambda ref: self._retire(ref, shard)))
+            finally:
+                self._lock.release()
+            return shard
+
+    def _retire(self, ref, shard):
+        self._lock.acquire()
+        try:
+            self._owners.discard(ref)
+            for idx, other in enumerate(self._shards):
+                if other is shard:
+                    del self._shards[idx]
+                    break
+            _merge(self._retired, shard)
+        finally:
+            self._lock.release()
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        key = (name, labels)
+        hist = shard.get(key)
+        if hist is None:
+            # one count per bucket, one for +Inf, then the sum
+            hist = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        hist[bisect.bisect_left(self.buckets, value)] += 1
+        hist[-1] += value
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            for shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns { name: { label_values: value } }.  Counter and gauge values
+        are numbers; a histogram value is a dict with the cumulative
+        'buckets' as [(upper_bound, count), ...], 'sum' and 'count'.
+        """
+        merged = {}
+        self._lock.acquire()
+        try:
+            shards = list(self._shards)
+            _merge(merged, self._retired)
+        finally:
+            self._lock.release()
+
+        for shard in shards:
+            _merge(merged, shard)
+
+        ret = {}
+        for (name, labels), value in merged.items():
+            if isinstance(value, list):
+                buckets = []
+                count = 0
+                for bound, n in zip(self.buckets + (float('inf'),), value[:-1]):
+                    count += n
+                    buckets.append((bound, count))
+                value = { 'buckets': buckets, 'sum': value[-1], 'count': count }
+            ret.setdefault(name, {})[labels] = value
+
+        for obj in list(self._collectors.keys()):
+            for name, values in obj.collect_metrics().items():
+                gauges = ret.setdefault(name, {})
+                for labels, value in values.items():
+                    gauges[labels] = gauges.get(labels, 0) + value
+        return ret
+
+    def to_dict(self):
+        """
+        The snapshot with label values turned into dicts:
+        { name: [ { 'labels': {...}, 'value': ... }, ... ] }
+        """
+        ret = {}
+        for name, values in self.snapshot().items():
+            labelnames = self._metrics.get(name, (None, None, ()))[2]
+            rows = ret[name] = []
+            for labels, value in sorted(values.items()):
+                rows.append({ 'labels': dict(zip(labelnames, labels)),
+                              'value' : value,
+                              })
+        return ret
+
+    def to_prometheus(self):
+        """
+        The snapshot in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, values in sorted(self.snapshot().items()):
+            kind, help, labelnames = self._metrics.get(name, (GAUGE, '', ()))
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(values.items()):
+                pairs = ['%s="%s"' % (k, _escape(v)) for k, v in zip(labelnames, labels)]
+                if kind != HISTOGRAM:
+                    lines.append('%s%s %s' % (name, pairs and '{%s}' % ','.join(pairs) or '',
+                                              _format_value(value)))
+                    continue
+                for bound, count in value['buckets']:
+                    le = pairs + ['le="%s"' % _format_value(float(bound))]
+                    lines.append('%s_bucket{%s} %d' % (name, ','.join(le), count))
+                suffix = pairs and '{%s}' % ','.join(pairs) or ''
+                lines.append('%s_sum%s %s' % (name, suffix, _format_value(value['sum'])))
+                lines.append('%s_count%s %d' % (name, suffix, value['count']))
+        return '\n'.join(lines) + '\n'
+
+def _describe_defaults(registry):
+    registry.describe(TRACKER_REQUEST_SECONDS, HISTOGRAM,
+                      'Tracker command latency', ('command', 'tracker'))
+    registry.describe(TRACKER_ERRORS, COUNTER,
+                      'Failed tracker commands by error code', ('command', 'err'))
+    registry.describe(TRACKER_CONNECTS, COUNTER,
+                      'Connections opened to trackers', ('tracker',))
+    registry.describe(TRACKER_CONNECT_FAILURES, COUNTER,
+                      'Failed attempts to connect to trackers', ('tracker',))
+    registry.describe(STORAGE_REQUEST_SECONDS, HISTOGRAM,
+                      'Storage node request latency until the response headers', ('host', 'method'))
+    registry.describe(STORAGE_BYTES, COUNTER,
+                      'Bytes sent to and announced by storage nodes', ('host', 'direction'))
+    registry.describe(STORAGE_ERRORS, COUNTER,
+                      'Failed storage node requests', ('host',))
+    registry.describe(STORAGE_CONNECTS, COUNTER,
+                      'Connections opened to storage nodes', ('host',))
+    registry.describe(POOL_IDLE_CONNECTIONS, GAUGE,
+                      'Idle keep-alive connections to storage nodes', ('host',))
+
+def new_registry(buckets=DEFAULT_BUCKETS):
+    """
+    A Registry knowing the metrics recorded by this package.
+    """
+    registry = Registry(buckets)
+    _describe_defaults(registry)
+    return registry
+
+registry = new_registry()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Spreads keys over several MogileFS clusters, or domains, by consistent
+hashing, so adding a shard only moves the keys the new one takes over.
+
+    client = ShardedClient({ 'a': Client('domain', ['tracker-a:7001']),
+                             'b': Client('domain', ['tracker-b:7001']) })
+
+While the set of shards changes, start_migration() makes reads look at
+the key's new owner first and its old owner after that; move_misplaced()
+copies keys over, and finish_migration() drops the old ring.
+"""
+import bisect
+import struct
+import hashlib
+import logging
+import threading
+
+from mogilefs.exceptions import MogileFSError, MogileFSHTTPError, MogileFSTrackerError
+
+logger = logging
+
+BLOCK_SIZE = 1024 * 1024
+
+def _hash(value):
+    return struct.unpack('>Q', hashlib.md5(value).digest()[:8])[0]
+
+class HashRing(object):
+    """
+    Maps keys to node names, each node owning `vnodes` points on the ring
+    per unit of weight.
+    """
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes  = vnodes
+        self.weights = {}
+        self._points = []
+        self._owners = []
+        if isinstance(nodes, dict):
+            nodes = nodes.items()
+        else:
+            nodes = [(node, 1) for node in nodes]
+        for node, weight in nodes:
+            self.weights[node] = weight
+        self._build()
+
+    def _build(self):
+        ring = []
+        for node, weight in self.weights.items():
+            for x in xrange(int(self.vnodes * weight)):
+                ring.append((_hash('%s-%d' % (node, x)), node))
+        ring.sort()
+        self._points = [point for point, node in ring]
+        self._owners = [node for point, node in ring]
+
+    def add(self, node, weight=1):
+        self.weights[node] = weight
+        self._build()
+
+    def remove(self, node):
+        del self.weights[node]
+        self._build()
+
+    def nodes(self):
+        return sorted(self.weights)
+
+    def get(self, key):
+        if not self._points:
+            raise ValueError("the ring has no nodes")
+        idx = bisect.bisect(self._points, _hash(key))
+        if idx == len(self._points):
+            idx = 0
+        return self._owners[idx]
+
+def _fan_out(func, clients):
+    """
+    Calls func(client) for every client at once; returns the results in
+    order, raising the first exception.
+    """
+    if len(clients) == 1:
+        return [func(clients[0])]
+
+    results = [None] * len(clients)
+    errors  = []
+    def run(idx, client):
+        try:
+            results[idx] = func(client)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(idx, client))
+               for idx, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def _list_keys(client, prefix, after, limit):
+    try:
+        return client.list_keys(prefix, after, limit)
+    except MogileFSTrackerError, e:
+        if e.err == 'none_match':
+            return []
+        raise
+
+class ShardedClient(object):
+    """
+    The Client API over a { name: Client } mapping of shards.
+    """
+    def __init__(self, shards, vnodes=160, weights=None):
+        self.vnodes = vnodes
+        self.shards = dict(shards)
+        self.ring   = self._ring(self.shards, weights)
+        self.old_shards = None
+        self.old_ring   = None
+
+    def _ring(self, shards, weights):
+        nodes = dict([(name, (weights or {}).get(name, 1)) for name in shards])
+        return HashRing(nodes, self.vnodes)
+
+    def shard_for(self, key):
+        return self.shards[self.ring.get(key)]
+
+    def _old_shard_for(self, key):
+        if self.old_ring is None:
+            return None
+        client = self.old_shards[self.old_ring.get(key)]
+        if client is self.shard_for(key):
+            return None
+        return client
+
+    def _clients(self):
+        clients = list(self.shards.values())
+        for client in (self.old_shards or {}).values():
+            if client not in clients:
+                clients.append(client)
+        return clients
+
+    def start_migration(self, shards, weights=None):
+        """
+        Switch to a new set of shards.  Until finish_migration(), keys not
+        found on their new owner are looked for on the old one, and
+        deletes go to both.  Shards kept over the migration must be the
+        same Client objects in both mappings.
+        """
+        if self.old_ring is not None:
+            raise MogileFSError("a migration is already in progress")
+        self.old_shards, self.old_ring = self.shards, self.ring
+        self.shards = dict(shards)
+        self.ring   = self._ring(self.shards, weights)
+
+    def finish_migration(self):
+        self.old_shards = None
+        self.old_ring   = None
+
+    def _reader(self, key):
+        client = self.shard_for(key)
+        old = self._old_shard_for(key)
+        if old is not None and not client.get_paths(key):
+            return old
+        return client
+
+    def get_paths(self, key, *args, **kwds):
+        paths = self.shard_for(key).get_paths(key, *args, **kwds)
+        if not paths:
+            old = self._old_shard_for(key)
+            if old is not None:
+                paths = old.get_paths(key, *args, **kwds)
+        return paths
+
+    def read_file(self, key, *args, **kwds):
+        return self._reader(key).read_file(key, *args, **kwds)
+
+    def get_file_data(self, key, *args, **kwds):
+        return self._reader(key).get_file_data(key, *args, **kwds)
+
+    def new_file(self, key, *args, **kwds):
+        return self.shard_for(key).new_file(key, *args, **kwds)
+
+    def store_file(self, key, fp, *args, **kwds):
+        return self.shard_for(key).store_file(key, fp, *args, **kwds)
+
+    def store_content(self, key, content, *args, **kwds):
+        return self.shard_for(key).store_content(key, content, *args, **kwds)
+
+    def delete(self, key):
+        client = self.shard_for(key)
+        old = self._old_shard_for(key)
+        if old is None:
+            return client.delete(key)
+
+        deleted = False
+        for c in (client, old):
+            try:
+                c.delete(key)
+                deleted = True
+            except MogileFSTrackerError, e:
+                if e.err != 'unknown_key':
+                    raise
+                error = e
+        if not deleted:
+            raise error
+        return True
+
+    def rename(self, from_key, to_key):
+        """
+        Keys living on different shards are copied and deleted.
+        """
+        src = self._reader(from_key)
+        dst = self.shard_for(to_key)
+        if src is dst:
+            return src.rename(from_key, to_key)
+        if self.get_paths(to_key):
+            # as the tracker refuses a rename onto an existing key
+            raise MogileFSTrackerError("Target key name already exists; can't overwrite.", 'key_exists')
+        _copy(src, from_key, dst, to_key)
+        src.delete(from_key)
+        return True
+
+    def list_keys(self, prefix=None, after=None, limit=None):
+        """
+        Asks every shard at once and merges the answers.
+        """
+        lists = _fan_out(lambda client: _list_keys(client, prefix, after, limit),
+                         self._clients())
+        keys = set()
+        for found in lists:
+            keys.update(found)
+        keys = sorted(keys)
+        if limit:
+            keys = keys[:limit]
+        if not keys:
+            raise MogileFSTrackerError('No keys match', 'none_match')
+        return keys
+
+    def iter_keys(self, prefix=None, after=None, page_size=1000):
+        while 1:
+            try:
+                keys = self.list_keys(prefix, after, page_size)
+            except MogileFSTrackerError, e:
+                if e.err == 'none_match':
+                    return
+                raise
+            for key in keys:
+                yield key
+            after = keys[-1]
+
+    def iter_misplaced(self, prefix=None):
+        """
+        (key, old owner, new owner) for every key of the old shards which
+        the new ring puts elsewhere.
+        """
+        if self.old_ring is None:
+            return
+        for name, client in sorted(self.old_shards.items()):
+            for key in client.iter_keys(prefix):
+                if self.old_ring.get(key) != name:
+                    # a leftover which doesn't belong here either way
+                    continue
+                owner = self.shard_for(key)
+                if owner is not client:
+                    yield key, client, owner
+
+    def move_misplaced(self, prefix=None):
+        """
+        Copies every misplaced key to its new owner and deletes it from
+        the old one once the copy is complete.  Returns the number of keys
+        moved.
+        """
+        moved = 0
+        for key, old, new in self.iter_misplaced(prefix):
+            if new.file_info(key) is None:
+                # written during the migration otherwise
+                _copy(old, key, new, key)
+            old.delete(key)
+            moved += 1
+        return moved
+
+def _copy(src, src_key, dst, dst_key, block_size=BLOCK_SIZE):
+    """
+    Streams a key from one client to another.  A copy which fails is
+    aborted, so the destination never holds part of the file.
+    """
+    info = src.file_info(src_key)
+    if info is None:
+        raise MogileFSTrackerError('unknown_key', 'unknown_key')
+    cls = info['class']
+    if cls == 'default':
+        cls = None
+    try:
+        _stream(src, src_key, dst, dst_key, cls, info['length'], block_size)
+    except MogileFSHTTPError, e:
+        if e.code != 403:
+            raise
+        # a node which wants MKCOL first refuses the first streaming
+        # upload; the client creates the directories from then on
+        _stream(src, src_key, dst, dst_key, cls, info['length'], block_size)
+
+    copied = dst.file_info(dst_key)
+    if copied is None or copied['length'] != info['length']:
+        raise MogileFSError("copy of %s is %s bytes, expected %d"
+                            % (src_key, copied and copied['length'], info['length']))
+
+def _stream(src, src_key, dst, dst_key, cls, length, block_size):
+    fp = src.read_file(src_key)
+    try:
+        out = dst.new_file(dst_key, cls, streaming=True)
+        try:
+            remaining = length
+            while remaining > 0:
+                buf = fp.read(min(block_size, remaining))
+                if not buf:
+                    raise MogileFSError("%s ended %d bytes early" % (src_key, remaining))
+                out.write(buf)
+                remaining -= len(buf)
+        except:
+            out.abort()
+            raise
+        out.close()
+    finally:
+        fp.close()
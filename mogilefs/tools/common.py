@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Pieces shared by the mogilefs-export and mogilefs-import commands.
+"""
+import os
+import sys
+import time
+import json
+import urllib
+import threading
+
+from mogilefs.client import Client
+
+def add_client_options(parser):
+    parser.add_option('-t', '--trackers', default='127.0.0.1:7001',
+                      help='comma separated host:port of the trackers [%default]')
+    parser.add_option('-d', '--domain',
+                      help='domain to work on')
+    parser.add_option('-w', '--workers', type='int', default=8,
+                      help='files transferred at once [%default]')
+    parser.add_option('--timeout', type='int', default=10,
+                      help='tracker timeout in seconds [%default]')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+                      help="don't report progress")
+
+def check_client_options(parser, options):
+    if not options.domain:
+        parser.error('--domain is required')
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+
+def make_client(options):
+    hosts = [host.strip() for host in options.trackers.split(',') if host.strip()]
+    return Client(options.domain, hosts, timeout=options.timeout)
+
+def key_to_path(key):
+    """
+    The relative path, '/' separated, a key is stored under in a directory
+    tree or a tar archive.  Keys are %-quoted; one whose parts would not
+    make a plain relative path, like '/a' or 'a/../b', becomes a single
+    file name with its slashes quoted too.
+    """
+    path = urllib.quote(key, safe='/')
+    for part in path.split('/'):
+        if part in ('', '.', '..'):
+            return urllib.quote(key, safe='')
+    return path
+
+def path_to_key(path):
+    """
+    The inverse of key_to_path.
+    """
+    return urllib.unquote(path)
+
+class Checkpoint(object):
+    """
+    A small JSON document saved next to the output, replaced atomically so
+    an interrupted run always leaves a consistent one behind.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        try:
+            fp = open(self.filename, 'rb')
+        except IOError:
+            return None
+        try:
+            return json.load(fp)
+        finally:
+            fp.close()
+
+    def save(self, state):
+        tmp = '%s.tmp' % self.filename
+        fp = open(tmp, 'wb')
+        try:
+            json.dump(state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(tmp, self.filename)
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+class Progress(object):
+    """
+    Counts files and bytes from any thread and reports the rate to `out`
+    at most every `interval` seconds.
+    """
+    def __init__(self, out=sys.stderr, interval=5.0, quiet=False):
+        self.out      = out
+        self.interval = interval
+        self.quiet    = quiet
+        self.files    = 0
+        self.bytes    = 0
+        self.skipped  = 0
+        self.failures = []
+        self.started  = time.time()
+        self._reported = self.started
+        self._lock    = threading.Lock()
+
+    def done(self, nbytes):
+        self._lock.acquire()
+        try:
+            self.files += 1
+            self.bytes += nbytes
+        finally:
+            self._lock.release()
+        self.maybe_report()
+
+    def skip(self):
+        self._lock.acquire()
+        try:
+            self.skipped += 1
+        finally:
+            self._lock.release()
+
+    def fail(self, name, error):
+        self._lock.acquire()
+        try:
+            self.failures.append((name, str(error)))
+        finally:
+            self._lock.release()
+
+    def maybe_report(self):
+        now = time.time()
+        if self.quiet or now - self._reported < self.interval:
+            return
+        self._reported = now
+        self.report()
+
+    def report(self, final=False):
+        """
+        Prints the totals and rates; the final report lists every failure,
+        even when quiet.
+        """
+        elapsed = max(time.time() - self.started, 1e-6)
+        line = '%d files, %.1f MB in %.1fs (%.1f files/s, %.2f MB/s)' % (
+            self.files, self.bytes / 1048576.0, elapsed,
+            self.files / elapsed, self.bytes / 1048576.0 / elapsed)
+        if self.skipped:
+            line += ', %d skipped' % self.skipped
+        if self.failures:
+            line += ', %d failed' % len(self.failures)
+        if not self.quiet:
+            print >>self.out, line
+        if final:
+            for name, error in self.failures:
+                print >>self.out, 'FAILED %s: %s' % (name, error)
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Copies the files of a domain into a tar archive or a directory tree.
+
+    mogilefs-export -t tracker:7001 -d domain -o backup.tar
+    mogilefs-export -t tracker:7001 -d domain -o backup/ --resume
+
+Keys are listed page by page and downloaded by a pool of workers, each
+with its own client and keep-alive connections, a block at a time.
+Progress is checkpointed next to the output so an interrupted export can
+carry on with --resume; keys which failed are kept in the checkpoint too,
+and tried again first.
+"""
+import os
+import sys
+import time
+import itertools
+import urllib
+import tarfile
+import logging
+import threading
+from Queue import Queue
+from optparse import OptionParser
+
+from mogilefs.tools.common import add_client_options, check_client_options, make_client, \
+     key_to_path, Checkpoint, Progress
+
+logger = logging
+
+BLOCK_SIZE = 1024 * 1024
+
+class _BlockReader(object):
+    """
+    Serves the small reads tarfile makes out of block sized reads from
+    the storage node.
+    """
+    def __init__(self, fp, block_size):
+        self.fp = fp
+        self.block_size = block_size
+        self._remaining = fp.length
+        self._buf = ''
+        self._pos = 0
+
+    def read(self, n):
+        if len(self._buf) - self._pos < n and self._remaining > 0:
+            chunks = [self._buf[self._pos:]]
+            have = len(chunks[0])
+            while have < n and self._remaining > 0:
+                chunk = self.fp.read(min(max(self.block_size, n - have), self._remaining))
+                if not chunk:
+                    self._remaining = 0
+                    break
+                chunks.append(chunk)
+                have += len(chunk)
+                self._remaining -= len(chunk)
+            self._buf = ''.join(chunks)
+            self._pos = 0
+        ret = self._buf[self._pos:self._pos + n]
+        self._pos += len(ret)
+        return ret
+
+def copy_file(fp, out, block_size=BLOCK_SIZE):
+    """
+    Copies an open MogileFS file to out a block at a time; returns the
+    number of bytes copied.
+    """
+    remaining = fp.length
+    while remaining > 0:
+        buf = fp.read(min(block_size, remaining))
+        if not buf:
+            raise IOError('file ended %d bytes early' % remaining)
+        out.write(buf)
+        remaining -= len(buf)
+    return fp.length
+
+class DirectorySink(object):
+    """
+    Writes each key to a file below root; workers write in parallel.
+    """
+    parallel = True
+
+    def __init__(self, root, block_size=BLOCK_SIZE, state=None):
+        self.root = root
+        self.block_size = block_size
+
+    def write(self, key, fp):
+        path = os.path.join(self.root, *key_to_path(key).split('/'))
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # another worker got there first
+                if not os.path.isdir(dirname):
+                    raise
+
+        tmp = '%s.part' % path
+        out = open(tmp, 'wb')
+        try:
+            try:
+                nbytes = copy_file(fp, out, self.block_size)
+            finally:
+                out.close()
+        except:
+            os.unlink(tmp)
+            raise
+        os.rename(tmp, path)
+        return nbytes
+
+    def state(self):
+        return {}
+
+    def close(self):
+        pass
+
+class TarSink(object):
+    """
+    Appends each key to a tar archive.  A tar stream can only be written
+    in order, so files are opened by the workers and copied in by the
+    collecting thread; a member which fails halfway is cut off again.
+    """
+    parallel = False
+
+    def __init__(self, filename, block_size=BLOCK_SIZE, state=None):
+        self.block_size = block_size
+        if state and 'offset' in state:
+            self._fileobj = open(filename, 'r+b')
+            self._fileobj.truncate(state['offset'])
+            self._fileobj.seek(state['offset'])
+        else:
+            self._fileobj = open(filename, 'wb')
+        self._tar = tarfile.open(fileobj=self._fileobj, mode='w', format=tarfile.PAX_FORMAT)
+
+    def write(self, key, fp):
+        info = tarfile.TarInfo(key_to_path(key))
+        info.size  = fp.length
+        info.mtime = int(time.time())
+        info.mode  = 0644
+
+        offset = self._tar.offset
+        try:
+            self._tar.addfile(info, _BlockReader(fp, self.block_size))
+        except:
+            self._fileobj.seek(offset)
+            self._fileobj.truncate(offset)
+            self._tar.offset = offset
+            raise
+        # only kept for listing the archive, which would grow without bound
+        del self._tar.members[:]
+        return info.size
+
+    def state(self):
+        self._fileobj.flush()
+        return { 'offset': self._tar.offset }
+
+    def close(self):
+        self._tar.close()
+        self._fileobj.close()
+
+class Exporter(object):
+    """
+    Streams every key of a domain into a sink.  The keys in `retry` are
+    exported first, then the others in the order they are listed; the
+    checkpoint records the last key up to which everything has been
+    dealt with, and the keys which failed.
+    """
+    def __init__(self, client_factory, sink, workers=8, prefix=None, after=None,
+                 page_size=1000, progress=None, checkpoint=None, checkpoint_interval=5.0,
+                 retry=()):
+        self.client_factory = client_factory
+        self.sink      = sink
+        self.workers   = workers
+        self.prefix    = prefix
+        self.after     = after
+        self.page_size = page_size
+        self.progress  = progress or Progress(quiet=True)
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.retry  = list(retry)
+        self.failed = []
+        self.error  = None
+
+    def run(self):
+        """
+        Returns True if every key listed was exported; the others are
+        kept in `failed`.  A failure to list keys, or of a worker as a
+        whole, stops the export and is kept in `error`.
+        """
+        jobs    = Queue(self.workers * 4)
+        results = Queue()
+
+        lister = threading.Thread(target=self._list, args=(jobs, results))
+        lister.setDaemon(True)
+        lister.start()
+        for x in xrange(self.workers):
+            worker = threading.Thread(target=self._work, args=(jobs, results))
+            worker.setDaemon(True)
+            worker.start()
+
+        self._collect(results)
+        self.sink.close()
+        if self.error is None and not self.failed and self.checkpoint is not None:
+            self.checkpoint.remove()
+        return self.error is None and not self.progress.failures
+
+    def _list(self, jobs, results):
+        try:
+            try:
+                client = self.client_factory()
+                listed = client.iter_keys(self.prefix, self.after, self.page_size)
+                for seq, key in enumerate(itertools.chain(self.retry, listed)):
+                    jobs.put((seq, key))
+            except Exception, e:
+                logger.error("listing keys failed: %s" % e)
+                results.put((None, None, None, e, None))
+        finally:
+            for x in xrange(self.workers):
+                jobs.put(None)
+
+    def _work(self, jobs, results):
+        # whatever happens, the collecting thread must hear that this
+        # worker is done
+        try:
+            try:
+                self._export(self.client_factory(), jobs, results)
+            except Exception, e:
+                logger.error("export worker failed: %s" % e)
+                results.put((None, None, None, e, None))
+                # keep the lister from blocking on a full queue; what
+                # isn't exported stays after the checkpoint
+                while jobs.get() is not None:
+                    pass
+        finally:
+            results.put(None)
+
+    def _export(self, client, jobs, results):
+        while 1:
+            job = jobs.get()
+            if job is None:
+                return
+            seq, key = job
+            try:
+                fp = client.read_file(key)
+            except Exception, e:
+                results.put((seq, key, None, e, None))
+                continue
+
+            if self.sink.parallel:
+                try:
+                    try:
+                        results.put((seq, key, self.sink.write(key, fp), None, None))
+                    except Exception, e:
+                        results.put((seq, key, None, e, None))
+                finally:
+                    fp.close()
+            else:
+                # wait for the collecting thread to copy the file
+                written = threading.Event()
+                results.put((seq, key, fp, None, written))
+                written.wait()
+
+    def _collect(self, results):
+        running  = self.workers
+        pending  = {}
+        next_seq = 0
+        last_key = None
+        saved_at = time.time()
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+                continue
+            seq, key, payload, error, written = item
+            if seq is None:
+                self.error = self.error or error
+                continue
+
+            pending[seq] = item
+            while next_seq in pending:
+                seq, key, payload, error, written = pending.pop(next_seq)
+                next_seq += 1
+                if written is not None:
+                    payload, error = self._write(key, payload, written)
+                if error is None:
+                    self.progress.done(payload)
+                else:
+                    self.progress.fail(key, error)
+                    self.failed.append(key)
+                if seq >= len(self.retry):
+                    last_key = key
+
+            if self.checkpoint is not None and time.time() - saved_at >= self.checkpoint_interval:
+                self._save(last_key, next_seq)
+                saved_at = time.time()
+
+        if self.checkpoint is not None and (self.error is not None or self.failed):
+            self._save(last_key, next_seq)
+
+    def _write(self, key, fp, written):
+        try:
+            try:
+                return self.sink.write(key, fp), None
+            except Exception, e:
+                return None, e
+        finally:
+            fp.close()
+            written.set()
+
+    def _save(self, last_key, next_seq):
+        state = self.sink.state()
+        # quoted, as keys are bytes and JSON wants text
+        state['after']  = urllib.quote(last_key or self.after or '')
+        state['prefix'] = self.prefix
+        # the retried keys not got to yet are still to do as well
+        state['failed'] = [urllib.quote(key) for key in self.failed + self.retry[next_seq:]]
+        self.checkpoint.save(state)
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog -d DOMAIN -o OUTPUT [options]')
+    add_client_options(parser)
+    parser.add_option('-o', '--output',
+                      help='tar archive or directory to write to')
+    parser.add_option('-f', '--format', choices=('tar', 'dir'),
+                      help='tar or dir [tar if OUTPUT ends in .tar, else dir]')
+    parser.add_option('-p', '--prefix',
+                      help='only export keys starting with PREFIX')
+    parser.add_option('--resume', action='store_true', default=False,
+                      help='carry on from the checkpoint of an interrupted export')
+    parser.add_option('--checkpoint',
+                      help='checkpoint file [OUTPUT.checkpoint]')
+    parser.add_option('--block-size', type='int', default=BLOCK_SIZE,
+                      help='bytes requested from storage nodes at once [%default]')
+    options, args = parser.parse_args(argv)
+    check_client_options(parser, options)
+    if not options.output:
+        parser.error('--output is required')
+
+    output = options.output.rstrip(os.sep) or options.output
+    format = options.format or (output.endswith('.tar') and 'tar' or 'dir')
+    checkpoint = Checkpoint(options.checkpoint or '%s.checkpoint' % output)
+
+    state = None
+    if options.resume:
+        state = checkpoint.load()
+        if state is not None and state.get('prefix') != options.prefix:
+            parser.error('the checkpoint is for prefix %r' % state.get('prefix'))
+    if format == 'tar':
+        sink = TarSink(output, options.block_size, state)
+    else:
+        sink = DirectorySink(output, options.block_size, state)
+
+    progress = Progress(quiet=options.quiet)
+    exporter = Exporter(lambda: make_client(options), sink,
+                        workers=options.workers,
+                        prefix=options.prefix,
+                        after=state and urllib.unquote(str(state['after'])) or None,
+                        progress=progress,
+                        checkpoint=checkpoint,
+                        retry=[urllib.unquote(str(key)) for key in (state or {}).get('failed', [])])
+    ok = exporter.run()
+    progress.report(final=True)
+    if exporter.error is not None:
+        print >>sys.stderr, 'export stopped: %s' % exporter.error
+        return 2
+    if exporter.failed:
+        print >>sys.stderr, '%d keys failed, --resume tries them again' % len(exporter.failed)
+    return not ok and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Uploads a directory tree, or the files listed in a manifest, to a domain.
+
+    mogilefs-import -t tracker:7001 -d domain -r backup/
+    mogilefs-import -t tracker:7001 -d domain -m manifest.txt --resume
+
+Keys are the paths relative to the root, %-unquoted as written by
+mogilefs-export.  A manifest has one file per line: the path, then
+optionally a tab and the key, and another tab and the class.  Keys which
+already exist with the same size are skipped; files are uploaded by a
+pool of workers and progress is checkpointed so an interrupted import
+can carry on with --resume.
+"""
+import os
+import sys
+import mmap
+import time
+import socket
+import httplib
+import logging
+import threading
+from Queue import Queue
+from optparse import OptionParser
+
+from mogilefs.exceptions import MogileFSError
+from mogilefs.tools.common import add_client_options, check_client_options, make_client, \
+     path_to_key, Checkpoint, Progress
+
+logger = logging
+
+def walk_directory(root, key_prefix='', cls=None):
+    """
+    (path, key, class) of every file below root, in a stable order.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if not os.path.isfile(path):
+                continue
+            relpath = os.path.relpath(path, root).replace(os.sep, '/')
+            yield path, key_prefix + path_to_key(relpath), cls
+
+def read_manifest(fp, root=None, key_prefix='', cls=None):
+    """
+    (path, key, class) for every line of a manifest.  Relative paths are
+    taken from root; keys which aren't given are made from the path as
+    walk_directory does.
+    """
+    for line in fp:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        relpath = fields[0]
+        if len(fields) > 1 and fields[1]:
+            key = fields[1]
+        else:
+            key = key_prefix + path_to_key(relpath.replace(os.sep, '/'))
+        if len(fields) > 2 and fields[2]:
+            file_cls = fields[2]
+        else:
+            file_cls = cls
+        if root is not None:
+            path = os.path.join(root, relpath)
+        else:
+            path = relpath
+        yield path, key, file_cls
+
+def upload_file(client, path, key, cls=None):
+    """
+    Stores the file at path to key in a single PUT; returns the number of
+    bytes stored.  The file is mapped into memory and handed to the socket
+    as it is, so its content is never copied into strings.
+    """
+    fp = open(path, 'rb')
+    try:
+        size = os.fstat(fp.fileno()).st_size
+        out = client.new_file(key, cls)
+        try:
+            if size:
+                mm = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    out.put(buffer(mm))
+                finally:
+                    mm.close()
+            else:
+                out.put('')
+        except:
+            # so an unclosed file doesn't store what it has when dropped
+            out.abort()
+            raise
+        return size
+    finally:
+        fp.close()
+
+class Importer(object):
+    """
+    Uploads (path, key, class) entries with a pool of workers.  The
+    checkpoint records how many entries, in the order given, have all
+    been dealt with.
+    """
+    def __init__(self, client_factory, entries, workers=8, skip_existing=True, retries=2,
+                 retry_delay=0.5, skip=0, progress=None,
+                 checkpoint=None, checkpoint_interval=5.0):
+        self.client_factory = client_factory
+        self.entries     = entries
+        self.workers     = workers
+        self.skip_existing = skip_existing
+        self.retries     = retries
+        self.retry_delay = retry_delay
+        self.skip        = skip
+        self.progress    = progress or Progress(quiet=True)
+        self.checkpoint  = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.failed      = []
+        self.error       = None
+
+    def run(self):
+        """
+        Returns True if every file was stored or skipped; the entries of
+        the others are kept in `failed`.  A failure to read the entries,
+        or of a worker as a whole, stops the import and is kept in
+        `error`.
+        """
+        jobs    = Queue(self.workers * 4)
+        results = Queue()
+
+        feeder = threading.Thread(target=self._feed, args=(jobs,))
+        feeder.setDaemon(True)
+        feeder.start()
+        for x in xrange(self.workers):
+            worker = threading.Thread(target=self._work, args=(jobs, results))
+            worker.setDaemon(True)
+            worker.start()
+
+        self._collect(results)
+        if self.checkpoint is not None and self.error is None:
+            self.checkpoint.remove()
+        return self.error is None and not self.failed
+
+    def _feed(self, jobs):
+        try:
+            try:
+                for seq, entry in enumerate(self.entries):
+                    if seq >= self.skip:
+                        jobs.put((seq, entry))
+            except Exception, e:
+                logger.error("reading the files to import failed: %s" % e)
+                self.error = e
+        finally:
+            for x in xrange(self.workers):
+                jobs.put(None)
+
+    def _work(self, jobs, results):
+        # whatever happens, the collecting thread must hear that this
+        # worker is done
+        try:
+            try:
+                client = self.client_factory()
+            except Exception, e:
+                logger.error("import worker failed: %s" % e)
+                self.error = self.error or e
+                # keep the feeder from blocking on a full queue; what
+                # isn't imported stays after the checkpoint
+                while jobs.get() is not None:
+                    pass
+                return
+
+            while 1:
+                job = jobs.get()
+                if job is None:
+                    return
+                seq, entry = job
+                try:
+                    stored = self._store(client, entry)
+                except Exception, e:
+                    stored = None, e
+                results.put((seq, entry) + stored)
+        finally:
+            results.put(None)
+
+    def _store(self, client, entry):
+        """
+        Returns (bytes stored or None if skipped, error).
+        """
+        path, key, cls = entry
+        attempt = 0
+        while 1:
+            try:
+                if self.skip_existing:
+                    info = client.file_info(key)
+                    if info is not None and info['length'] == os.path.getsize(path):
+                        return None, None
+                return upload_file(client, path, key, cls), None
+            except (MogileFSError, socket.error, httplib.HTTPException), e:
+                if attempt >= self.retries:
+                    return None, e
+            except (IOError, OSError), e:
+                # the local file is unreadable, trying again won't help
+                return None, e
+            attempt += 1
+            logger.debug("storing %s failed, retrying: %s" % (key, e))
+            time.sleep(self.retry_delay * attempt)
+
+    def _collect(self, results):
+        running  = self.workers
+        finished = set()
+        done     = self.skip
+        saved_at = time.time()
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+                continue
+            seq, entry, nbytes, error = item
+            if error is not None:
+                self.progress.fail(entry[0], error)
+                self.failed.append(entry)
+            elif nbytes is None:
+                self.progress.skip()
+            else:
+                self.progress.done(nbytes)
+
+            finished.add(seq)
+            while done in finished:
+                finished.remove(done)
+                done += 1
+
+            if self.checkpoint is not None and time.time() - saved_at >= self.checkpoint_interval:
+                self.checkpoint.save({ 'done': done })
+                saved_at = time.time()
+
+        if self.error is not None and self.checkpoint is not None:
+            self.checkpoint.save({ 'done': done })
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog -d DOMAIN (-r ROOT | -m MANIFEST) [options]')
+    add_client_options(parser)
+    parser.add_option('-r', '--root',
+                      help='directory to upload, or the one manifest paths are relative to')
+    parser.add_option('-m', '--manifest',
+                      help='file listing what to upload, - for stdin')
+    parser.add_option('-c', '--class', dest='cls',
+                      help='class of the files, unless the manifest says otherwise')
+    parser.add_option('-p', '--key-prefix', default='',
+                      help='prepended to keys made from paths')
+    parser.add_option('--overwrite', action='store_true', default=False,
+                      help="upload keys which already exist with the same size too")
+    parser.add_option('--retries', type='int', default=2,
+                      help='attempts after the first for each file [%default]')
+    parser.add_option('--resume', action='store_true', default=False,
+                      help='carry on from the checkpoint of an interrupted import')
+    parser.add_option('--checkpoint',
+                      help='checkpoint file [MANIFEST.checkpoint or ROOT.checkpoint]')
+    parser.add_option('--failures',
+                      help='write a manifest of the files which failed, with the paths as opened, to FAILURES')
+    options, args = parser.parse_args(argv)
+    check_client_options(parser, options)
+    if not options.root and not options.manifest:
+        parser.error('--root or --manifest is required')
+
+    if options.manifest:
+        if options.manifest == '-':
+            manifest = sys.stdin
+        else:
+            manifest = open(options.manifest, 'rb')
+        entries = read_manifest(manifest, options.root, options.key_prefix, options.cls)
+        source = options.manifest
+    else:
+        root = options.root.rstrip(os.sep) or options.root
+        entries = walk_directory(root, options.key_prefix, options.cls)
+        source = root
+
+    checkpoint = None
+    if options.checkpoint or source != '-':
+        checkpoint = Checkpoint(options.checkpoint or '%s.checkpoint' % source)
+    skip = 0
+    if options.resume and checkpoint is not None:
+        state = checkpoint.load()
+        if state is not None:
+            skip = state['done']
+
+    progress = Progress(quiet=options.quiet)
+    importer = Importer(lambda: make_client(options), entries,
+                        workers=options.workers,
+                        skip_existing=not options.overwrite,
+                        retries=options.retries,
+                        skip=skip,
+                        progress=progress,
+                        checkpoint=checkpoint)
+    ok = importer.run()
+    progress.report(final=True)
+    if importer.error is not None:
+        print >>sys.stderr, 'import stopped: %s' % importer.error
+
+    if options.failures and importer.failed:
+        out = open(options.failures, 'wb')
+        try:
+            for path, key, cls in importer.failed:
+                print >>out, '\t'.join([path, key, cls or ''])
+        finally:
+            out.close()
+    if importer.error is not None:
+        return 2
+    return not ok and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+import logging
+import threading
+from collections import namedtuple
+
+from mogilefs.admin import _parse_hosts, _parse_devices
+
+logger = logging
+
+Host = namedtuple('Host', 'hostid hostname hostip http_port http_get_port status')
+Device = namedtuple('Device', 'devid hostid status observed_state weight mb_total mb_used utilization')
+
+_DEVID_RE = re.compile(r'/dev(\d+)/')
+
+def path_devid(path):
+    """
+    The devid a storage path lives on, from its /devN/ component, or None.
+    """
+    m = _DEVID_RE.search(path)
+    if m is None:
+        return None
+    return int(m.group(1))
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class _Snapshot(object):
+    """
+    Everything a refresh produces, swapped in with a single assignment so
+    readers never see half an update.
+    """
+    __slots__ = ('hosts', 'devices', 'by_status', 'by_host', 'structure')
+
+    def __init__(self, hosts, devices, by_status, by_host, structure):
+        self.hosts     = hosts
+        self.devices   = devices
+        self.by_status = by_status
+        self.by_host   = by_host
+        self.structure = structure
+
+_EMPTY = _Snapshot({}, {}, {}, {}, None)
+
+class Topology(object):
+    """
+    A cached copy of the cluster's hosts and devices, answering lookups
+    without talking to the tracker.
+
+    refresh() fetches get_hosts and get_devices.  If the responses are
+    the same as last time nothing is rebuilt; if only utilization and
+    space usage moved the indexes by status and by host are kept.  With
+    an interval, start() refreshes from a background thread.
+    """
+    def __init__(self, admin, interval=None):
+        self.admin    = admin
+        self.interval = interval
+        self.refreshed_at = None
+        self.rebuilds = 0
+        self._snapshot  = _EMPTY
+        self._signature = None
+        self._lock      = threading.Lock()
+        self._stopped   = threading.Event()
+        self._thread    = None
+
+    def refresh(self):
+        """
+        Returns True if anything changed.
+        """
+        backend = self.admin.backend
+        hosts_res   = backend.do_request('get_hosts')
+        devices_res = backend.do_request('get_devices')
+
+        self._lock.acquire()
+        try:
+            self.refreshed_at = time.time()
+            signature = (frozenset(hosts_res.items()), frozenset(devices_res.items()))
+            if signature == self._signature:
+                return False
+            self._signature = signature
+            self._snapshot = self._build(hosts_res, devices_res, self._snapshot)
+            return True
+        finally:
+            self._lock.release()
+
+    def _build(self, hosts_res, devices_res, previous):
+        hosts = {}
+        for row in _parse_hosts(hosts_res):
+            host = Host(row['hostid'], row['hostname'], row['hostip'],
+                        row['http_port'], row['http_get_port'], row['status'])
+            hosts[host.hostid] = host
+
+        devices = {}
+        for row in _parse_devices(devices_res):
+            device = Device(_int(row['devid']), _int(row['hostid']), row['status'],
+                            row['observed_state'], row['weight'], row['mb_total'],
+                            row['mb_used'], _float(row['utilization']))
+            devices[device.devid] = device
+
+        structure = (frozenset(hosts.values()),
+                     frozenset([(d.devid, d.hostid, d.status, d.observed_state)
+                                for d in devices.values()]))
+        if structure == previous.structure:
+            return _Snapshot(hosts, devices, previous.by_status, previous.by_host, structure)
+
+        self.rebuilds += 1
+        by_status = {}
+        by_host   = {}
+        for devid in sorted(devices):
+            device = devices[devid]
+            by_status.setdefault(device.status, []).append(devid)
+            by_host.setdefault(device.hostid, []).append(devid)
+        for index in (by_status, by_host):
+            for k, v in index.items():
+                index[k] = tuple(v)
+        return _Snapshot(hosts, devices, by_status, by_host, structure)
+
+    def start(self):
+        """
+        Refresh now, then every `interval` seconds in a daemon thread.
+        """
+        if self.interval is None:
+            raise ValueError("no refresh interval given")
+        if self._thread is not None:
+            return
+        self.refresh()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='mogilefs-topology')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while 1:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                break
+            try:
+                self.refresh()
+            except Exception, e:
+                logger.warning("failed to refresh cluster topology: %s" % e)
+
+    def age(self):
+        """
+        Seconds since the last refresh, or None if there hasn't been one.
+        """
+        if self.refreshed_at is None:
+            return None
+        return time.time() - self.refreshed_at
+
+    def host(self, hostid):
+        return self._snapshot.hosts.get(hostid)
+
+    def hosts(self):
+        snapshot = self._snapshot
+        return [snapshot.hosts[k] for k in sorted(snapshot.hosts)]
+
+    def device(self, devid):
+        return self._snapshot.devices.get(devid)
+
+    def devices(self, status=None, hostid=None):
+        """
+        Devices, optionally only those with the given status and/or on
+        the given host, ordered by devid.
+        """
+        snapshot = self._snapshot
+        if status is None and hostid is None:
+            devids = sorted(snapshot.devices)
+        elif hostid is None:
+            devids = snapshot.by_status.get(status, ())
+        elif status is None:
+            devids = snapshot.by_host.get(hostid, ())
+        else:
+            devids = [devid for devid in snapshot.by_host.get(hostid, ())
+                      if snapshot.devices[devid].status == status]
+        return [snapshot.devices[devid] for devid in devids]
+
+    def device_host(self, devid):
+        snapshot = self._snapshot
+        device = snapshot.devices.get(devid)
+        if device is None:
+            return None
+        return snapshot.hosts.get(device.hostid)
+
+    def utilization(self, devid):
+        device = self._snapshot.devices.get(devid)
+        if device is None:
+            return None
+        return device.utilization
+
+class DeviceReadPolicy(object):
+    """
+    Orders the replicas of a file for reading using a Topology: paths on
+    devices which are dead, down, draining or unreachable go last, the
+    rest are ordered by utilization in steps of `granularity` percent so
+    that small differences leave the order as it was.  Paths on devices
+    the topology doesn't know keep their place among the usable ones.
+
+    Set as Client.read_policy; keep the topology fresh with start().
+    """
+    SKIP_STATUS = ('dead', 'down', 'drain')
+    SKIP_OBSERVED = ('unreachable',)
+
+    def __init__(self, topology, granularity=10.0):
+        self.topology    = topology
+        self.granularity = granularity
+
+    def _rank(self, path):
+        """
+        (skip, utilization step), or None for a device the topology
+        doesn't know.
+        """
+        device = self.topology.device(path_devid(path))
+        if device is None:
+            return None
+        if device.status in self.SKIP_STATUS or device.observed_state in self.SKIP_OBSERVED:
+            return (True, 0)
+        if device.utilization is None:
+            return (False, 0)
+        return (False, int(device.utilization // self.granularity))
+
+    def sort_paths(self, paths):
+        if len(paths) < 2:
+            return list(paths)
+        ranks = [(self._rank(path), path) for path in paths]
+        skipped = [path for rank, path in ranks if rank is not None and rank[0]]
+        usable  = [(rank, path) for rank, path in ranks if rank is None or not rank[0]]
+
+        # the known devices are sorted into the slots they hold, unknown
+        # ones stay where they are
+        known = iter(sorted([(rank, idx, path) for idx, (rank, path) in enumerate(usable)
+                             if rank is not None]))
+        ordered = []
+        for rank, path in usable:
+            if rank is None:
+                ordered.append(path)
+            else:
+                ordered.append(known.next()[2])
+        return ordered + skipped
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import time
+import socket
+import httplib
+import logging
+import threading
+from Queue import Queue
+
+from mogilefs.exceptions import MogileFSError, MogileFSTrackerError, UploadQueueFull
+
+logger = logging
+
+class UploadFuture(object):
+    """
+    The pending result of a WriteBehindUploader.submit() call.  result()
+    returns the number of bytes stored, or raises the error the last
+    attempt failed with.
+    """
+    def __init__(self, key, size):
+        self.key  = key
+        self.size = size
+        self.attempts = 0
+        self._done      = threading.Event()
+        self._result    = None
+        self._exception = None
+        self._callbacks = []
+        self._lock      = threading.Lock()
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        callback(future) is called from the worker thread once the upload
+        has finished, or right away if it already has.
+        """
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        self._run_callback(callback)
+
+    def _wait(self, timeout):
+        self._done.wait(timeout)
+        if not self.done():
+            raise MogileFSError("upload of %s didn't finish in %s seconds" % (self.key, timeout))
+
+    def _set(self, result=None, exception=None):
+        self._lock.acquire()
+        try:
+            self._result    = result
+            self._exception = exception
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            logger.exception("upload callback for %s failed: %s" % (self.key, e))
+
+class WriteBehindUploader(object):
+    """
+    Stores content in MogileFS in the background.  submit() queues
+    (key, data, cls) and returns at once; a pool of worker threads drains
+    the queue through Client.store_content().
+
+    At most max_bytes of content is held in the queue.  When the budget
+    is exhausted submit() either blocks until workers catch up or, with
+    block=False, raises UploadQueueFull.  A failed upload is retried up to
+    `retries` times; every attempt asks the tracker for fresh
+    destinations and tries each replica in turn.
+    """
+    def __init__(self, client, workers=4, max_bytes=64 * 1024 * 1024,
+                 block=True, retries=2, retry_delay=0.5):
+        self.client      = client
+        self.max_bytes   = max_bytes
+        self.block       = block
+        self.retries     = retries
+        self.retry_delay = retry_delay
+
+        self._queue   = Queue()
+        self._cond    = threading.Condition()
+        self._bytes   = 0
+        self._pending = 0
+        self._closed  = False
+        self._workers = []
+        for x in xrange(workers):
+            worker = threading.Thread(target=self._work,
+                                      name='mogilefs-uploader-%d' % x)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._pending
+
+    def pending_bytes(self):
+        return self._bytes
+
+    def submit(self, key, data, cls=None, callback=None, block=None, timeout=None):
+        """
+        Queue data to be stored under key.  Returns an UploadFuture;
+        callback, if given, is added to it as a done callback.
+        """
+        if block is None:
+            block = self.block
+        size = len(data)
+
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise ValueError("operation on closed uploader")
+
+            deadline = timeout is not None and time.time() + timeout or None
+            # an item larger than the whole budget is let through once the
+            # queue has drained, otherwise it could never be stored
+            while self._bytes and self._bytes + size > self.max_bytes:
+                if not block:
+                    raise UploadQueueFull("upload queue is full (%d bytes pending)" % self._bytes)
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise UploadQueueFull("upload queue is full (%d bytes pending)" % self._bytes)
+                    self._cond.wait(remaining)
+
+            self._bytes   += size
+            self._pending += 1
+
+            future = UploadFuture(key, size)
+            if callback is not None:
+                future.add_done_callback(callback)
+            # while holding the lock, so close() can't queue the workers'
+            # stop sentinels ahead of the item
+            self._queue.put((future, data, cls))
+            return future
+        finally:
+            self._cond.release()
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything submitted so far has been stored or has
+        failed.  Returns False if timeout expired first.
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        self._cond.acquire()
+        try:
+            while self._pending:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+        finally:
+            self._cond.release()
+
+    def close(self, wait=True):
+        """
+        Stop accepting uploads and shut the workers down, after draining
+        the queue if wait is true.
+        """
+        self._cond.acquire()
+        try:
+            if self._closed:
+                return
+            self._closed = True
+        finally:
+            self._cond.release()
+
+        for worker in self._workers:
+            self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _work(self):
+        while 1:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            future, data, cls = item
+            try:
+                result = self._store(future, data, cls)
+            except Exception, e:
+                logger.debug("giving up on %s after %d attempts: %s" % (future.key, future.attempts, e))
+                future._set(exception=e)
+            else:
+                future._set(result=result)
+
+            self._cond.acquire()
+            try:
+                self._bytes   -= future.size
+                self._pending -= 1
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def _store(self, future, data, cls):
+        while 1:
+            future.attempts += 1
+            try:
+                return self.client.store_content(future.key, data, cls)
+            except (MogileFSError, socket.error, httplib.HTTPException), e:
+                # errors reported by the tracker itself (unknown domain or
+                # class, ...) won't go away by trying again
+                if isinstance(e, MogileFSTrackerError) and e.err:
+                    raise
+                if future.attempts > self.retries:
+                    raise
+                logger.debug("upload of %s failed, retrying: %s" % (future.key, e))
+                time.sleep(self.retry_delay * (2 ** (future.attempts - 1)))
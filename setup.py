@@ -20,7 +20,7 @@ setup(name='mogilefs',
       author_email='csakatoku@gmail.com',
       #url='',
       license='GPL',
-      packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+      packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'benchmarks']),
       include_package_data=True,
       zip_safe=False,
       install_requires=[
@@ -28,6 +28,9 @@ setup(name='mogilefs',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      mogilefs-export = mogilefs.tools.export:main
+      mogilefs-import = mogilefs.tools.importer:main
       """,
       test_suite='nose.collector'
       )
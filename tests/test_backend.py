@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import os
+import socket
 from mogilefs.backend import Backend
 from mogilefs.exceptions import MogileFSError
 
@@ -36,3 +38,63 @@ def test_do_request_with_no_cmd():
     else:
         assert False
 
+
+def test_discard_socket_after_fork():
+    backend = get_backend()
+    sock, peer = socket.socketpair()
+    backend._sock_cache = sock
+    backend._pid = -1
+    backend._check_pid()
+    assert backend._sock_cache is None
+    assert backend._pid == os.getpid()
+    peer.close()
+
+def test_decode_url_string():
+    from cgi import parse_qs
+    from mogilefs.backend import _decode_url_string
+    for arg in ['', 'key_count=0', 'a=1&b=%2Fx+y&c=&d=q&d=r&e%20f=1&x',
+                'a=%41%2B', 'a=%26b%3d&c=%3D', 'a=%2520']:
+        expected = dict([(k, v[0]) for k, v in parse_qs(arg).items()])
+        assert _decode_url_string(arg) == expected, arg
+
+def test_decode_pairs():
+    from cgi import parse_qsl
+    from mogilefs.backend import _decode_pairs
+    for arg in ['', 'key_count=0', 'a=1&b=%2Fx+y&c=&d=q&d=r&e%20f=1&x',
+                'a=%41%2B', 'a=%26b%3d&c=%3D', 'a=%2520']:
+        assert _decode_pairs(arg) == parse_qsl(arg), arg
+
+def test_do_request_iter():
+    from benchmarks.bench_backend import CannedTracker, canned_response
+    tracker = CannedTracker(canned_response(10000)).start()
+    try:
+        backend = Backend([tracker.address])
+        pairs = list(backend.do_request_iter('list_keys'))
+        assert len(pairs) == 10001
+        assert dict(pairs) == backend.do_request('list_keys')
+
+        # stopping early discards the connection, which is then replaced
+        pairs = backend.do_request_iter('list_keys')
+        pairs.next()
+        pairs.close()
+        assert backend._sock_cache is None
+        assert len(list(backend.do_request_iter('list_keys'))) == 10001
+    finally:
+        tracker.stop()
+
+def test_do_request_iter_error():
+    from benchmarks.bench_backend import CannedTracker
+    for response in ['ERR unknown_key unknown_key\r\n', 'OK 1 \r\n', 'OK\r\n']:
+        tracker = CannedTracker(response).start()
+        try:
+            backend = Backend([tracker.address])
+            try:
+                pairs = list(backend.do_request_iter('get_paths'))
+            except MogileFSError, e:
+                assert e.err == 'unknown_key'
+            else:
+                assert pairs == []
+            # still in step with the tracker
+            assert backend._sock_cache is not None
+        finally:
+            tracker.stop()
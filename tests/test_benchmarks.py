@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from cStringIO import StringIO
+from mogilefs import Client, Admin
+from benchmarks.fakes import Cluster
+from benchmarks.bench_client import benchmark, percentile
+
+def test_percentile():
+    samples = range(1, 101)
+    assert percentile(samples, 50) == 51
+    assert percentile(samples, 100) == 100
+    assert percentile([], 99) == 0.0
+
+def test_benchmark_against_fake_cluster():
+    cluster = Cluster(nodes=2).start()
+    try:
+        Admin(cluster.hosts).create_domain('benchmark')
+        client = Client('benchmark', cluster.hosts)
+        results = benchmark(client, iterations=10, size=100, threads=2, out=StringIO())
+        assert [r.name for r in results] == ['store_content', 'store_file', 'get_paths',
+                                             'get_file_data', 'list_keys']
+        for result in results:
+            assert not result.errors, result.name
+            assert len(result.samples) == 10
+    finally:
+        cluster.stop()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from mogilefs import Admin
+from mogilefs.backend import Backend
+from mogilefs.exceptions import MogileFSTrackerError
+from benchmarks.fakes import Cluster
+
+cluster = None
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=2).start()
+
+def teardown():
+    cluster.stop()
+
+def test_do_pipeline():
+    backend = Backend(cluster.hosts)
+    requests = [('sleep', { 'duration': 0 }),
+                ('get_hosts', None),
+                ('no_such_command', None),
+                ('get_devices', None)]
+    ret = backend.do_pipeline(requests * 3, window=5)
+    assert len(ret) == 12
+    for x in (0, 4, 8):
+        assert ret[x + 1]['hosts'] == '2'
+        assert isinstance(ret[x + 2], MogileFSTrackerError)
+        assert ret[x + 3]['devices'] == '4'
+
+    # the connection is still usable
+    assert backend.do_request('get_hosts')['hosts'] == '2'
+    assert backend.do_pipeline([]) == []
+
+def test_pipeline_reconnects():
+    backend = Backend(cluster.hosts)
+    backend.warmup()
+    backend._sock_cache.close()
+    assert backend.do_pipeline([('get_hosts', None)])[0]['hosts'] == '2'
+
+def test_pipeline_cut_short():
+    backend = Backend(cluster.hosts)
+    cluster.tracker.drop_after = 3
+    try:
+        ret = backend.do_pipeline([('get_hosts', None)] * 8, window=5)
+    finally:
+        cluster.tracker.drop_after = None
+    assert len(ret) == 8
+    for res in ret[:3]:
+        assert res['hosts'] == '2'
+    for res in ret[3:]:
+        assert isinstance(res, MogileFSTrackerError) and res.err is None
+    assert ret[3] is ret[7]
+    # and the next call gets a fresh connection
+    assert backend.do_request('get_hosts')['hosts'] == '2'
+
+def test_set_device_states_cut_short():
+    devices = cluster.tracker.devices
+    try:
+        # get_devices and get_hosts, then two of the four updates
+        cluster.tracker.drop_after = 4
+        ret = Admin(cluster.hosts).set_device_states(dict([(devid, 'drain') for devid in devices]))
+        done = sorted([devid for devid, res in ret.items() if res is None])
+        assert len(done) == 2
+        assert sorted([devid for devid in devices if devices[devid]['status'] == 'drain']) == done
+        for devid, res in ret.items():
+            if devid not in done:
+                assert res.err is None
+    finally:
+        cluster.tracker.drop_after = None
+        for device in devices.values():
+            device['status'] = 'alive'
+
+def test_set_device_states():
+    devices = cluster.tracker.devices
+    try:
+        ret = Admin(cluster.hosts).set_device_states({ 1: 'drain', 3: 'down', 99: 'dead' })
+        assert ret[1] is None and ret[3] is None
+        assert ret[99].err == 'no_device'
+        assert devices[1]['status'] == 'drain'
+        assert devices[3]['status'] == 'down'
+        assert devices[2]['status'] == 'alive'
+    finally:
+        for device in devices.values():
+            device['status'] = 'alive'
+
+def test_set_device_weights():
+    moga = Admin(cluster.hosts)
+    try:
+        moga.set_device_weights({ 1: '10' })
+    except ValueError:
+        pass
+    else:
+        assert False, "a weight which isn't an int was accepted"
+
+    assert moga.set_device_weights({ 2: 10, 4: 20 }) == { 2: None, 4: None }
+    assert cluster.tracker.devices[4]['weight'] == 20
+
+def test_update_hosts():
+    ret = Admin(cluster.hosts).update_hosts({ 'host1': { 'status': 'down' },
+                                              'host2': { 'port': 7600 } })
+    assert ret == { 'host1': None, 'host2': None }
+    assert cluster.tracker.commands.count('update_host') == 2
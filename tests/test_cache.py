@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from mogilefs import Client, Admin
+from mogilefs.cache import NegativeCache, RecentWrites, SingleFlight
+from benchmarks.fakes import Cluster
+
+cluster = None
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=1).start()
+    Admin(cluster.hosts).create_domain('cache')
+
+def teardown():
+    cluster.stop()
+
+def test_negative_cache():
+    cache = NegativeCache(ttl=0.05, max_size=2)
+    cache.add('a')
+    assert 'a' in cache
+    assert 'b' not in cache
+    time.sleep(0.06)
+    assert 'a' not in cache
+    assert len(cache) == 0
+
+    cache.add('a')
+    cache.add('b')
+    cache.add('c')
+    assert 'a' not in cache
+    assert 'b' in cache and 'c' in cache
+    cache.discard('b')
+    assert 'b' not in cache
+    assert cache.hits == 3
+
+def get_paths_calls():
+    return cluster.tracker.commands.count('get_paths')
+
+def test_client_negative_cache():
+    client = Client('cache', cluster.hosts)
+    client.negative_cache = NegativeCache(ttl=60)
+
+    calls = get_paths_calls()
+    assert client.get_paths('missing') == []
+    assert client.get_paths('missing') == []
+    assert get_paths_calls() == calls + 1
+
+    client.store_content('missing', 'data')
+    assert len(client.get_paths('missing')) == 1
+
+    client.delete('missing')
+    calls = get_paths_calls()
+    assert client.get_paths('missing') == []
+    assert get_paths_calls() == calls
+
+    client.store_content('other', 'data')
+    client.rename('other', 'missing')
+    assert len(client.get_paths('missing')) == 1
+
+def test_lookup_racing_an_upload():
+    client = Client('cache', cluster.hosts)
+    client.negative_cache = NegativeCache(ttl=60)
+    fp = client.new_file('racing')
+    fp.write('data')
+    assert client.get_paths('racing') == []
+    fp.close()
+    assert len(client.get_paths('racing')) == 1
+
+def test_recent_writes():
+    writes = RecentWrites(ttl=0.05, max_size=2)
+    writes.add('a', ['http://node/dev1/a.fid'])
+    assert writes.get('a') == ['http://node/dev1/a.fid']
+    assert writes.get('b') is None
+    time.sleep(0.06)
+    assert writes.get('a') is None
+
+    writes.add('a', ['pa'])
+    writes.add('b', ['pb'])
+    writes.add('c', ['pc'])
+    assert writes.get('a') is None
+    writes.move('b', 'd')
+    assert writes.get('b') is None
+    assert writes.get('d') == ['pb']
+    assert writes.discard('d')
+    assert not writes.discard('d')
+    assert writes.hits == 2
+
+def test_client_recent_writes():
+    client = Client('cache', cluster.hosts)
+    client.recent_writes = RecentWrites(ttl=60)
+    client.store_content('written', 'data')
+
+    calls = get_paths_calls()
+    paths = client.get_paths('written')
+    assert len(paths) == 1
+    assert client.get_file_data('written') == 'data'
+    assert get_paths_calls() == calls
+
+    client.rename('written', 'renamed')
+    assert client.get_file_data('renamed') == 'data'
+    assert get_paths_calls() == calls
+
+    # a path which no longer works sends the read to the tracker
+    client.recent_writes.add('renamed', [paths[0].replace('.fid', '.gone.fid')])
+    assert client.get_file_data('renamed') == 'data'
+    assert get_paths_calls() == calls + 1
+    assert client.recent_writes.get('renamed') is None
+
+    client.delete('renamed')
+    assert client.get_paths('renamed') == []
+
+def run_concurrently(func, count=10):
+    results = []
+    def run():
+        try:
+            results.append(func())
+        except Exception, e:
+            results.append(e)
+    threads = [threading.Thread(target=run) for x in xrange(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+    def slow(value):
+        calls.append(value)
+        time.sleep(0.1)
+        if value == 'error':
+            raise ValueError(value)
+        return value
+
+    results = run_concurrently(lambda: flight.do('key', slow, 'result'))
+    assert results == ['result'] * 10
+    assert len(calls) + flight.shared == 10
+    assert len(calls) < 10
+
+    results = run_concurrently(lambda: flight.do('key', slow, 'error'))
+    assert [type(r) for r in results] == [ValueError] * 10
+
+    # nothing is cached once the call is over
+    assert flight.do('key', lambda: 'again') == 'again'
+
+def test_client_single_flight():
+    client = Client('cache', cluster.hosts)
+    client.store_content('hot', 'data')
+    client.single_flight = SingleFlight()
+
+    cluster.tracker.faults.latency = 0.1
+    try:
+        calls = get_paths_calls()
+        results = run_concurrently(lambda: client.get_paths('hot'))
+        assert get_paths_calls() - calls < 10
+        assert len(set(map(tuple, results))) == 1
+        assert results[0] is not results[1]
+
+        calls = get_paths_calls()
+        results = run_concurrently(lambda: client.get_file_data('hot', coalesce=True))
+        assert results == ['data'] * 10
+        assert get_paths_calls() - calls < 10
+    finally:
+        cluster.tracker.faults.latency = 0
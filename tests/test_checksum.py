@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from cStringIO import StringIO
+from mogilefs import Client, Admin
+from mogilefs.exceptions import ChecksumMismatch
+from benchmarks.fakes import Cluster
+
+cluster = None
+data = ''.join([chr(x % 251) for x in xrange(200000)])
+digest = hashlib.md5(data).hexdigest()
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=2).start()
+    Admin(cluster.hosts).create_domain('checksum')
+
+def teardown():
+    cluster.stop()
+
+def test_new_file_checksum():
+    client = Client('checksum', cluster.hosts)
+    for opts in ({}, { 'largefile': True }, { 'streaming': True }):
+        fp = client.new_file('new', checksum='md5', **opts)
+        for offset in xrange(0, len(data), 65536):
+            fp.write(data[offset:offset + 65536])
+        fp.close()
+        assert fp.checksum == digest, opts
+
+def test_store_returns_checksum():
+    client = Client('checksum', cluster.hosts)
+    assert client.store_content('content', data, checksum='md5') == (len(data), digest)
+    assert client.store_file('file', StringIO(data), checksum='sha1') == \
+           (len(data), hashlib.sha1(data).hexdigest())
+    # the byte count alone without a checksum asked for
+    assert client.store_content('content', data) == len(data)
+
+def test_send_checksum():
+    client = Client('checksum', cluster.hosts)
+    client.store_content('sent', data, checksum='md5', send_checksum=True)
+    assert cluster.tracker.files[('checksum', 'sent')]['checksum'] == 'MD5:%s' % digest
+
+    client.store_content('unsent', data, checksum='md5')
+    assert cluster.tracker.files[('checksum', 'unsent')]['checksum'] is None
+
+def test_expected_checksum():
+    client = Client('checksum', cluster.hosts)
+    client.store_content('expected', data)
+    assert client.get_file_data('expected', expected_checksum='MD5:%s' % digest) == data
+    try:
+        client.get_file_data('expected', expected_checksum='MD5:%s' % ('0' * 32))
+    except ChecksumMismatch:
+        pass
+    else:
+        assert False, "ChecksumMismatch expected"
+
+    # a file corrupted on the storage node
+    for storage in cluster.storages:
+        for path in storage.files:
+            if len(storage.files[path]) == len(data):
+                storage.files[path] = 'X' + storage.files[path][1:]
+    try:
+        client.get_file_data('expected', expected_checksum='MD5:%s' % digest)
+    except ChecksumMismatch:
+        pass
+    else:
+        assert False, "ChecksumMismatch expected"
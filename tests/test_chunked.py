@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import random
+from cStringIO import StringIO
+from mogilefs import Client, Admin
+from mogilefs.chunked import ChunkedWriter, ChunkedReader, store_chunked, delete_chunked, \
+     read_manifest, chunk_keys
+from mogilefs.exceptions import MogileFSError, MogileFSTrackerError
+from benchmarks.fakes import Cluster
+
+cluster = None
+data = ''.join([chr(x % 253) for x in xrange(300000)])
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=2).start()
+    Admin(cluster.hosts).create_domain('chunked')
+
+def teardown():
+    cluster.stop()
+
+def keys(client, prefix):
+    return list(client.iter_keys(prefix))
+
+def test_store_and_read():
+    client = Client('chunked', cluster.hosts)
+    assert store_chunked(client, 'big', StringIO(data), chunk_size=65536, workers=3) == len(data)
+
+    manifest = read_manifest(client, 'big')
+    assert manifest['length'] == len(data)
+    assert [length for length, digest in manifest['chunks']] == [65536] * 4 + [300000 - 4 * 65536]
+    assert sorted(keys(client, 'big')) == sorted(['big'] + chunk_keys('big', manifest))
+
+    fp = ChunkedReader(client, 'big')
+    assert fp.read() == data
+    fp.seek(70000)
+    assert fp.read(100000) == data[70000:170000]
+    assert fp.tell() == 170000
+    fp.seek(-10, 2)
+    assert fp.read(100) == data[-10:]
+    assert fp.read(100) == ''
+    fp.seek(5)
+    assert fp.read(10) == data[5:15]
+    fp.close()
+
+    # writes of any size are cut into the same chunks
+    with ChunkedWriter(client, 'big', chunk_size=65536) as writer:
+        for offset in xrange(0, len(data), 10000):
+            writer.write(data[offset:offset + 10000])
+    assert ChunkedReader(client, 'big').read() == data
+
+    # the chunks of the object replaced are gone
+    new = read_manifest(client, 'big')
+    assert new['upload_id'] != manifest['upload_id']
+    assert sorted(keys(client, 'big')) == sorted(['big'] + chunk_keys('big', new))
+
+    delete_chunked(client, 'big')
+    assert keys(client, 'big') == []
+
+def test_read_ahead_is_bounded():
+    client = Client('chunked', cluster.hosts)
+    chunk_size = 2 * 1024 * 1024
+    big = ''.join([chr(x % 251) * 4096 for x in xrange(24 * 1024 * 1024 / 4096)])
+    store_chunked(client, 'huge', StringIO(big), chunk_size=chunk_size, workers=4)
+
+    fp = ChunkedReader(client, 'huge', read_ahead=3)
+    for x in xrange(3):
+        fp.seek(0)
+        assert fp.read() == big
+        assert len(fp._threads) <= 4
+
+    # seeks drop the fetches ahead, which then don't hold the reads up
+    rand = random.Random(5)
+    for x in xrange(30):
+        offset = rand.randrange(len(big))
+        fp.seek(offset)
+        assert fp.read(100000) == big[offset:offset + 100000]
+        assert len(fp._threads) <= 4
+    workers = list(fp._threads)
+    fp.close()
+    for thread in workers:
+        thread.join(10)
+        assert not thread.isAlive()
+    delete_chunked(client, 'huge')
+
+def test_empty_object():
+    client = Client('chunked', cluster.hosts)
+    assert store_chunked(client, 'empty', StringIO('')) == 0
+    assert ChunkedReader(client, 'empty').read() == ''
+    delete_chunked(client, 'empty')
+
+def test_retry():
+    client = Client('chunked', cluster.hosts)
+    client.breakers = None
+    for storage in cluster.storages:
+        storage.faults.error_rate = 0.3
+    try:
+        store_chunked(client, 'flaky', StringIO(data), chunk_size=30000,
+                      retries=20, retry_delay=0)
+    finally:
+        for storage in cluster.storages:
+            storage.faults.error_rate = 0
+    assert ChunkedReader(client, 'flaky').read() == data
+
+def test_failure_cleans_up():
+    client = Client('chunked', cluster.hosts)
+    client.breakers = None
+    for storage in cluster.storages:
+        storage.faults.error_rate = 1.0
+    try:
+        try:
+            store_chunked(client, 'failed', StringIO(data), chunk_size=30000,
+                          retries=1, retry_delay=0)
+        except MogileFSError:
+            pass
+        else:
+            assert False
+    finally:
+        for storage in cluster.storages:
+            storage.faults.error_rate = 0
+    assert keys(client, 'failed') == []
+
+def test_not_chunked():
+    client = Client('chunked', cluster.hosts)
+    client.store_content('plain', 'not a manifest')
+    for func in (read_manifest, ChunkedReader):
+        try:
+            func(client, 'plain')
+        except MogileFSError:
+            pass
+        else:
+            assert False
+    try:
+        ChunkedReader(client, 'missing')
+    except MogileFSTrackerError, e:
+        assert e.err == 'unknown_key'
+    else:
+        assert False
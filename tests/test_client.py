@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import time
 import random
+import hashlib
 from cStringIO import StringIO
 from nose import with_setup
 from mogilefs import Client, Admin, MogileFSError
+from mogilefs.exceptions import ChecksumMismatch
 
 TEST_NS = "mogilefs.client::test_client"
 HOSTS   = ["127.0.0.1:7001"]
@@ -85,6 +87,25 @@ def test_new_large_file():
     content = client.get_file_data(key)
     assert content == "0123456789" * 50
 
+@with_setup(_setup, _teardown)
+def test_new_streaming_file():
+    client = Client(TEST_NS, HOSTS)
+
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    fp = client.new_file(key, streaming=True)
+    assert fp is not None
+
+    for x in xrange(50):
+        fp.write("0123456789")
+    assert fp.tell() == 500
+    fp.close()
+
+    paths = client.get_paths(key)
+    assert paths
+
+    content = client.get_file_data(key)
+    assert content == "0123456789" * 50
+
 @with_setup(_setup, _teardown)
 def test_new_file_unexisting_class():
     def func(largefile):
@@ -279,6 +300,30 @@ def test_store_content():
     content = client.get_file_data(key)
     assert content == data
 
+@with_setup(_setup, _teardown)
+def test_checksum():
+    def func(largefile):
+        client = Client(TEST_NS, HOSTS)
+        key = 'test_file_%s_%s' % (random.random(), time.time())
+
+        data = "0123456789" * 50
+        fp = client.new_file(key, largefile=largefile, checksum='md5')
+        fp.write(data)
+        fp.close()
+        assert fp.checksum == hashlib.md5(data).hexdigest()
+
+        expected = 'MD5:%s' % fp.checksum
+        assert client.get_file_data(key, expected_checksum=expected) == data
+        try:
+            client.get_file_data(key, expected_checksum='MD5:%s' % ('0' * 32))
+        except ChecksumMismatch:
+            pass
+        else:
+            assert False, "ChecksumMismatch expected"
+
+    for largefile in (False, True):
+        yield func, largefile
+
 @with_setup(_setup, _teardown)
 def test_read_file():
     client = Client(TEST_NS, HOSTS)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import threading
+from mogilefs import Admin
+from mogilefs.admin import FsckTally
+from benchmarks.fakes import Cluster
+
+cluster = None
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=1).start()
+
+def teardown():
+    cluster.stop()
+
+def add_rows(count, evcode='NOPA', devid=1):
+    log = cluster.tracker.fsck_log
+    for x in xrange(count):
+        log.append({ 'logid': len(log) + 1, 'utime': 1000, 'fid': len(log) + 10,
+                     'evcode': evcode, 'devid': devid })
+
+def test_follow_fsck_log():
+    del cluster.tracker.fsck_log[:]
+    add_rows(150)
+    add_rows(5, evcode='REPL', devid=2)
+
+    tally = FsckTally()
+    rows = list(Admin(cluster.hosts).follow_fsck_log(tally=tally, until_done=True))
+    assert [row.logid for row in rows] == range(1, 156)
+    assert rows[0].fid == 10 and rows[0].devid == 1
+    assert tally.total == 155
+    assert tally.evcodes == { 'NOPA': 150, 'REPL': 5 }
+    assert tally.devids == { 1: 150, 2: 5 }
+
+    rows = list(Admin(cluster.hosts).follow_fsck_log(after_logid=150, until_done=True))
+    assert [row.logid for row in rows] == range(151, 156)
+
+def test_follow_waits_for_new_rows():
+    del cluster.tracker.fsck_log[:]
+    add_rows(1)
+    rows = Admin(cluster.hosts).follow_fsck_log(min_interval=0.01, max_interval=0.05)
+    assert rows.next().logid == 1
+
+    timer = threading.Timer(0.2, add_rows, (1,))
+    timer.start()
+    assert rows.next().logid == 2
+    timer.join()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import time
+from mogilefs.health import LatencyTracker, CircuitBreaker, BreakerBoard, CLOSED, OPEN, HALF_OPEN
+
+PATHS = ["http://10.0.0.1:7500/dev1/0/000/000/0000000001.fid",
+         "http://10.0.0.2:7500/dev2/0/000/000/0000000001.fid",
+         "http://10.0.0.3:7500/dev3/0/000/000/0000000001.fid",
+         ]
+
+def test_keep_tracker_order_without_stats():
+    tracker = LatencyTracker()
+    assert tracker.sort_paths(PATHS) == PATHS
+
+def test_prefer_fast_node():
+    tracker = LatencyTracker()
+    tracker.record("10.0.0.1:7500", 0.5)
+    tracker.record("10.0.0.2:7500", 0.3)
+    tracker.record("10.0.0.3:7500", 0.01)
+    assert tracker.sort_paths(PATHS) == [PATHS[2], PATHS[1], PATHS[0]]
+
+def test_failing_node_goes_last():
+    tracker = LatencyTracker()
+    for netloc in ("10.0.0.1:7500", "10.0.0.2:7500", "10.0.0.3:7500"):
+        tracker.record(netloc, 0.01)
+    tracker.record_error("10.0.0.1:7500")
+    assert tracker.sort_paths(PATHS)[-1] == PATHS[0]
+    assert tracker.stats()["10.0.0.1:7500"]["errors"] == 1
+
+def test_error_penalty_decays():
+    tracker = LatencyTracker(penalty=1.0, half_life=10.0)
+    tracker.record("10.0.0.1:7500", 0.01)
+    tracker.record_error("10.0.0.1:7500")
+    now = time.time()
+    assert tracker.score("10.0.0.1:7500", now) > 1.0
+    assert tracker.score("10.0.0.1:7500", now + 100) < 0.02
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+def test_breaker_half_open_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    now = time.time()
+    breaker.record_failure(now)
+    assert breaker.get_state(now + 11) == HALF_OPEN
+    assert breaker.allow(now + 11)
+    # only one trial request at a time
+    assert not breaker.allow(now + 11)
+    breaker.record_failure(now + 11)
+    assert breaker.get_state(now + 12) == OPEN
+
+    assert breaker.allow(now + 22)
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+def test_board_moves_open_nodes_last():
+    board = BreakerBoard(failure_threshold=1)
+    board.record_failure("10.0.0.1:7500")
+    assert not board.allow("10.0.0.1:7500")
+    assert board.allow("10.0.0.2:7500")
+    assert board.sort_paths(PATHS) == [PATHS[1], PATHS[2], PATHS[0]]
+    assert board.states()["10.0.0.1:7500"] == OPEN
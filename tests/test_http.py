@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import gc
+import time
+import threading
+import urlparse
+from mogilefs import Client, Admin
+from mogilefs.exceptions import MogileFSError, MogileFSHTTPError
+from mogilefs.health import BreakerBoard, CLOSED
+from benchmarks.fakes import Cluster
+
+cluster = None
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=1, replicas=1).start()
+    Admin(cluster.hosts).create_domain('http')
+
+def teardown():
+    cluster.stop()
+
+def run_concurrently(func, count):
+    errors = []
+    def run():
+        try:
+            func()
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for x in xrange(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+def test_shared_client_reads():
+    client = Client('http', cluster.hosts)
+    data = {}
+    for x in xrange(4):
+        data['big%d' % x] = chr(ord('a') + x) * (4 * 1024 * 1024)
+        client.store_content('big%d' % x, data['big%d' % x])
+
+    def read():
+        for x in xrange(10):
+            key = 'big%d' % (x % 4)
+            assert client.get_file_data(key) == data[key]
+    assert run_concurrently(read, 8) == []
+    # connections went back to the pool once their responses were read
+    assert 0 < len(client.http_pool._idle.values()[0]) <= client.http_pool.max_idle
+
+def test_streaming_upload_abandoned():
+    client = Client('http', cluster.hosts)
+    try:
+        with client.new_file('abandoned', streaming=True) as fp:
+            fp.write('x' * 1000)
+            raise ValueError()
+    except ValueError:
+        pass
+    assert client.get_paths('abandoned') == []
+
+    fp = client.new_file('dropped', streaming=True)
+    fp.write('x' * 1000)
+    del fp
+    gc.collect()
+    assert client.get_paths('dropped') == []
+
+    with client.new_file('finished', streaming=True) as fp:
+        fp.write('x' * 1000)
+    assert client.get_file_data('finished') == 'x' * 1000
+
+def test_streaming_upload_closes_breaker():
+    client = Client('http', cluster.hosts)
+    client.breakers = BreakerBoard(failure_threshold=1, reset_timeout=0.2)
+    storage = cluster.storages[0]
+    storage.faults.error_rate = 1.0
+    try:
+        try:
+            client.store_content('breaker', 'x')
+        except MogileFSError:
+            pass
+        else:
+            assert False
+    finally:
+        storage.faults.error_rate = 0
+    assert client.breakers.is_open(storage.netloc)
+
+    # the upload is the half-open trial, and its success ends it
+    time.sleep(0.3)
+    with client.new_file('breaker', streaming=True) as fp:
+        fp.write('x' * 1000)
+    assert client.get_file_data('breaker') == 'x' * 1000
+    time.sleep(0.3)
+    assert client.get_file_data('breaker') == 'x' * 1000
+
+    # a node refusing the upload is still up
+    client.mkcol_nodes = None
+    storage.require_mkcol = True
+    try:
+        for x in xrange(3):
+            fp = client.new_file('refused%d' % x, streaming=True)
+            fp.write('x' * 1000)
+            try:
+                fp.close()
+            except MogileFSHTTPError, e:
+                assert e.code == 403
+            else:
+                assert False
+    finally:
+        storage.require_mkcol = False
+    assert client.breakers._get(storage.netloc).state == CLOSED
+    assert client.get_file_data('breaker') == 'x' * 1000
+
+def test_streaming_upload_with_mkcol():
+    client = Client('http', cluster.hosts)
+    storage = cluster.storages[0]
+    storage.dirs.clear()
+    storage.require_mkcol = True
+    try:
+        # the first upload finds out that the node wants MKCOL
+        fp = client.new_file('mkcol', streaming=True)
+        fp.write('x' * 1000)
+        try:
+            fp.close()
+        except MogileFSHTTPError, e:
+            assert e.code == 403
+        else:
+            assert False
+        assert client.mkcol_nodes == set([storage.netloc])
+        storage.dirs.clear()
+
+        with client.new_file('mkcol', streaming=True) as fp:
+            fp.write('x' * 1000)
+        assert client.get_file_data('mkcol') == 'x' * 1000
+        assert storage.dirs
+    finally:
+        storage.require_mkcol = False
+
+    # and one which learned it from a plain PUT doesn't fail at all
+    client = Client('http', cluster.hosts)
+    storage.dirs.clear()
+    storage.require_mkcol = True
+    try:
+        client.store_content('mkcol', 'y')
+        storage.dirs.clear()
+        with client.new_file('mkcol', streaming=True) as fp:
+            fp.write('y' * 1000)
+        assert client.get_file_data('mkcol') == 'y' * 1000
+    finally:
+        storage.require_mkcol = False
+
+def open_replicas(cluster, client, key):
+    """
+    The file opened, and the storage nodes of its replicas in the order
+    they will be read from.
+    """
+    fp = client.read_file(key)
+    storages = dict([(storage.netloc, storage) for storage in cluster.storages])
+    return fp, [storages[urlparse.urlsplit(path).netloc] for path in fp._replicas]
+
+def reset(cluster):
+    for storage in cluster.storages:
+        storage.drop_after = None
+        storage.ignore_range = False
+
+def with_replicas(func):
+    def test():
+        replicated = Cluster(nodes=3, replicas=3).start()
+        try:
+            Admin(replicated.hosts).create_domain('http')
+            client = Client('http', replicated.hosts)
+            client.store_content('file', data)
+            func(replicated, client)
+        finally:
+            replicated.stop()
+    test.__name__ = func.__name__
+    return test
+
+data = ''.join([chr(x % 251) for x in xrange(500000)])
+
+@with_replicas
+def test_resume_after_dropped_connection(cluster, client):
+    fp, storages = open_replicas(cluster, client, 'file')
+    storages[0].drop_after = 100000
+    assert fp.read() == data
+    # only what was missing was asked for again
+    assert storages[1].requests[-1] == ('GET', urlparse.urlsplit(fp._replicas[1]).path)
+
+    reset(cluster)
+    fp, storages = open_replicas(cluster, client, 'file')
+    storages[0].drop_after = 100000
+    fp.seek(1000)
+    assert fp.read(300000) == data[1000:301000]
+    assert fp.read(10) == data[301000:301010]
+
+@with_replicas
+def test_resume_on_node_ignoring_range(cluster, client):
+    fp, storages = open_replicas(cluster, client, 'file')
+    storages[0].drop_after = 100000
+    storages[1].ignore_range = True
+    assert fp.read() == data
+
+    reset(cluster)
+    fp, storages = open_replicas(cluster, client, 'file')
+    storages[0].drop_after = 100000
+    storages[1].ignore_range = True
+    storages[2].ignore_range = True
+    try:
+        fp.read()
+    except MogileFSError:
+        pass
+    else:
+        assert False
+
+@with_replicas
+def test_length_mismatch_between_replicas(cluster, client):
+    fp, storages = open_replicas(cluster, client, 'file')
+    path = urlparse.urlsplit(fp._replicas[1]).path
+    storages[1].files[path] = data[:200000]
+    storages[0].drop_after = 100000
+    assert fp.read() == data
+    assert fp.path == fp._replicas[2]
+
+    # a replica too short to answer the range at all
+    reset(cluster)
+    client.store_content('other', data)
+    fp, storages = open_replicas(cluster, client, 'other')
+    path = urlparse.urlsplit(fp._replicas[1]).path
+    storages[1].files[path] = data[:1000]
+    storages[0].drop_after = 100000
+    assert fp.read() == data
+    assert fp.path == fp._replicas[2]
+
+@with_replicas
+def test_no_failover_when_writing(cluster, client):
+    fp = client.new_file('written', largefile=True)
+    fp.write(data)
+    devid, path = fp.devid, fp.path
+    storages = dict([(storage.netloc, storage) for storage in cluster.storages])
+    storages[urlparse.urlsplit(path).netloc].drop_after = 1000
+    try:
+        fp.seek(0)
+        try:
+            fp.read()
+        except MogileFSError:
+            pass
+        else:
+            assert False
+    finally:
+        reset(cluster)
+    assert (fp.devid, fp.path, fp._path) == (devid, path, path)
+    fp.close()
+    assert client.get_file_data('written') == data
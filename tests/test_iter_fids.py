@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from mogilefs import Client, Admin
+from benchmarks.fakes import Cluster
+
+cluster = None
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=2).start()
+    Admin(cluster.hosts).create_domain('fids')
+    client = Client('fids', cluster.hosts)
+    for x in xrange(50):
+        client.store_content('key%d' % x, 'x' * x)
+
+def teardown():
+    cluster.stop()
+
+def test_list_fids_keyed_by_fid():
+    fids = Admin(cluster.hosts).list_fids(1, 10)
+    assert sorted(fids) == range(1, 11)
+    assert fids[3]['key'] == 'key2'
+
+def test_iter_fids():
+    infos = list(Admin(cluster.hosts).iter_fids(1, batch=7, min_batch=1))
+    assert [info.fid for info in infos] == range(1, 51)
+    assert infos[10].key == 'key10'
+    assert infos[10].length == 10
+    assert infos[10].domain == 'fids'
+    assert infos[10].devcount == 2
+
+def test_iter_fids_range():
+    infos = list(Admin(cluster.hosts).iter_fids(5, 9, batch=2, min_batch=1))
+    assert [info.fid for info in infos] == [5, 6, 7, 8, 9]
+    assert list(Admin(cluster.hosts).iter_fids(9, 5)) == []
+
+def test_iter_fids_parallel():
+    infos = list(Admin(cluster.hosts).iter_fids(1, 50, batch=3, min_batch=1, parallel=4))
+    assert sorted(info.fid for info in infos) == range(1, 51)
+
+def test_iter_fids_capped():
+    # a tracker answering like mogilefsd, with fids above 'from' and at
+    # most a few at once
+    cluster.tracker.list_fids_limit = 4
+    try:
+        for batch, parallel in ((1, 1), (7, 1), (100, 1), (10, 3)):
+            infos = list(Admin(cluster.hosts).iter_fids(1, 50, batch=batch, min_batch=1,
+                                                        max_batch=1000, parallel=parallel))
+            assert sorted(info.fid for info in infos) == range(1, 51), (batch, parallel)
+        infos = list(Admin(cluster.hosts).iter_fids(5, 9, batch=2, min_batch=1))
+        assert [info.fid for info in infos] == [5, 6, 7, 8, 9]
+    finally:
+        cluster.tracker.list_fids_limit = None
+
+def test_iter_fids_stop_early():
+    fids = Admin(cluster.hosts).iter_fids(1, 50, batch=1, min_batch=1, parallel=3)
+    assert fids.next().fid
+    fids.close()
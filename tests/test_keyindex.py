@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from mogilefs import Client, Admin
+from mogilefs.keyindex import BloomFilter, KeyIndex
+from benchmarks.fakes import Cluster
+
+cluster = None
+tmpdir = None
+
+def setup():
+    global cluster, tmpdir
+    cluster = Cluster(nodes=1).start()
+    tmpdir = tempfile.mkdtemp()
+    Admin(cluster.hosts).create_domain('keyindex')
+    client = Client('keyindex', cluster.hosts)
+    for x in xrange(25):
+        client.store_content('key%d' % x, 'data')
+
+def teardown():
+    cluster.stop()
+    shutil.rmtree(tmpdir)
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01)
+    for x in xrange(1000):
+        bloom.add('key%d' % x)
+    for x in xrange(1000):
+        assert 'key%d' % x in bloom
+    false_positives = len([x for x in xrange(10000) if 'other%d' % x in bloom])
+    assert false_positives < 300
+    assert bloom.count == 1000
+
+def test_save_and_load():
+    filename = os.path.join(tmpdir, 'bloom')
+    bloom = BloomFilter(100)
+    bloom.add('a')
+    bloom.save(filename)
+
+    mapped = BloomFilter.load(filename)
+    assert 'a' in mapped
+    assert 'b' not in mapped
+    mapped.close()
+
+    mapped = BloomFilter.load(filename, writable=True)
+    mapped.add('b')
+    mapped.close()
+
+    mapped = BloomFilter.load(filename)
+    assert 'a' in mapped and 'b' in mapped
+    assert mapped.count == 2
+    mapped.close()
+
+    open(filename, 'wb').write('garbage')
+    try:
+        BloomFilter.load(filename)
+    except ValueError:
+        pass
+    else:
+        assert False, 'loaded garbage'
+
+def test_key_index():
+    client = Client('keyindex', cluster.hosts)
+    index = KeyIndex.build(client, capacity=1000, page_size=10)
+    assert index.bloom.count == 25
+    assert index.exists('key3')
+    assert not index.might_exist('missing')
+    assert not index.exists('missing')
+
+    filename = os.path.join(tmpdir, 'keys')
+    index.save(filename)
+    index = KeyIndex.load(client, filename)
+    client.key_index = index
+    client.store_content('new', 'data')
+    client.rename('new', 'renamed')
+    assert index.might_exist('new')
+    assert index.exists('renamed')
+    index.bloom.close()
+
+    assert BloomFilter.load(filename).count == 27
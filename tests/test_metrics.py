@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import threading
+from mogilefs.metrics import new_registry, TRACKER_REQUEST_SECONDS, TRACKER_ERRORS
+
+def test_counter():
+    registry = new_registry()
+    registry.inc(TRACKER_ERRORS, ('get_paths', 'unknown_key'))
+    registry.inc(TRACKER_ERRORS, ('get_paths', 'unknown_key'), 2)
+    snapshot = registry.snapshot()
+    assert snapshot[TRACKER_ERRORS][('get_paths', 'unknown_key')] == 3
+
+def test_histogram_merges_threads():
+    registry = new_registry(buckets=(0.01, 0.1))
+
+    def record():
+        for value in (0.005, 0.05, 0.5):
+            registry.observe(TRACKER_REQUEST_SECONDS, ('get_paths', '127.0.0.1:7001'), value)
+
+    threads = [threading.Thread(target=record) for x in xrange(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    hist = registry.snapshot()[TRACKER_REQUEST_SECONDS][('get_paths', '127.0.0.1:7001')]
+    assert hist['count'] == 12
+    assert hist['buckets'] == [(0.01, 4), (0.1, 8), (float('inf'), 12)]
+    assert abs(hist['sum'] - 2.22) < 1e-9
+
+def test_finished_threads_are_folded():
+    registry = new_registry()
+
+    def record():
+        registry.inc(TRACKER_ERRORS, ('get_paths', 'unknown_key'))
+    for x in xrange(200):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+
+    assert len(registry._shards) < 5
+    assert registry.snapshot()[TRACKER_ERRORS][('get_paths', 'unknown_key')] == 200
+    registry.reset()
+    assert TRACKER_ERRORS not in registry.snapshot()
+
+def test_to_dict():
+    registry = new_registry()
+    registry.inc(TRACKER_ERRORS, ('delete', 'unknown_key'))
+    rows = registry.to_dict()[TRACKER_ERRORS]
+    assert rows == [{ 'labels': { 'command': 'delete', 'err': 'unknown_key' }, 'value': 1 }]
+
+def test_prometheus():
+    registry = new_registry(buckets=(0.01,))
+    registry.observe(TRACKER_REQUEST_SECONDS, ('sleep', '127.0.0.1:7001'), 0.5)
+    text = registry.to_prometheus()
+    assert '# TYPE mogilefs_tracker_request_seconds histogram' in text
+    assert 'mogilefs_tracker_request_seconds_bucket{command="sleep",tracker="127.0.0.1:7001",le="0.01"} 0' in text
+    assert 'mogilefs_tracker_request_seconds_bucket{command="sleep",tracker="127.0.0.1:7001",le="+Inf"} 1' in text
+    assert 'mogilefs_tracker_request_seconds_count{command="sleep",tracker="127.0.0.1:7001"} 1' in text
+
+def test_reset():
+    registry = new_registry()
+    registry.inc(TRACKER_ERRORS, ('delete', 'unknown_key'))
+    registry.reset()
+    assert TRACKER_ERRORS not in registry.snapshot()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from mogilefs import Client, Admin
+from mogilefs.cache import RecentWrites
+from mogilefs.exceptions import MogileFSError
+from benchmarks.fakes import Cluster
+
+cluster = None
+data = ''.join([chr(x % 251) for x in xrange(200000)])
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=2).start()
+    Admin(cluster.hosts).create_domain('ranges')
+    Client('ranges', cluster.hosts).store_content('file', data)
+
+def teardown():
+    cluster.stop()
+
+def storage_reads():
+    # replication may still be PUTting copies
+    requests = []
+    for storage in cluster.storages:
+        requests.extend([method for method, path in storage.requests if method != 'PUT'])
+        del storage.requests[:]
+    return requests
+
+def test_get_file_range():
+    client = Client('ranges', cluster.hosts)
+    storage_reads()
+    assert client.get_file_range('file', 100000, 1000) == data[100000:101000]
+    assert storage_reads() == ['GET']
+
+    buf = bytearray(5000)
+    assert client.get_file_range('file', 10, 1000, buf) == 1000
+    assert buf[:1000] == data[10:1010]
+
+    # past the end of the file
+    assert client.get_file_range('file', 199990, 1000) == data[199990:]
+    assert client.get_file_range('file', 300000, 1000) == ''
+    assert client.get_file_range('file', 0, 0) == ''
+
+def test_get_file_ranges():
+    client = Client('ranges', cluster.hosts)
+    ranges = [(0, 10), (150000, 70000), (70000, 100), (60000, 20000), (250000, 10)]
+    storage_reads()
+    assert client.get_file_ranges('file', ranges) == \
+        [data[offset:offset + length] for offset, length in ranges]
+    assert storage_reads() == ['GET']
+
+    bufs = [bytearray(length) for offset, length in ranges]
+    assert client.get_file_ranges('file', ranges, bufs) == [10, 50000, 100, 20000, 0]
+    assert str(bufs[2]) == data[70000:70100]
+
+def test_failover():
+    client = Client('ranges', cluster.hosts)
+    client.breakers = None
+    paths = client.get_paths('file')
+    assert len(paths) == 2
+    broken = [storage for storage in cluster.storages if storage.netloc in paths[0]][0]
+    broken.faults.error_rate = 1.0
+    try:
+        assert client.get_file_range('file', 5, 5) == data[5:10]
+    finally:
+        broken.faults.error_rate = 0
+
+def test_recent_write_gone():
+    client = Client('ranges', cluster.hosts)
+    client.recent_writes = RecentWrites(ttl=60)
+    client.store_content('recent', 'recent data')
+    assert client.get_file_range('recent', 7, 4) == 'data'
+
+    path = client.recent_writes.get('recent')[0]
+    client.recent_writes.add('recent', [path.replace('.fid', '.gone.fid')])
+    assert client.get_file_range('recent', 0, 6) == 'recent'
+
+    try:
+        client.get_file_range('missing', 0, 6)
+    except MogileFSError:
+        pass
+    else:
+        assert False
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import gc
+from mogilefs import Client, Admin
+from mogilefs.exceptions import MogileFSError, MogileFSTrackerError
+from mogilefs.sharding import HashRing, ShardedClient
+from benchmarks.fakes import Cluster
+
+clusters = {}
+
+def setup():
+    for name in ('a', 'b', 'c'):
+        clusters[name] = Cluster(nodes=1).start()
+        Admin(clusters[name].hosts).create_domain('sharded')
+
+def teardown():
+    for cluster in clusters.values():
+        cluster.stop()
+
+def _clients(*names):
+    return dict([(name, Client('sharded', clusters[name].hosts)) for name in names])
+
+def test_hash_ring():
+    ring = HashRing(['a', 'b', 'c'])
+    owners = [ring.get('key%d' % x) for x in xrange(3000)]
+    for name in ('a', 'b', 'c'):
+        assert 700 < owners.count(name) < 1300, owners.count(name)
+
+    # a new node only takes keys over, the others stay where they were
+    ring.add('d')
+    moved = 0
+    for x, owner in enumerate(owners):
+        now = ring.get('key%d' % x)
+        if now != owner:
+            assert now == 'd'
+            moved += 1
+    assert 500 < moved < 1000, moved
+
+    ring.remove('d')
+    assert [ring.get('key%d' % x) for x in xrange(3000)] == owners
+
+    weighted = HashRing({ 'a': 1, 'b': 3 })
+    owners = [weighted.get('key%d' % x) for x in xrange(2000)]
+    assert owners.count('b') > 2 * owners.count('a')
+
+def test_sharded_client():
+    clients = _clients('a', 'b')
+    sharded = ShardedClient(clients)
+    keys = ['basic%d' % x for x in xrange(20)]
+    for key in keys:
+        sharded.store_content(key, 'data of %s' % key)
+
+    for key in keys:
+        owner = sharded.shard_for(key)
+        assert owner.get_paths(key)
+        for other in clients.values():
+            if other is not owner:
+                assert other.get_paths(key) == []
+        assert sharded.get_file_data(key) == 'data of %s' % key
+        assert sharded.get_paths(key)
+    assert len(set([sharded.ring.get(key) for key in keys])) == 2
+
+    assert sharded.list_keys('basic') == sorted(keys)
+    assert sharded.list_keys('basic', limit=5) == sorted(keys)[:5]
+    assert list(sharded.iter_keys('basic', page_size=3)) == sorted(keys)
+    try:
+        sharded.list_keys('nothing')
+    except MogileFSTrackerError, e:
+        assert e.err == 'none_match'
+    else:
+        assert False
+
+    # renaming onto an existing key on another shard is refused
+    other = [key for key in keys if sharded.shard_for(key) is not sharded.shard_for('basic0')][0]
+    try:
+        sharded.rename('basic0', other)
+    except MogileFSTrackerError, e:
+        assert e.err == 'key_exists'
+    else:
+        assert False
+    assert sharded.get_file_data(other) == 'data of %s' % other
+
+    sharded.rename('basic0', 'renamed')
+    assert sharded.get_paths('basic0') == []
+    assert sharded.get_file_data('renamed') == 'data of basic0'
+
+    for key in keys[1:] + ['renamed']:
+        sharded.delete(key)
+    assert list(sharded.iter_keys('basic')) == []
+
+def test_migration():
+    old = _clients('a', 'b')
+    sharded = ShardedClient(old)
+    keys = ['migrate%d' % x for x in xrange(30)]
+    for key in keys:
+        sharded.store_content(key, 'data of %s' % key)
+
+    new = _clients('a', 'b', 'c')
+    new['a'], new['b'] = old['a'], old['b']
+    sharded.start_migration(new)
+    misplaced = [key for key, src, dst in sharded.iter_misplaced('migrate')]
+    assert misplaced
+    for key in misplaced:
+        assert sharded.ring.get(key) == 'c'
+
+    # everything stays readable before and after moving
+    for key in keys:
+        assert sharded.get_paths(key)
+        assert sharded.get_file_data(key) == 'data of %s' % key
+    assert sharded.list_keys('migrate') == sorted(keys)
+
+    # new writes go to the new owner, deletes reach the old one
+    sharded.store_content(misplaced[0], 'rewritten')
+    assert sharded.get_file_data(misplaced[0]) == 'rewritten'
+    sharded.delete(misplaced[1])
+    assert sharded.get_paths(misplaced[1]) == []
+    assert old[sharded.old_ring.get(misplaced[1])].get_paths(misplaced[1]) == []
+
+    assert sharded.move_misplaced('migrate') == len(misplaced) - 1
+    assert list(sharded.iter_misplaced('migrate')) == []
+    sharded.finish_migration()
+
+    assert sharded.get_file_data(misplaced[0]) == 'rewritten'
+    for key in keys:
+        if key not in misplaced[:2]:
+            assert sharded.get_file_data(key) == 'data of %s' % key
+    assert sorted(sharded.shards['c'].list_keys('migrate')) == sorted(misplaced[:1] + misplaced[2:])
+
+def test_failed_move_keeps_the_source():
+    old = _clients('a')
+    sharded = ShardedClient(old)
+    keys = ['failing%d' % x for x in xrange(10)]
+    for key in keys:
+        sharded.store_content(key, key * 20000)
+
+    new = _clients('c')
+    new['a'] = old['a']
+    sharded.start_migration(new)
+    key, src, dst = list(sharded.iter_misplaced('failing'))[0]
+    for storage in clusters['a'].storages:
+        storage.drop_after = 1000
+    try:
+        try:
+            sharded.move_misplaced('failing')
+        except MogileFSError:
+            pass
+        else:
+            assert False
+    finally:
+        for storage in clusters['a'].storages:
+            storage.drop_after = None
+    gc.collect()
+    assert dst.get_paths(key) == []
+    assert src.get_file_data(key) == key * 20000
+
+    sharded.move_misplaced('failing')
+    sharded.finish_migration()
+    for key in keys:
+        assert sharded.get_file_data(key) == key * 20000
+
+def test_move_to_mkcol_nodes():
+    old = _clients('b')
+    sharded = ShardedClient(old)
+    keys = ['mkcol%d' % x for x in xrange(10)]
+    for key in keys:
+        sharded.store_content(key, key * 1000)
+
+    new = _clients('c')
+    new['b'] = old['b']
+    sharded.start_migration(new)
+    for storage in clusters['c'].storages:
+        storage.dirs.clear()
+        storage.require_mkcol = True
+    try:
+        assert sharded.move_misplaced('mkcol') > 0
+    finally:
+        for storage in clusters['c'].storages:
+            storage.require_mkcol = False
+    sharded.finish_migration()
+    for key in keys:
+        assert sharded.get_file_data(key) == key * 1000
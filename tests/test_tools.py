@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import gc
+import os
+import shutil
+import tarfile
+import tempfile
+from cStringIO import StringIO
+from mogilefs import Client, Admin
+from mogilefs.tools.common import key_to_path, path_to_key, Checkpoint, Progress
+from mogilefs.tools import export, importer
+from benchmarks.fakes import Cluster
+
+cluster = None
+tmpdir = None
+keys = {}
+
+def setup():
+    global cluster, tmpdir
+    cluster = Cluster(nodes=2).start()
+    tmpdir = tempfile.mkdtemp()
+    Admin(cluster.hosts).create_domain('tools')
+    client = Client('tools', cluster.hosts)
+    for x in xrange(30):
+        keys['dir%d/key %d' % (x % 3, x)] = 'data%d' % x * (x * 100)
+    keys['/leading/slash'] = 'slash'
+    keys['empty'] = ''
+    for key, data in keys.items():
+        client.store_content(key, data)
+
+def teardown():
+    cluster.stop()
+    shutil.rmtree(tmpdir)
+
+def run_export(*args):
+    return export.main(['-q', '-t', ','.join(cluster.hosts), '-d', 'tools', '-w', '3'] + list(args))
+
+def test_key_to_path():
+    for key, path in [('a/b c.txt', 'a/b%20c.txt'),
+                      ('/a', '%2Fa'),
+                      ('a/../b', 'a%2F..%2Fb'),
+                      ('a//b', 'a%2F%2Fb')]:
+        assert key_to_path(key) == path
+        assert path_to_key(path) == key
+
+def test_checkpoint():
+    checkpoint = Checkpoint(os.path.join(tmpdir, 'checkpoint'))
+    assert checkpoint.load() is None
+    checkpoint.save({ 'after': 'key' })
+    assert checkpoint.load() == { 'after': 'key' }
+    checkpoint.remove()
+    assert checkpoint.load() is None
+
+def test_progress():
+    out = StringIO()
+    progress = Progress(out=out)
+    progress.done(1048576)
+    progress.fail('key', 'gone')
+    progress.report(final=True)
+    assert out.getvalue().startswith('1 files, 1.0 MB')
+    assert 'FAILED key: gone' in out.getvalue()
+
+def test_export_directory():
+    output = os.path.join(tmpdir, 'export')
+    assert run_export('-o', output) == 0
+    for key, data in keys.items():
+        path = os.path.join(output, *key_to_path(key).split('/'))
+        assert open(path, 'rb').read() == data, key
+    assert not os.path.exists(output + '.checkpoint')
+
+def test_export_tar():
+    output = os.path.join(tmpdir, 'export.tar')
+    assert run_export('-o', output, '--block-size', '1000') == 0
+    tar = tarfile.open(output)
+    try:
+        names = tar.getnames()
+        assert sorted(names) == sorted(key_to_path(key) for key in keys)
+        for key, data in keys.items():
+            assert tar.extractfile(key_to_path(key)).read() == data
+    finally:
+        tar.close()
+
+def test_export_tar_resume():
+    output = os.path.join(tmpdir, 'resume.tar')
+    ordered = sorted(keys)
+    # pretend a first run wrote the first ten keys
+    client = Client('tools', cluster.hosts)
+    sink = export.TarSink(output)
+    for key in ordered[:10]:
+        sink.write(key, client.read_file(key))
+    state = sink.state()
+    # and was interrupted halfway through the next one
+    sink._fileobj.write('partial member')
+    sink._fileobj.close()
+    state['after'] = ordered[9]
+    state['prefix'] = None
+    Checkpoint(output + '.checkpoint').save(state)
+
+    assert run_export('-o', output, '--resume') == 0
+    tar = tarfile.open(output)
+    try:
+        assert tar.getnames() == [key_to_path(key) for key in ordered]
+    finally:
+        tar.close()
+
+def test_export_without_client():
+    # Client() refuses a tracker without a port
+    output = os.path.join(tmpdir, 'noclient')
+    assert export.main(['-q', '-t', 'localhost', '-d', 'tools', '-o', output]) == 2
+
+    def factory():
+        raise ValueError("no client")
+    exporter = export.Exporter(factory, export.DirectorySink(output), workers=2)
+    assert not exporter.run()
+    assert isinstance(exporter.error, ValueError)
+
+class FailingClient(object):
+    def __init__(self, client, fail):
+        self.client = client
+        self.fail = fail
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def read_file(self, key, *args, **kwds):
+        if key in self.fail:
+            raise IOError("storage node went away")
+        return self.client.read_file(key, *args, **kwds)
+
+def test_export_retries_failed_keys():
+    output = os.path.join(tmpdir, 'retried')
+    checkpoint = Checkpoint(output + '.checkpoint')
+    failing = ['dir1/key 1', 'dir2/key 29']
+    exporter = export.Exporter(lambda: FailingClient(Client('tools', cluster.hosts), failing),
+                               export.DirectorySink(output), workers=3, checkpoint=checkpoint)
+    assert not exporter.run()
+    assert sorted(exporter.failed) == failing
+    state = checkpoint.load()
+    assert sorted(state['failed']) == ['dir1/key%201', 'dir2/key%2029']
+    for key in failing:
+        assert not os.path.exists(os.path.join(output, *key_to_path(key).split('/')))
+
+    assert run_export('-o', output, '--resume') == 0
+    for key, data in keys.items():
+        path = os.path.join(output, *key_to_path(key).split('/'))
+        assert open(path, 'rb').read() == data, key
+    assert checkpoint.load() is None
+
+def test_export_prefix():
+    output = os.path.join(tmpdir, 'prefix')
+    assert run_export('-o', output, '-p', 'dir1/') == 0
+    assert len(os.listdir(os.path.join(output, 'dir1'))) == 10
+    assert not os.path.exists(os.path.join(output, 'dir2'))
+
+def run_import(*args):
+    return importer.main(['-q', '-t', ','.join(cluster.hosts), '-w', '3'] + list(args))
+
+def test_import_directory():
+    Admin(cluster.hosts).create_domain('imported')
+    output = os.path.join(tmpdir, 'roundtrip')
+    assert run_export('-o', output) == 0
+    assert run_import('-d', 'imported', '-r', output) == 0
+
+    client = Client('imported', cluster.hosts)
+    for key, data in keys.items():
+        assert client.get_file_data(key) == data, key
+
+    # everything is there already
+    stored = len(cluster.tracker.commands)
+    imp = importer.Importer(lambda: Client('imported', cluster.hosts),
+                            importer.walk_directory(output))
+    assert imp.run(), imp.progress.failures
+    assert imp.progress.skipped == len(keys)
+    assert 'create_open' not in cluster.tracker.commands[stored:]
+
+def test_import_with_mkcol():
+    Admin(cluster.hosts).create_domain('mkcol')
+    path = os.path.join(tmpdir, 'mkcol')
+    open(path, 'wb').write('m' * 5000)
+    for storage in cluster.storages:
+        storage.dirs.clear()
+        storage.require_mkcol = True
+    try:
+        client = Client('mkcol', cluster.hosts)
+        assert importer.upload_file(client, path, 'mkcol') == 5000
+    finally:
+        for storage in cluster.storages:
+            storage.require_mkcol = False
+    assert client.get_file_data('mkcol') == 'm' * 5000
+
+def test_import_manifest():
+    Admin(cluster.hosts).create_domain('manifest')
+    Admin(cluster.hosts).create_class('manifest', 'big', 2)
+    root = os.path.join(tmpdir, 'manifest-root')
+    os.mkdir(root)
+    for name in ('a', 'b', 'c'):
+        open(os.path.join(root, name), 'wb').write(name * 10)
+    manifest = os.path.join(tmpdir, 'manifest.txt')
+    failures = os.path.join(tmpdir, 'failures.txt')
+    open(manifest, 'wb').write('# path key class\na\nb\tkey-b\tbig\nmissing\tkey-m\nc\n')
+
+    assert run_import('-d', 'manifest', '-r', root, '-m', manifest, '-p', 'x/',
+                      '--failures', failures) == 1
+    client = Client('manifest', cluster.hosts)
+    assert client.get_file_data('x/a') == 'a' * 10
+    assert client.get_file_data('key-b') == 'b' * 10
+    assert client.file_info('key-b')['class'] == 'big'
+    assert client.file_info('key-m') is None
+    assert open(failures).read() == '%s\tkey-m\t\n' % os.path.join(root, 'missing')
+
+def test_import_resume():
+    Admin(cluster.hosts).create_domain('resumed')
+    root = os.path.join(tmpdir, 'resume-root')
+    os.mkdir(root)
+    for name in ('1', '2', '3'):
+        open(os.path.join(root, name), 'wb').write(name)
+    Checkpoint(root + '.checkpoint').save({ 'done': 2 })
+
+    assert run_import('-d', 'resumed', '-r', root, '--resume') == 0
+    assert Client('resumed', cluster.hosts).list_keys() == ['3']
+    assert not os.path.exists(root + '.checkpoint')
+
+class BreakingFile(object):
+    def __init__(self, fp):
+        self.fp = fp
+
+    def put(self, body):
+        self.fp.write(str(body[:1000]))
+        raise IOError("the disk went away")
+
+    def abort(self):
+        self.fp.abort()
+
+class BreakingClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    def new_file(self, *args, **kwds):
+        return BreakingFile(self.client.new_file(*args, **kwds))
+
+    def file_info(self, key):
+        raise RuntimeError("not expected")
+
+def test_import_failures():
+    Admin(cluster.hosts).create_domain('failing')
+    client = Client('failing', cluster.hosts)
+    path = os.path.join(tmpdir, 'partial')
+    open(path, 'wb').write('x' * 5000)
+
+    try:
+        importer.upload_file(BreakingClient(client), path, 'partial')
+    except IOError:
+        pass
+    else:
+        assert False
+    gc.collect()
+    assert client.get_paths('partial') == []
+
+    # an unexpected exception fails the file, not the worker
+    imp = importer.Importer(lambda: BreakingClient(client), [(path, 'partial', None)], workers=2)
+    assert not imp.run()
+    assert imp.failed == [(path, 'partial', None)]
+
+    assert importer.main(['-q', '-t', 'localhost', '-d', 'failing', '-r', tmpdir,
+                          '--checkpoint', os.path.join(tmpdir, 'failing.checkpoint')]) == 2
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import time
+from mogilefs import Client, Admin
+from mogilefs.topology import Topology, DeviceReadPolicy, path_devid
+from benchmarks.fakes import Cluster
+
+cluster = None
+
+def setup():
+    global cluster
+    cluster = Cluster(nodes=2).start()
+
+def teardown():
+    cluster.stop()
+
+def test_get_hosts():
+    hosts = Admin(cluster.hosts).get_hosts()
+    assert [h['hostid'] for h in hosts] == [1, 2]
+    assert hosts[0]['http_port'] == cluster.storages[0].port
+
+def test_lookups():
+    topology = Topology(Admin(cluster.hosts))
+    assert topology.refresh()
+    assert len(topology.hosts()) == 2
+    assert [d.devid for d in topology.devices(hostid=1)] == [1, 2]
+    assert topology.device(3).hostid == 2
+    assert topology.device_host(3).hostip == cluster.storages[1].host
+    assert topology.utilization(1) == 3.0
+    assert len(topology.devices(status='alive')) == 4
+
+def test_skip_unchanged():
+    topology = Topology(Admin(cluster.hosts))
+    topology.refresh()
+    assert not topology.refresh()
+    assert topology.rebuilds == 1
+
+    # only utilization moved: the indexes are kept
+    cluster.tracker.devices[1]['utilization'] = '50.0'
+    try:
+        assert topology.refresh()
+        assert topology.rebuilds == 1
+        assert topology.utilization(1) == 50.0
+
+        cluster.tracker.devices[1]['status'] = 'drain'
+        assert topology.refresh()
+        assert topology.rebuilds == 2
+        assert [d.devid for d in topology.devices(status='drain')] == [1]
+    finally:
+        cluster.tracker.devices[1]['utilization'] = '3.0'
+        cluster.tracker.devices[1]['status'] = 'alive'
+
+def test_background_refresh():
+    topology = Topology(Admin(cluster.hosts), interval=0.01)
+    topology.start()
+    try:
+        refreshed_at = topology.refreshed_at
+        time.sleep(0.1)
+        assert topology.refreshed_at > refreshed_at
+    finally:
+        topology.stop()
+
+def test_path_devid():
+    assert path_devid('http://10.0.0.1:7500/dev12/0/000/000/0000000001.fid') == 12
+    assert path_devid('http://10.0.0.1:7500/data/1.fid') is None
+
+def test_device_read_policy():
+    topology = Topology(Admin(cluster.hosts))
+    policy = DeviceReadPolicy(topology)
+    paths = ['http://h/dev1/1.fid', 'http://h/dev2/1.fid', 'http://h/dev3/1.fid', 'http://h/dev9/1.fid']
+    # nothing known yet
+    assert policy.sort_paths(paths) == paths
+
+    devices = cluster.tracker.devices
+    devices[1]['status'] = 'drain'
+    devices[2]['utilization'] = '95.0'
+    try:
+        topology.refresh()
+        # dev9 is unknown and keeps its place among the usable paths
+        assert policy.sort_paths(paths) == ['http://h/dev3/1.fid', 'http://h/dev2/1.fid',
+                                            'http://h/dev9/1.fid', 'http://h/dev1/1.fid']
+        paths = ['http://h/dev9/1.fid', 'http://h/dev2/1.fid', 'http://h/dev3/1.fid']
+        assert policy.sort_paths(paths) == ['http://h/dev9/1.fid', 'http://h/dev3/1.fid',
+                                            'http://h/dev2/1.fid']
+    finally:
+        devices[1]['status'] = 'alive'
+        devices[2]['utilization'] = '3.0'
+
+def test_client_read_policy():
+    Admin(cluster.hosts).create_domain('topology')
+    client = Client('topology', cluster.hosts)
+    client.store_content('key', 'data')
+    topology = Topology(Admin(cluster.hosts))
+    client.read_policy = DeviceReadPolicy(topology)
+
+    devids = [path_devid(p) for p in client.get_paths('key')]
+    for devid in devids[:-1]:
+        cluster.tracker.devices[devid]['status'] = 'down'
+    try:
+        topology.refresh()
+        fp = client.read_file('key')
+        assert path_devid(fp.path) == devids[-1]
+        assert fp.read() == 'data'
+        fp.close()
+    finally:
+        for devid in devids:
+            cluster.tracker.devices[devid]['status'] = 'alive'
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import threading
+from mogilefs.exceptions import MogileFSError, MogileFSTrackerError, UploadQueueFull
+from mogilefs import Client, Admin
+from mogilefs.uploader import WriteBehindUploader
+from benchmarks.fakes import Cluster
+
+class StubClient(object):
+    def __init__(self, failures=0, gate=None):
+        self.stored = {}
+        self.failures = failures
+        self.gate = gate
+
+    def store_content(self, key, content, cls=None):
+        if self.gate is not None:
+            self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise MogileFSError("storage node went away")
+        self.stored[key] = content
+        return len(content)
+
+def test_submit_and_flush():
+    client = StubClient()
+    uploader = WriteBehindUploader(client, workers=2)
+    futures = [uploader.submit('key%d' % x, 'data%d' % x) for x in xrange(10)]
+    assert uploader.flush(5)
+    assert len(client.stored) == 10
+    assert [f.result() for f in futures] == [5] * 10
+    uploader.close()
+
+def test_close_racing_submit():
+    client = StubClient()
+    uploader = WriteBehindUploader(client, workers=2)
+    put = uploader._queue.put
+    def racing_put(item):
+        # close() from another thread while the item is being queued
+        uploader._queue.put = put
+        closer = threading.Thread(target=uploader.close, args=(False,))
+        closer.start()
+        closer.join(0.2)
+        put(item)
+    uploader._queue.put = racing_put
+    future = uploader.submit('spam', 'egg')
+    assert uploader.flush(5)
+    assert future.result() == 3
+    assert client.stored == { 'spam': 'egg' }
+
+def test_callback():
+    done = []
+    with WriteBehindUploader(StubClient(), workers=1) as uploader:
+        uploader.submit('spam', 'egg', callback=done.append)
+        uploader.flush()
+    assert [f.key for f in done] == ['spam']
+
+def test_retry():
+    client = StubClient(failures=2)
+    uploader = WriteBehindUploader(client, workers=1, retries=2, retry_delay=0)
+    future = uploader.submit('spam', 'egg')
+    assert future.result(5) == 3
+    assert future.attempts == 3
+    uploader.close()
+
+def test_retry_gives_up():
+    client = StubClient(failures=5)
+    uploader = WriteBehindUploader(client, workers=1, retries=1, retry_delay=0)
+    future = uploader.submit('spam', 'egg')
+    assert isinstance(future.exception(5), MogileFSError)
+    assert future.attempts == 2
+    uploader.close()
+
+def test_no_retry_on_tracker_error():
+    class BadDomainClient(StubClient):
+        def store_content(self, key, content, cls=None):
+            raise MogileFSTrackerError('Domain name invalid/not found', 'unreg_domain')
+
+    uploader = WriteBehindUploader(BadDomainClient(), workers=1, retry_delay=0)
+    future = uploader.submit('spam', 'egg')
+    assert future.exception(5).err == 'unreg_domain'
+    assert future.attempts == 1
+    uploader.close()
+
+def test_reject_when_full():
+    gate = threading.Event()
+    uploader = WriteBehindUploader(StubClient(gate=gate), workers=1, max_bytes=10, block=False)
+    uploader.submit('spam', '12345678')
+    try:
+        uploader.submit('egg', '12345678')
+    except UploadQueueFull:
+        pass
+    else:
+        assert False, "UploadQueueFull expected"
+    gate.set()
+    assert uploader.flush(5)
+    uploader.submit('egg', '12345678')
+    uploader.close()
+
+def test_block_timeout():
+    gate = threading.Event()
+    uploader = WriteBehindUploader(StubClient(gate=gate), workers=1, max_bytes=10)
+    uploader.submit('spam', '12345678')
+    try:
+        uploader.submit('egg', '12345678', timeout=0.05)
+    except UploadQueueFull:
+        pass
+    else:
+        assert False, "UploadQueueFull expected"
+    gate.set()
+    uploader.close()
+
+def test_real_client():
+    # the workers share one Client, its tracker socket and storage pool
+    with Cluster(nodes=2) as cluster:
+        Admin(cluster.hosts).create_domain('uploader')
+        client = Client('uploader', cluster.hosts)
+        data = dict([('key%d' % x, chr(ord('a') + x % 26) * (100000 + x)) for x in xrange(40)])
+        with WriteBehindUploader(client, workers=8) as uploader:
+            futures = [uploader.submit(key, value) for key, value in sorted(data.items())]
+            assert uploader.flush(30)
+        assert [f.exception() for f in futures] == [None] * len(futures)
+        for key, value in data.items():
+            assert client.get_file_data(key) == value